@@ -11,11 +11,11 @@ Just for test:
   # send a request (different shell):
   $ python stream_err.py
 
-What I get here: the buffer works, but waits indefinitly for a last 'read'
- - if I press ^C at the server shell, it finishes off the response, which 
- is complete!
-I even tried to experiment with the IByteStream's length - I don't really
-understand how it affects read-ing - see line 417.
+Responses are marshalled lazily: lists, tuples, dicts, iterators and
+generators are turned into XML piece by piece, as the client reads the
+response, so only about one chunk of it is in memory at a time. Requests
+are unmarshalled as their body arrives; big base64 and array arguments
+are spooled to temporary files.
 '''
 
 ##
@@ -110,6 +110,51 @@ class AsyncMarshaller(Marshaller):
   #
   dispatch[types.GeneratorType] = dump_generator
 
+  def iterparams(self, values):
+    '''generates the marshalled params (or fault) in pieces'''
+    if isinstance(values, Fault):
+      yield "<fault>\n"
+      for piece in self.itervalue({'faultCode': values.faultCode,
+          'faultString': values.faultString}):
+        yield piece
+      yield "</fault>\n"
+    else:
+      yield "<params>\n"
+      for v in values:
+        yield "<param>\n"
+        for piece in self.itervalue(v):
+          yield piece
+        yield "</param>\n"
+      yield "</params>\n"
+
+  def itervalue(self, value):
+    '''generates the marshalled value in pieces
+
+    containers, iterators and generators are walked lazily, everything
+    else is dumped in one piece'''
+    if hasattr(value, 'iteritems'):
+      yield '<value><struct>\n'
+      for key, val in value.iteritems():
+        if isinstance(key, unicode):
+          key = key.encode(self.encoding or ENCODING)
+        elif not isinstance(key, str):
+          raise TypeError, "dictionary key must be string"
+        yield '<member>\n<name>%s</name>\n' % xmlrpclib.escape(key)
+        for piece in self.itervalue(val):
+          yield piece
+        yield '</member>\n'
+      yield '</struct></value>\n'
+    elif hasattr(value, '__iter__'):
+      yield '<value><array><data>\n'
+      for val in value:
+        for piece in self.itervalue(val):
+          yield piece
+      yield '</data></array></value>\n'
+    else:
+      out = []
+      self.__dump(value, out.append)
+      yield ''.join(out)
+
 ##
 # Convert a Python tuple or a Fault instance to an XML-RPC packet.
 #
@@ -200,13 +245,184 @@ def dumps(params, methodname=None, methodresponse=None, encoding=None,
     write(''.join(data[-1]))
   return ''.join(result)
 
+def iterdumps(params, methodname=None, methodresponse=None, encoding=None,
+     allow_none=0):
+  '''same as dumps, but generates the packet in pieces
+
+  nothing is marshalled before it is asked for'''
+  assert isinstance(params, types.TupleType) or isinstance(params, Fault),\
+      "argument must be tuple or Fault instance"
+
+  if isinstance(params, Fault):
+    methodresponse = 1
+  elif methodresponse and isinstance(params, types.TupleType):
+    assert len(params) == 1, "response tuple must be a singleton"
+
+  if not encoding:
+    encoding = "utf-8"
+
+  m = AsyncMarshaller(encoding, allow_none, write=None)
+
+  if encoding != "utf-8":
+    yield "<?xml version='1.0' encoding='%s'?>\n" % str(encoding)
+  else:
+    yield "<?xml version='1.0'?>\n" # utf-8 is default
+
+  if methodname:
+    if not isinstance(methodname, types.StringType):
+      methodname = methodname.encode(encoding)
+    yield "<methodCall>\n<methodName>%s</methodName>\n" % methodname
+    footer = "</methodCall>\n"
+  elif methodresponse:
+    yield "<methodResponse>\n"
+    footer = "</methodResponse>\n"
+  else:
+    footer = ""
+  for piece in m.iterparams(params):
+    yield piece
+  yield footer
+
+import binascii, cPickle, tempfile
+from cStringIO import StringIO
+
+class SpooledArray(object):
+  '''array parameter of a streamed call
+
+  keeps up to maxItems elements in memory, and pickles all of them to
+  a temporary file beyond that; iterate over it to get them back'''
+  def __init__(self, maxItems=1000):
+    self.maxItems = maxItems
+    self._items = []
+    self._files = []
+    self._file = None
+    self._len = 0
+
+  def append(self, value):
+    self._len += 1
+    if self._file is None:
+      self._items.append(value)
+      if len(self._items) > self.maxItems:
+        self._file = tempfile.TemporaryFile()
+        for item in self._items:
+          self._dump(item)
+        self._items = []
+    else:
+      self._dump(value)
+
+  def _dump(self, value):
+    p = cPickle.Pickler(self._file, 2)
+    p.persistent_id = self._persistentId
+    p.dump(value)
+
+  def _persistentId(self, obj):
+    # base64 parameters are files already, only remember them
+    if isinstance(obj, file) or hasattr(obj, 'getvalue'):
+      self._files.append(obj)
+      return len(self._files) - 1
+    return None
+
+  def __len__(self):
+    return self._len
+
+  def __iter__(self):
+    if self._file is None:
+      return iter(self._items)
+    return self._iterfile()
+
+  def _iterfile(self):
+    f = self._file
+    f.flush()
+    f.seek(0)
+    for i in xrange(self._len):
+      u = cPickle.Unpickler(f)
+      u.persistent_load = self._files.__getitem__
+      yield u.load()
+
+
+class StreamingUnmarshaller(xmlrpclib.Unmarshaller):
+  '''unmarshaller to be fed with the request body chunk by chunk
+
+  base64 values are decoded as they arrive into a file-like object
+  (a temporary file beyond spoolSize bytes), and array parameters
+  become SpooledArrays, so neither has to fit in memory'''
+  spoolSize = 1024 * 1024
+  maxItems = 1000
+
+  def __init__(self, use_datetime=0):
+    xmlrpclib.Unmarshaller.__init__(self, use_datetime)
+    self._array = None
+    self._spool = None
+
+  def start(self, tag, attrs):
+    if tag == 'array' and not self._marks:
+      self._array = SpooledArray(self.maxItems)
+    xmlrpclib.Unmarshaller.start(self, tag, attrs)
+    if tag == 'base64':
+      self._spool = StringIO()
+      self._b64 = []
+      self._b64size = 0
+
+  def data(self, text):
+    if self._spool is None:
+      self._data.append(text)
+      return
+    self._b64.append(text)
+    self._b64size += len(text)
+    if self._b64size >= 64 * 1024:
+      self._decode(False)
+
+  def _decode(self, final):
+    data = ''.join(''.join(self._b64).split())
+    cut = len(data)
+    if not final:
+      cut -= cut % 4
+    self._b64 = [data[cut:]]
+    self._b64size = len(data) - cut
+    if cut:
+      self._spool.write(binascii.a2b_base64(data[:cut]))
+    if hasattr(self._spool, 'getvalue') and \
+        self._spool.tell() > self.spoolSize:
+      spool = tempfile.TemporaryFile()
+      spool.write(self._spool.getvalue())
+      self._spool = spool
+
+  def end(self, tag):
+    if tag == 'base64':
+      self._decode(True)
+      spool, self._spool = self._spool, None
+      spool.seek(0)
+      self.append(spool)
+      self._value = 0
+    elif tag == 'array' and self._array is not None and \
+        len(self._marks) == 1:
+      self._marks.pop()
+      array, self._array = self._array, None
+      self.append(array)
+      self._value = 0
+    else:
+      xmlrpclib.Unmarshaller.end(self, tag)
+    if self._array is not None and len(self._marks) == 1:
+      # move the finished elements out of the stack
+      mark = self._marks[0]
+      for value in self._stack[mark:]:
+        self._array.append(value)
+      del self._stack[mark:]
+
+def getparser(use_datetime=0):
+  '''same as xmlrpclib.getparser, but with a StreamingUnmarshaller
+
+  feed the parser with the chunks as they arrive'''
+  target = StreamingUnmarshaller(use_datetime)
+  return xmlrpclib.ExpatParser(target), target
+
 #xmlrpclib.Marshaller = AsyncMarshaller
 #xmlrpclib.dumps = dumps
 
 import itertools, functools, string, shelve, tempfile, os, pprint
 from datetime import datetime
 import time
-from twisted.internet import defer, threads
+from twisted.internet import defer
+from twisted.python import failure
 
 def enc(obj, encoding=ENCODING):
   if isinstance(obj, unicode): return obj.encode(encoding)
@@ -225,24 +441,6 @@ def print_err(failure):
   if hasattr(failure, 'printTraceback'): failure.printTraceback()
   else: print pprint.pformat(failure)
 
-TEMPFILES = []
-def tempfilename(*args, **kwds):
-  (fdesc, fname) = tempfile.mkstemp(*args, **kwds)
-  os.close(fdesc)
-  os.unlink(fname)
-  TEMPFILES.append(fname)
-  return fname
-
-def del_tempfiles():
-  for fn in TEMPFILES:
-    if os.path.exists(fn):
-      try:
-        os.unlink(fn)
-      except:
-        pass
-import atexit
-atexit.register(del_tempfiles)
-
 from twisted.web2 import stream
 
 ##
@@ -254,221 +452,93 @@ from twisted.web2 import server, http, resource, channel, xmlrpc
 from twisted.web2 import static, http_headers, responsecode, stream
 MimeType = http_headers.MimeType
 
-import threading, thread
-
-class StringCache(object):
-  '''Queue for a string
-
-  buffers everything onto disk, and gives back chunk sized parts of it'''
-  def __init__(self, chunksize=1*1024**2):
-    self._dbfn = tempfile.mkdtemp()
-    self.chunksize = chunksize
-    self._lock = threading.Lock()
-    self.truncate()
-    self.buffer = []
-    self.length = 0
-    self._blen = 0
-    self._first = 0
-    self._last = 0
-
-  def lock(self, txt=''):
-    '''locking mechanism
-
-    against nasty threads'''
-    if not self._lock.acquire(False):
-      print 'BLOCKING!'
-      self._lock.acquire(True)
-
-  def release(self, txt=''):
-    '''release lock'''
-    self._lock.release()
-
-  def _write(self, key, data):
-    '''writes to disk'''
-    fn = os.path.join(self._dbfn, str(key))
-    msk = os.umask(0066)
-    fh = open(fn, 'wb')
-    os.umask(msk)
-    fh.truncate()
-    fh.seek(0,0)
-    print 'writing %d to %s'%(len(data), fn)
-    fh.write(data)
-    fh.flush()
-    fh.close()
-
-  def _read(self, key):
-    '''reads back from disk'''
-    fn = os.path.join(self._dbfn, str(key))
-    fh = open(fn, 'rb')
-    data = fh.read()
-    print 'read %d from %s'%(len(data), fn)
-    fh.seek(0, 2)
-    length = fh.tell()
-    if len(data) != length: print '!!!', len(data), length, '!!!'
-    fh.close()
-    os.unlink(fn)
-    return data
-
-  def put(self, text):
-    '''puts the given text to the end'''
-    if text is not None:
-      self.lock('PUT')
-      self.buffer.append(text)
-      n = len(text)
-      self._blen += n 
-      self.length += n
-      if self._blen >= self.chunksize or len(self.buffer) > 32766:
-        nxt = str(self._last)
-        try:
-          self._write(nxt, ''.join(self.buffer))
-        except Exception, dbme:
-          dt = ''.join(self.buffer)
-          pprint.pprint(( nxt, type(dt), len(dt), dbme))
-          raise dbme
-        self._last += 1
-        self.buffer = []
-        self._blen = 0
-      self.release()
-
-  def get(self):
-    '''gets the first chunk'''
-    res = None
-    self.lock('GET')
-    b = bool(self.buffer)
-    if self._first < self._last:
-      key = str(self._first)
-      res = self._read(key)
-      self._first += 1
-    elif self.buffer:
-      b = False
-      res = ''.join(self.buffer)
-      self.buffer = []
-      self._blen = 0
-    if res is not None:
-      self.length -= len(res)
-      if b: 
-        print 'LEFT in bufferben!', self._blen, sum(map(len, self.buffer))
-    self.release()
-    return res
-
-  def truncate(self):
-    '''truncactes the cache'''
-    self.lock('TRUNC')
-    self.buffer = []
-    self._blen = 0
-    self.length = 0
-    for fn in (os.path.join(self._dbfn, fn) 
-        for fn in os.listdir(self._dbfn)):
-      os.unlink(fn)
-    #
-    self._first = 0
-    self._last = 0
-    self.release()
-    print '.'
-
-  def __del__(self):
-    '''delete every file and folder'''
-    if hasattr(self, 'db') and self.db:
-      try:
-        self.db.close()
-      except:
-        pass
-      self.db = None
-    if self._dbfn and os.path.exists(self._dbfn):
-      if os.path.isdir(self._dbfn):
-        try:
-          for fn in (os.path.join(self._dbfn, fn) 
-              for fn in os.listdir(self._dbfn)):
-            os.unlink(fn)
-        except:
-          pass
-      try:
-        os.unlink(self._dbfn)
-      except:
-        pass
-
 from zope.interface import implements
-
-class XMLRPCRenderStream(object):
-  '''IByteStrem which produces what consumed by write
-  
-  Maybe the dumps call should be separated from here...
-  '''
-
-  implements(stream.IByteStream)
-
-  def __init__(self, src):
-    self.src = src
-    self.closed = False
-    self.cache = StringCache()
-    self.waiting = []
-    if isinstance(src, defer.Deferred):
-      self.dfr = self.src.addCallback(dumps, methodresponse=1,
-          allow_none=1, write=self.write)
-    else:
-      self.dfr = threads.deferToThread(dumps, 
-          src, methodresponse=1, write=self.write)
-    #
-    self.dfr.addErrback(print_err)
-    self.dfr.addCallback(self.finish)
-
-  def _getlength(self):
-    '''returns the length of the stream (as far as we know)'''
-    # this gives back no response (0 bytes):
-    # return (None if self.cache.length != 0 else 0)
-    # this seems to work:
-    return self.cache.length
-  length = property(_getlength)
-
-  def write(self, data):
-    '''consumes data'''
-    if data:
-      if not self.closed:
-        self.cache.put(data)
-        self._flush()
-      else:
-        raise StopIteration, 'write to a closed stream!'
-
-  def _flush(self):
-    '''produces into waiting 'read' calls, if any'''
-    while self.waiting and self.length > 0:
-      dfr = self.waiting.pop(0)
-      buf = []
-      while 1:
-        data = self.cache.get()
-        if data is None: 
+from twisted.internet import interfaces, reactor
+
+class XMLRPCResponseProducer(object):
+  '''push producer of a marshalled XML-RPC response
+
+  marshals the response lazily (see iterdumps), and writes it to the
+  consumer about chunkSize bytes at a time, one chunk per reactor
+  iteration, until it is paused - so a web2 ProducerStream as consumer
+  holds only a few chunks, and the transport's buffer filling up stops
+  the marshalling.'''
+
+  implements(interfaces.IPushProducer)
+
+  chunkSize = 64 * 1024
+
+  def __init__(self, result, consumer, allow_none=1, encoding=None):
+    self.consumer = consumer
+    self._pieces = iterdumps(result, methodresponse=1,
+        allow_none=allow_none, encoding=encoding)
+    self.paused = False
+    self._call = None
+    self.deferred = None
+
+  def start(self):
+    '''starts producing
+
+    returns a Deferred, which fires when the whole response is written,
+    or fails if marshalling fails or the consumer stops the producer'''
+    self.deferred = defer.Deferred()
+    self.consumer.registerProducer(self, True)
+    self._schedule()
+    return self.deferred
+
+  def _schedule(self):
+    if self._call is None and self.deferred is not None:
+      self._call = reactor.callLater(0, self._produce)
+
+  def _produce(self):
+    self._call = None
+    if self.paused or self.deferred is None:
+      return
+    buf = []
+    size = 0
+    done = True
+    try:
+      for piece in self._pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= self.chunkSize:
+          done = False
           break
-        buf.append(data)
-      data = ''.join(buf)
-      dfr.callback(data)
-
-  def read(self):
-    '''returns a Deferred for the read data'''
-    if not self.closed or self.cache.length > 0:
-      res = defer.Deferred()
-      self.waiting.append(res)
-      if self.closed:
-        self._flush()
+    except:
+      self._finish(failure.Failure())
+      return
+    if buf:
+      self.consumer.write(''.join(buf))
+    if done:
+      self._finish(None)
+    else:
+      self._schedule()
+
+  def _finish(self, result):
+    d, self.deferred = self.deferred, None
+    if d is None:
+      return
+    self.consumer.unregisterProducer()
+    if isinstance(result, failure.Failure):
+      d.errback(result)
     else:
-      res = None
-    return res
-
-  def close(self):
-    '''reader closes this stream'''
-    print 'CLOSE', self.length, self.cache.length
-    self._flush()
-    self.cache.truncate()
-
-  def finish(self, *args):
-    '''writer closes this stream'''
-    #print 'FINISH', self.cache.length
-    self._flush()
-    while self.waiting:
-      self.waiting.pop(0).callback(None)
-    self.closed = True
-
-  def split(self, point):
-    return stream.fallbackSplit(self, point)
+      d.callback(result)
+
+  def pauseProducing(self):
+    self.paused = True
+    if self._call is not None:
+      self._call.cancel()
+      self._call = None
+
+  def resumeProducing(self):
+    self.paused = False
+    self._schedule()
+
+  def stopProducing(self):
+    self.pauseProducing()
+    self._pieces.close()
+    self._finish(failure.Failure(
+        Exception("Consumer asked us to stop producing")))
 
 class XMLRPCInterface(xmlrpc.XMLRPC):
   '''the XML-RPC server'''
@@ -497,15 +567,27 @@ class XMLRPCInterface(xmlrpc.XMLRPC):
       raise xmlrpc.NoSuchFunction(self.NOT_FOUND, 
           'No such function %s'%functionPath)
 
+  def http_POST(self, request):
+    '''same as xmlrpc.XMLRPC's, but unmarshals the body as it arrives
+
+    base64 arguments are passed as file-like objects, arrays as
+    SpooledArrays (see StreamingUnmarshaller)'''
+    parser, unmarshaller = getparser()
+    d = stream.readStream(request.stream, parser.feed)
+    d.addCallback(lambda _: self._cbDispatch(request, parser, unmarshaller))
+    d.addErrback(self._ebRender)
+    d.addCallback(self._cbRender, request)
+    return d
+
   def _cbRender(self, result, request):
     if not isinstance(result, Fault):
       result = (result,)
-    try:
-      s = XMLRPCRenderStream(result)
-    except Exception, e:
-      f = Fault(self.FAILURE, "can't serialize output (%s)"%e)
-      print '_cbRender error:', e
-      s = xmlrpclib.dumps(f, methodresponse=1)
+    s = stream.ProducerStream()
+    d = XMLRPCResponseProducer(result, s).start()
+    # the response has started by the time marshalling can fail, so
+    # all we can do is to cut it short
+    d.addCallbacks(lambda _: s.finish(), s.finish)
+    d.addErrback(print_err)
     return http.Response(responsecode.OK, 
       {'content-type': http_headers.MimeType('text', 'xml')},
       s)
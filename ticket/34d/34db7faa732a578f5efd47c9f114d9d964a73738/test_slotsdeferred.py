@@ -0,0 +1,199 @@
+"""
+Tests for L{slotsdeferred.SlotsDeferred}.
+"""
+
+import gc
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python import log
+from twisted.test import test_defer
+
+from slotsdeferred import SlotsDeferred
+
+
+class SlotsDeferredTestCase(unittest.SynchronousTestCase):
+
+    def test_isDeferred(self):
+        d = SlotsDeferred()
+        self.failUnless(isinstance(d, defer.Deferred))
+        d.addCallback(lambda r: r + 1)
+        d.callback(1)
+        self.assertEqual(self.successResultOf(d), 2)
+
+    def test_noInstanceDictionary(self):
+        """
+        Everything a Deferred sets on itself while running and chaining goes
+        in the slots.
+        """
+        d = SlotsDeferred()
+        other = SlotsDeferred()
+        d.addCallback(lambda r: other)
+        d.addErrback(lambda f: None)
+        d.callback(None)
+        other.errback(ValueError())
+        d.pause()
+        d.unpause()
+        self.assertEqual(d.__dict__, {})
+        self.assertEqual(other.__dict__, {})
+
+    def test_chainFromDeferred(self):
+        """
+        A L{defer.Deferred} whose callback returns a L{SlotsDeferred} waits
+        for its result.
+        """
+        inner = SlotsDeferred()
+        results = []
+        d = defer.Deferred()
+        d.addCallback(lambda r: inner)
+        d.addCallback(results.append)
+        d.callback(None)
+        self.assertEqual(results, [])
+        self.assertIdentical(d._chainedTo, inner)
+        inner.callback("inner")
+        self.assertEqual(results, ["inner"])
+
+    def test_chainToDeferred(self):
+        """
+        A L{SlotsDeferred} whose callback returns a L{defer.Deferred} waits
+        for its result.
+        """
+        inner = defer.Deferred()
+        results = []
+        d = SlotsDeferred()
+        d.addCallback(lambda r: inner)
+        d.addCallback(results.append)
+        d.callback(None)
+        self.assertEqual(results, [])
+        inner.callback("inner")
+        self.assertEqual(results, ["inner"])
+
+    def test_maybeDeferred(self):
+        d = defer.maybeDeferred(lambda: SlotsDeferred())
+        self.failUnless(isinstance(d, SlotsDeferred))
+
+    def test_inlineCallbacks(self):
+        inner = SlotsDeferred()
+
+        @defer.inlineCallbacks
+        def f():
+            result = yield inner
+            defer.returnValue(result * 2)
+
+        d = f()
+        inner.callback(21)
+        self.assertEqual(self.successResultOf(d), 42)
+
+    def test_gatherResults(self):
+        ds = [SlotsDeferred(), SlotsDeferred()]
+        d = defer.gatherResults(ds)
+        ds[1].callback(2)
+        ds[0].callback(1)
+        self.assertEqual(self.successResultOf(d), [1, 2])
+
+    def test_pauseUnpause(self):
+        results = []
+        d = SlotsDeferred()
+        d.addCallback(results.append)
+        d.pause()
+        d.callback(1)
+        self.assertEqual(results, [])
+        d.unpause()
+        self.assertEqual(results, [1])
+
+    def test_cancel(self):
+        cancelled = []
+        d = SlotsDeferred(cancelled.append)
+        d.cancel()
+        self.assertEqual(cancelled, [d])
+        self.failureResultOf(d).trap(defer.CancelledError)
+
+    def test_cancelIgnoresLateResult(self):
+        d = SlotsDeferred()
+        d.cancel()
+        d.callback("late")
+        self.failureResultOf(d).trap(defer.CancelledError)
+
+    def test_cancelChained(self):
+        """
+        Cancelling a L{SlotsDeferred} waiting for another one cancels that
+        one instead.
+        """
+        inner = SlotsDeferred()
+        d = SlotsDeferred()
+        d.addCallback(lambda r: inner)
+        d.callback(None)
+        d.cancel()
+        self.failUnless(inner.called)
+        self.failureResultOf(d).trap(defer.CancelledError)
+
+    def test_unhandledErrorLogged(self):
+        errors = []
+        log.addObserver(errors.append)
+        self.addCleanup(log.removeObserver, errors.append)
+        d = SlotsDeferred()
+        d.addCallback(lambda r: 1 / 0)
+        d.callback(None)
+        del d
+        gc.collect()
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+    def test_deepChain(self):
+        """
+        A long chain of L{SlotsDeferred}s each waiting for the next is run
+        without recursion.
+        """
+        last = SlotsDeferred()
+        d = last
+        for i in xrange(10000):
+            d = SlotsDeferred().addCallback(lambda ignored, d=d: d)
+            d.callback(None)
+        last.callback("deep")
+        self.assertEqual(self.successResultOf(d), "deep")
+
+
+
+class _SlotsDefer(object):
+    """
+    L{twisted.internet.defer}, as seen by the tests of L{test_defer} when
+    they create a L{defer.Deferred}.
+    """
+    Deferred = SlotsDeferred
+
+    def __getattr__(self, name):
+        return getattr(defer, name)
+
+
+
+# The reprs of a subclass have its own name, as with DeferredList
+_skipped = ['test_repr', 'test_reprWithResult', 'test_reprWithChaining']
+
+def _slotsTestCase(testCase):
+    """
+    Make a test case running the tests of I{testCase} with
+    L{SlotsDeferred}s instead of L{defer.Deferred}s.
+    """
+    def setUp(self):
+        self.patch(test_defer, 'defer', _SlotsDefer())
+        return testCase.setUp(self)
+
+    def skipped(self):
+        pass
+    skipped.skip = "The repr of a SlotsDeferred names SlotsDeferred"
+
+    attributes = {'setUp': setUp}
+    for name in _skipped:
+        if hasattr(testCase, name):
+            attributes[name] = skipped
+    name = testCase.__name__ + 'WithSlots'
+    return type(name, (testCase,), attributes)
+
+
+
+for _name, _testCase in vars(test_defer).items():
+    if (isinstance(_testCase, type) and
+        issubclass(_testCase, unittest.SynchronousTestCase) and
+        _testCase.__module__ == test_defer.__name__):
+        _slotsTest = _slotsTestCase(_testCase)
+        globals()[_slotsTest.__name__] = _slotsTest
+del _name, _testCase, _slotsTest
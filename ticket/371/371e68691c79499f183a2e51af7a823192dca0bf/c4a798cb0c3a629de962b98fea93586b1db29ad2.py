@@ -9,19 +9,29 @@ listeners or connectors are added)::
 
     from twisted.internet import epollreactor
     epollreactor.install()
+
+Pass C{edgeTriggered=True} to L{install} to have descriptors which are only
+being read from registered edge-triggered (C{EPOLLET}).
 """
 
 from __future__ import division, absolute_import
 
-from select import epoll, EPOLLHUP, EPOLLERR, EPOLLIN, EPOLLOUT
-import errno, os
+import select
+from select import epoll, EPOLLHUP, EPOLLERR, EPOLLIN, EPOLLOUT, EPOLLET
+import errno, fcntl, os, socket, struct, sys, termios, time
+
+# Not exposed by the select and socket modules of older Pythons.
+EPOLLRDHUP = getattr(select, 'EPOLLRDHUP', 0x2000)
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
 
 from zope.interface import implementer
 
 from twisted.internet.interfaces import IReactorFDSet
 
 from twisted.python import log
-from twisted.internet import posixbase
+from twisted.internet import defer, posixbase, tcp
+from twisted.internet.error import CannotListenError
+from twisted.internet.main import CONNECTION_DONE, CONNECTION_LOST
 
 
 
@@ -39,9 +49,29 @@ class _ContinuousPolling(posixbase._PollLikeMixin,
     but re-implementing and testing the relevant code yet again is
     unappealing.
 
+    Polling backs off: the delay between polls doubles, up to
+    C{maximumDelay}, every time no reader made progress (its file offset
+    stayed put), and goes back to C{minimumDelay} as soon as one does, or a
+    writer or a reader is added.  So a file which is only being tailed does
+    not keep a CPU busy.
+
     @ivar _reactor: The L{EPollReactor} that is using this instance.
 
-    @ivar _loop: A C{LoopingCall} that drives the polling, or C{None}.
+    @ivar _call: The C{IDelayedCall} of the next poll, or C{None}.
+
+    @ivar _delay: The current delay between polls, in seconds.
+
+    @ivar useInotify: Whether to also watch the files being read from with
+        C{inotify(7)}, which cuts the delay short when they are modified, so
+        the delay can grow up to C{inotifyMaximumDelay} instead.  Turned off
+        if C{inotify} is not available.
+
+    @ivar _inotify: The L{twisted.internet.inotify.INotify} in use, or
+        C{None}.
+
+    @ivar _watches: A dictionary mapping readers to the
+        L{twisted.python.filepath.FilePath} of the file being watched for
+        them.
 
     @ivar _readers: A C{set} of C{FileDescriptor} objects that should be read
         from.
@@ -55,32 +85,117 @@ class _ContinuousPolling(posixbase._PollLikeMixin,
     _POLL_IN = 2
     _POLL_OUT = 4
 
+    minimumDelay = 0.00001
+    maximumDelay = 0.1
+    inotifyMaximumDelay = 1.0
 
-    def __init__(self, reactor):
+    def __init__(self, reactor, useInotify=False):
         self._reactor = reactor
-        self._loop = None
+        self._call = None
+        self._delay = self.minimumDelay
         self._readers = set()
         self._writers = set()
         self.isReading = self._readers.__contains__
         self.isWriting = self._writers.__contains__
+        self.useInotify = useInotify
+        self._inotify = None
+        self._watches = {}
 
 
     def _checkLoop(self):
         """
-        Start or stop a C{LoopingCall} based on whether there are readers and
-        writers.
+        Schedule or cancel the next poll based on whether there are readers
+        and writers.
         """
         if self._readers or self._writers:
-            if self._loop is None:
-                from twisted.internet.task import LoopingCall, _EPSILON
-                self._loop = LoopingCall(self.iterate)
-                self._loop.clock = self._reactor
-                # LoopingCall seems unhappy with timeout of 0, so use very
-                # small number:
-                self._loop.start(_EPSILON, now=False)
-        elif self._loop:
-            self._loop.stop()
-            self._loop = None
+            if self._call is None:
+                self._call = self._reactor.callLater(self._delay, self._poll)
+        else:
+            self._delay = self.minimumDelay
+            if self._call is not None:
+                self._call.cancel()
+                self._call = None
+
+
+    def _wake(self, *args):
+        """
+        Go back to polling at C{minimumDelay}.
+        """
+        if self._delay > self.minimumDelay:
+            self._delay = self.minimumDelay
+            if self._call is not None:
+                self._call.reset(self._delay)
+
+
+    def _offset(self, reader):
+        """
+        Return the current offset in the file of a reader, or C{None} if it
+        cannot be told.
+        """
+        try:
+            return os.lseek(reader.fileno(), 0, os.SEEK_CUR)
+        except (OSError, IOError):
+            return None
+
+
+    def _poll(self):
+        """
+        Call L{iterate}, and adjust the delay of the next poll depending on
+        whether it got anything done.
+        """
+        self._call = None
+        offsets = [(reader, self._offset(reader)) for reader in self._readers]
+        self.iterate()
+        active = bool(self._writers)
+        for reader, offset in offsets:
+            if reader in self._readers and (
+                    offset is None or self._offset(reader) != offset):
+                active = True
+        if active:
+            self._delay = self.minimumDelay
+        else:
+            limit = self.maximumDelay
+            if self._inotify is not None and (
+                    len(self._watches) == len(self._readers)):
+                limit = self.inotifyMaximumDelay
+            self._delay = min(self._delay * 2, limit)
+        self._checkLoop()
+
+
+    def _watch(self, reader):
+        """
+        Watch the file a reader reads from with C{inotify}, if possible.
+        """
+        try:
+            from twisted.internet import inotify
+            from twisted.python.filepath import FilePath
+            if self._inotify is None:
+                self._inotify = inotify.INotify(self._reactor)
+                self._inotify.startReading()
+            path = FilePath(os.readlink("/proc/self/fd/%d" % (
+                reader.fileno(),)))
+            self._inotify.watch(path, inotify.IN_MODIFY,
+                                callbacks=[self._wake])
+        except Exception:
+            if self._inotify is None:
+                # No inotify here, don't try again.
+                self.useInotify = False
+            return
+        self._watches[reader] = path
+
+
+    def _unwatch(self, reader):
+        """
+        Stop watching the file a reader reads from, unless another reader
+        reads from it too.
+        """
+        path = self._watches.pop(reader, None)
+        if path is not None and path not in self._watches.values():
+            try:
+                self._inotify.ignore(path)
+            except KeyError:
+                # The watch went away with the file.
+                pass
 
 
     def iterate(self):
@@ -98,6 +213,9 @@ class _ContinuousPolling(posixbase._PollLikeMixin,
         Add a C{FileDescriptor} for notification of data available to read.
         """
         self._readers.add(reader)
+        if self.useInotify:
+            self._watch(reader)
+        self._wake()
         self._checkLoop()
 
 
@@ -106,6 +224,7 @@ class _ContinuousPolling(posixbase._PollLikeMixin,
         Add a C{FileDescriptor} for notification of data available to write.
         """
         self._writers.add(writer)
+        self._wake()
         self._checkLoop()
 
 
@@ -117,6 +236,7 @@ class _ContinuousPolling(posixbase._PollLikeMixin,
             self._readers.remove(reader)
         except KeyError:
             return
+        self._unwatch(reader)
         self._checkLoop()
 
 
@@ -141,6 +261,9 @@ class _ContinuousPolling(posixbase._PollLikeMixin,
         # to the existing instance:
         self._readers.clear()
         self._writers.clear()
+        for reader in list(self._watches):
+            self._unwatch(reader)
+        self._checkLoop()
         return result
 
 
@@ -188,6 +311,39 @@ class EPollReactor(posixbase.PosixReactorBase, posixbase._PollLikeMixin):
     @ivar _continuousPolling: A L{_ContinuousPolling} instance, used to handle
         file descriptors (e.g. filesytem files) that are not supported by
         C{epoll(7)}.
+
+    @ivar _edgeTriggered: If true, descriptors which are only being read from
+        and which support C{FIONREAD} are registered with C{EPOLLET}; after a
+        read event they are read from until nothing is left to read.  Write
+        interest is always level-triggered, since C{doWrite} gives no way to
+        tell whether the kernel buffer was filled.
+
+    @ivar _maxEvents: The largest number of events handled per iteration.
+
+    @ivar maxReadsPerEvent: The largest number of C{doRead} calls made for a
+        single edge-triggered read event, so that one busy connection cannot
+        starve the others.  Descriptors with data left over are kept in
+        C{_pendingReads} and read from again on the next iteration.
+
+    @ivar _registered: A dictionary mapping integer file descriptors to the
+        event mask they are registered with in C{_poller}.
+
+    @ivar _modified: A dictionary mapping integer file descriptors to
+        arbitrary values (this is essentially a set) whose event mask changed
+        since the last iteration.  C{_poller.modify} is only called for these
+        right before polling, and only if the mask ends up differing from the
+        registered one, so toggling write interest on and off within one
+        iteration costs no system call.
+
+    @ivar _drainable: A dictionary mapping integer file descriptors to
+        whether they support C{FIONREAD}, and so can be edge-triggered.
+
+    @ivar _pendingReads: A dictionary mapping integer file descriptors to
+        C{(selectable, event)} tuples of edge-triggered descriptors which may
+        have data left to read.
+
+    @ivar _preforkPorts: A C{list} of the L{_PreforkPort}s this reactor is
+        the master of.
     """
 
     # Attributes for _PollLikeMixin
@@ -195,10 +351,21 @@ class EPollReactor(posixbase.PosixReactorBase, posixbase._PollLikeMixin):
     _POLL_IN = EPOLLIN
     _POLL_OUT = EPOLLOUT
 
-    def __init__(self):
+    maxReadsPerEvent = 16
+
+    def __init__(self, edgeTriggered=False, maxEvents=1024, inotify=False):
         """
         Initialize epoll object, file descriptor tracking dictionaries, and the
         base class.
+
+        @param edgeTriggered: Whether to register descriptors which are only
+            being read from with C{EPOLLET}.
+
+        @param maxEvents: The largest number of events to ask C{epoll_wait}
+            for per iteration.
+
+        @param inotify: Whether to watch files which are polled, rather than
+            handled by C{epoll}, with C{inotify(7)}; see L{_ContinuousPolling}.
         """
         # Create the poller we're going to use.  The 1024 here is just a hint
         # to the kernel, it is not a hard maximum.  After Linux 2.6.8, the size
@@ -207,7 +374,14 @@ class EPollReactor(posixbase.PosixReactorBase, posixbase._PollLikeMixin):
         self._reads = {}
         self._writes = {}
         self._selectables = {}
-        self._continuousPolling = _ContinuousPolling(self)
+        self._registered = {}
+        self._modified = {}
+        self._drainable = {}
+        self._pendingReads = {}
+        self._edgeTriggered = edgeTriggered
+        self._maxEvents = maxEvents
+        self._preforkPorts = []
+        self._continuousPolling = _ContinuousPolling(self, inotify)
         posixbase.PosixReactorBase.__init__(self)
 
 
@@ -220,20 +394,23 @@ class EPollReactor(posixbase.PosixReactorBase, posixbase._PollLikeMixin):
         """
         fd = xer.fileno()
         if fd not in primary:
-            flags = event
-            # epoll_ctl can raise all kinds of IOErrors, and every one
-            # indicates a bug either in the reactor or application-code.
-            # Let them all through so someone sees a traceback and fixes
-            # something.  We'll do the same thing for every other call to
-            # this method in this file.
-
             if fd in other:
-                flags |= antievent
-                log.msg("[{0}] Modify   FD={1} flags={2}  (primary={3}, other={4}) -- FileDesciptor Class={5}".format(os.getpid(), fd, flags, primary, other, repr(xer.__class__)))
-                self._poller.modify(fd, flags)
+                # Already registered for the other event, so only the mask
+                # changes; leave that to _flushModifications.
+                self._modified[fd] = 1
             else:
-                log.msg("[{0}] Register FD={1} flags={2}  (primary={3}, other={4}) -- FileDesciptor Class={5}".format(os.getpid(), fd, flags, primary, other, repr(xer.__class__)))
+                flags = event
+                if self._edgeTriggered and event == EPOLLIN:
+                    drainable = self._drainable[fd] = self._canDrain(fd)
+                    if drainable:
+                        flags |= EPOLLET | EPOLLRDHUP
+                # epoll_ctl can raise all kinds of IOErrors, and every one
+                # indicates a bug either in the reactor or application-code.
+                # Let them all through so someone sees a traceback and fixes
+                # something.  We'll do the same thing for every other call to
+                # this method in this file.
                 self._poller.register(fd, flags)
+                self._registered[fd] = flags
 
             # Update our own tracking state *only* after the epoll call has
             # succeeded.  Otherwise we may get out of sync.
@@ -241,6 +418,64 @@ class EPollReactor(posixbase.PosixReactorBase, posixbase._PollLikeMixin):
             selectables[fd] = xer
 
 
+    def _canDrain(self, fd):
+        """
+        Tell whether C{FIONREAD} works for a file descriptor, which is what
+        edge-triggered reading relies on to find out when to stop.
+        """
+        try:
+            fcntl.ioctl(fd, termios.FIONREAD, b"\0\0\0\0")
+        except IOError:
+            return False
+        return True
+
+
+    def _readable(self, fd):
+        """
+        Return the number of bytes waiting to be read from a file descriptor.
+        """
+        try:
+            return struct.unpack(
+                "i", fcntl.ioctl(fd, termios.FIONREAD, b"\0\0\0\0"))[0]
+        except IOError:
+            return 0
+
+
+    def _eventMask(self, fd):
+        """
+        Compute the event mask a file descriptor should be registered with.
+        """
+        flags = 0
+        if fd in self._reads:
+            flags |= EPOLLIN
+        if fd in self._writes:
+            flags |= EPOLLOUT
+        if flags == EPOLLIN and self._drainable.get(fd):
+            flags |= EPOLLET | EPOLLRDHUP
+        return flags
+
+
+    def _flushModifications(self):
+        """
+        Bring the event masks registered with C{_poller} up to date with
+        C{_reads} and C{_writes}.
+        """
+        modified = self._modified
+        self._modified = {}
+        registered = self._registered
+        for fd in modified:
+            if fd not in registered:
+                continue
+            flags = self._eventMask(fd)
+            if flags != registered[fd]:
+                if self._edgeTriggered and flags == EPOLLIN and \
+                        fd not in self._drainable:
+                    self._drainable[fd] = self._canDrain(fd)
+                    flags = self._eventMask(fd)
+                self._poller.modify(fd, flags)
+                registered[fd] = flags
+
+
     def addReader(self, reader):
         """
         Add a FileDescriptor for notification of data available to read.
@@ -294,13 +529,17 @@ class EPollReactor(posixbase.PosixReactorBase, posixbase._PollLikeMixin):
                 return
         if fd in primary:
             if fd in other:
-                flags = antievent
-                # See comment above modify call in _add.
-                self._poller.modify(fd, flags)
+                self._modified[fd] = 1
             else:
                 del selectables[fd]
-                # See comment above _control call in _add.
+                # Unregister right away rather than lazily: the descriptor
+                # may be closed soon after, and its number reused.  See
+                # comment above register call in _add.
                 self._poller.unregister(fd)
+                del self._registered[fd]
+                self._modified.pop(fd, None)
+                self._drainable.pop(fd, None)
+                self._pendingReads.pop(fd, None)
             del primary[fd]
 
 
@@ -350,17 +589,24 @@ class EPollReactor(posixbase.PosixReactorBase, posixbase._PollLikeMixin):
         """
         Poll the poller for new events.
         """
-        if timeout is None:
+        if self._modified:
+            self._flushModifications()
+        pending = self._pendingReads
+        if pending:
+            # Some edge-triggered descriptors still have data to read, and
+            # will get no further event for it.
+            self._pendingReads = {}
+            timeout = 0
+        elif timeout is None:
             timeout = -1  # Wait indefinitely.
 
         try:
-            # Limit the number of events to the number of io objects we're
-            # currently tracking (because that's maybe a good heuristic) and
-            # the amount of time we block to the value specified by our
-            # caller.
-            l = self._poller.poll(timeout, len(self._selectables))
+            # Limit the number of events handled in one go, and the amount of
+            # time we block to the value specified by our caller.
+            l = self._poller.poll(timeout, self._maxEvents)
         except IOError as err:
             if err.errno == errno.EINTR:
+                self._pendingReads.update(pending)
                 return
             # See epoll_wait(2) for documentation on the other conditions
             # under which this can fail.  They can only be due to a serious
@@ -368,26 +614,744 @@ class EPollReactor(posixbase.PosixReactorBase, posixbase._PollLikeMixin):
             # loudly.
             raise
 
+        selectables = self._selectables
+        callWithLogger = log.callWithLogger
+        if pending:
+            _drain = self._drain
+            for fd, (selectable, event) in pending.items():
+                if selectables.get(fd) is selectable and fd in self._reads:
+                    callWithLogger(selectable, _drain, selectable, fd, event)
+
         _drdw = self._doReadOrWrite
         for fd, event in l:
             try:
-                selectable = self._selectables[fd]
+                selectable = selectables[fd]
             except KeyError:
                 pass
             else:
-                log.callWithLogger(selectable, _drdw, selectable, fd, event)
+                callWithLogger(selectable, _drdw, selectable, fd, event)
+
+
+    def _doReadOrWrite(self, selectable, fd, event):
+        """
+        Dispatch an event, draining edge-triggered descriptors.
+        """
+        if event & EPOLLRDHUP or self._registered.get(fd, 0) & EPOLLET:
+            self._drain(selectable, fd, event)
+        else:
+            posixbase._PollLikeMixin._doReadOrWrite(
+                self, selectable, fd, event)
+
+
+    def _drain(self, selectable, fd, event):
+        """
+        Read from an edge-triggered descriptor until nothing is left to read,
+        the peer has shut down and the descriptor has been disconnected, or
+        C{maxReadsPerEvent} is reached.
+        """
+        hangup = event & (EPOLLRDHUP | EPOLLHUP | EPOLLERR)
+        if event & EPOLLRDHUP:
+            # The end of the stream is there to be read.
+            event |= EPOLLIN
+        _drdw = posixbase._PollLikeMixin._doReadOrWrite
+        for i in range(self.maxReadsPerEvent):
+            _drdw(self, selectable, fd, event)
+            if self._selectables.get(fd) is not selectable or (
+                    fd not in self._reads):
+                return
+            if not hangup and not self._readable(fd):
+                return
+            # A write event has been handled already.
+            event &= ~EPOLLOUT
+        self._pendingReads[fd] = (selectable, event)
 
     doIteration = doPoll
 
 
-def install():
+    def listenTCP(self, port, factory, backlog=50, interface='',
+                  reusePort=False, workers=0):
+        """
+        @see: L{twisted.internet.interfaces.IReactorTCP.listenTCP}
+
+        @param reusePort: Whether to set C{SO_REUSEPORT} on the listening
+            socket, so that other sockets, in this or other processes, can
+            listen on the same address, the kernel spreading connections
+            across them.
+
+        @param workers: With C{reusePort}, the number of worker processes to
+            fork, each listening on its own socket, and running its own
+            reactor; this process only supervises them.  Call this before
+            anything else is set up, as the workers are forked right away,
+            and they do not keep the rest of the reactor's state.  In the
+            workers, the worker's own port is returned.
+
+        @return: An object providing L{IListeningPort}.
+        """
+        if not reusePort:
+            if workers:
+                raise ValueError("workers need reusePort")
+            return posixbase.PosixReactorBase.listenTCP(
+                self, port, factory, backlog, interface)
+        if workers:
+            p = _PreforkPort(self, port, factory, backlog, interface, workers)
+        else:
+            p = _ReusePort(port, factory, backlog, interface, self)
+        return p.startListening() or p
+
+
+    def _reinitializeAfterFork(self):
+        """
+        Forget everything inherited from the parent process, and start over
+        with a new C{epoll} object and wakers.
+
+        The C{epoll} object is shared with the parent, so nothing inherited
+        is unregistered from it, which would unregister it in the parent
+        too.
+        """
+        for port in self._preforkPorts:
+            port._forget()
+        self._preforkPorts = []
+        self._poller.close()
+        self._poller = epoll(1024)
+        for tracking in (self._reads, self._writes, self._selectables,
+                         self._registered, self._modified, self._drainable,
+                         self._pendingReads):
+            tracking.clear()
+        self._continuousPolling = _ContinuousPolling(
+            self, self._continuousPolling.useInotify)
+        self._pendingTimedCalls = []
+        self._newTimedCalls = []
+        self._cancellations = 0
+        if self.threadpool is not None:
+            # Its threads did not survive the fork.
+            for trigger in (self._threadpoolStartupID,
+                            self.threadpoolShutdownID):
+                if trigger is not None:
+                    try:
+                        self.removeSystemEventTrigger(trigger)
+                    except ValueError:
+                        pass
+            self._threadpoolStartupID = self.threadpoolShutdownID = None
+            self.threadpool = None
+        self.threadCallQueue = []
+        self._internalReaders.clear()
+        self.waker = None
+        self.installWaker()
+        if self._childWaker is not None:
+            self._childWaker = posixbase._SIGCHLDWaker(self)
+            self._internalReaders.add(self._childWaker)
+            self.addReader(self._childWaker)
+            self._childWaker.install()
+
+
+
+class _ReusePort(tcp.Port):
+    """
+    A TCP port whose socket has C{SO_REUSEPORT} set.
+    """
+
+    def createInternetSocket(self):
+        s = tcp.Port.createInternetSocket(self)
+        s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return s
+
+
+
+class _ControlChannel(object):
+    """
+    One end of the control socket pair between a prefork master and one of
+    its workers, carrying newline-terminated commands and stats reports.
+    """
+
+    def __init__(self, reactor, skt, lineReceived, lost):
+        self.reactor = reactor
+        self.socket = skt
+        self._lineReceived = lineReceived
+        self._lost = lost
+        self._buffer = b""
+        skt.setblocking(False)
+
+
+    def fileno(self):
+        return self.socket.fileno()
+
+
+    def logPrefix(self):
+        return "ControlChannel"
+
+
+    def doRead(self):
+        try:
+            data = self.socket.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            return CONNECTION_LOST
+        if not data:
+            return CONNECTION_DONE
+        lines = (self._buffer + data).split(b"\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            self._lineReceived(line)
+
+
+    def sendLine(self, line):
+        """
+        Send a line, dropping it if the other end is gone.
+        """
+        try:
+            self.socket.sendall(line + b"\n")
+        except socket.error:
+            pass
+
+
+    def close(self):
+        """
+        Close the socket, without telling anyone.
+        """
+        self.reactor.removeReader(self)
+        self.socket.close()
+
+
+    def connectionLost(self, reason):
+        self.close()
+        self._lost()
+
+
+
+class _PreforkWorker(object):
+    """
+    The worker side of a L{_PreforkPort}: tells the master once it is
+    listening, reports stats to it, and shuts down gracefully when told to,
+    or when the master goes away.
+
+    @ivar accepted: The number of connections accepted.
+
+    @ivar protocols: The C{set} of connected protocols.
+
+    @ivar statsInterval: How often to report stats to the master, in seconds.
+
+    @ivar gracePeriod: How long to wait for connections to finish once
+        told to stop, in seconds.
+    """
+    statsInterval = 1.0
+    gracePeriod = 30.0
+
+    def __init__(self, reactor, skt):
+        self.reactor = reactor
+        self.channel = _ControlChannel(reactor, skt, self.lineReceived,
+                                       self.stop)
+        self.port = None
+        self.accepted = 0
+        self.protocols = set()
+        self.stopping = False
+        self._stopped = False
+
+
+    def start(self, port):
+        """
+        Tell the master that the worker is listening, and start reporting on
+        the port.
+        """
+        from twisted.internet.task import LoopingCall
+        self.port = port
+        self.reactor.addReader(self.channel)
+        self.channel.sendLine(b"ready")
+        # Never return into the master's code once the reactor is done.
+        self.reactor.addSystemEventTrigger('after', 'shutdown', os._exit, 0)
+        self._report = LoopingCall(self.report)
+        self._report.clock = self.reactor
+        self._report.start(self.statsInterval, now=False)
+
+
+    def report(self):
+        self._sendStats()
+        if self.stopping and not self.protocols:
+            self._stop()
+
+
+    def _sendStats(self):
+        self.channel.sendLine(b"stats " + (
+            "%d %d" % (self.accepted, len(self.protocols))).encode("ascii"))
+
+
+    def lineReceived(self, line):
+        if line == b"stop":
+            self.stop()
+
+
+    def stop(self):
+        """
+        Stop accepting connections, and stop the reactor once the open ones
+        are closed, or C{gracePeriod} is over.
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        self.port.stopListening()
+        self.reactor.callLater(self.gracePeriod, self._stop)
+        if not self.protocols:
+            self._stop()
+
+
+    def _stop(self):
+        if not self._stopped:
+            self._stopped = True
+            self._sendStats()
+            self.reactor.stop()
+
+
+
+def _workerFactory(worker, factory):
+    """
+    Wrap a factory so that a L{_PreforkWorker} can keep count of the
+    connections it builds.
+    """
+    from twisted.protocols.policies import WrappingFactory
+
+    class WorkerFactory(WrappingFactory):
+        def registerProtocol(self, p):
+            worker.accepted += 1
+            worker.protocols.add(p)
+
+        def unregisterProtocol(self, p):
+            worker.protocols.discard(p)
+
+    return WorkerFactory(factory)
+
+
+
+class _PreforkPort(object):
+    """
+    A TCP port served by worker processes, each accepting connections on its
+    own C{SO_REUSEPORT} socket, the kernel spreading them across the workers.
+
+    The master binds a socket to the address without listening on it, which
+    reserves the port number, and forks the workers.  Each worker talks to
+    the master over a L{_ControlChannel}, saying C{ready} once it listens;
+    workers which exit unexpectedly are replaced after C{restartDelay}
+    seconds.
+
+    @ivar workers: A dictionary mapping the process IDs of the workers to
+        their L{_ControlChannel}s.
+
+    @ivar workerStats: A dictionary mapping the process IDs of the workers
+        to the last C{(accepted, active)} connection counts they reported.
+    """
+    restartDelay = 1.0
+
+    def __init__(self, reactor, port, factory, backlog, interface,
+                 workerCount):
+        self.reactor = reactor
+        self.port = port
+        self.factory = factory
+        self.backlog = backlog
+        self.interface = interface
+        self.workerCount = workerCount
+        self.workers = {}
+        self.workerStats = {}
+        self.stopping = False
+        self._retiring = set()
+        self._retiredAccepted = 0
+        # Workers still to be replaced by restartWorkers, in order
+        self._restartQueue = []
+        # Maps a new worker which isn't ready yet to the one it replaces
+        self._replacements = {}
+        self._stopWaiters = []
+        self._socket = None
+
+
+    def startListening(self):
+        """
+        Reserve the port and fork the workers.
+
+        @return: In a worker, the worker's listening port, otherwise C{None}.
+        """
+        p = _ReusePort(self.port, self.factory, self.backlog, self.interface,
+                       self.reactor)
+        skt = p.createInternetSocket()
+        try:
+            if p.addressFamily == socket.AF_INET6:
+                skt.bind(tcp._resolveIPv6(self.interface, self.port))
+            else:
+                skt.bind((self.interface, self.port))
+        except socket.error as le:
+            skt.close()
+            raise CannotListenError(self.interface, self.port, le)
+        self._socket = skt
+        self.port = skt.getsockname()[1]
+        self._addressType = p._addressType
+        self._shutdownID = self.reactor.addSystemEventTrigger(
+            'before', 'shutdown', self.stopListening)
+        self.reactor._preforkPorts.append(self)
+        for i in range(self.workerCount):
+            port = self._spawn()
+            if port is not None:
+                return port
+
+
+    def _spawn(self, replacing=None):
+        """
+        Fork a worker.
+
+        Only call this when nothing up the stack is going to do anything
+        else, since the worker returns here too.
+
+        @param replacing: The process ID of a worker to stop once the new one
+            is ready, or C{None}.
+
+        @return: In the worker, its listening port, otherwise C{None}.
+        """
+        master, worker = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            master.close()
+            self.reactor._reinitializeAfterFork()
+            w = _PreforkWorker(self.reactor, worker)
+            port = _ReusePort(self.port, _workerFactory(w, self.factory),
+                              self.backlog, self.interface, self.reactor)
+            port.startListening()
+            w.start(port)
+            return port
+        worker.close()
+        channel = _ControlChannel(
+            self.reactor, master,
+            lambda line: self._lineReceived(pid, line),
+            lambda: self._workerLost(pid))
+        self.workers[pid] = channel
+        self.workerStats[pid] = (0, 0)
+        if replacing is not None:
+            self._replacements[pid] = replacing
+        self.reactor.addReader(channel)
+
+
+    def _lineReceived(self, pid, line):
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == b"stats":
+            self.workerStats[pid] = (int(parts[1]), int(parts[2]))
+        elif parts == [b"ready"] and pid in self._replacements:
+            old = self._replacements.pop(pid)
+            if old in self.workers:
+                self.workers[old].sendLine(b"stop")
+            # Forking here would return into the caller in the new worker.
+            self.reactor.callLater(0, self._replaceNext)
+
+
+    def _workerLost(self, pid):
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+        del self.workers[pid]
+        self._retiredAccepted += self.workerStats.pop(pid)[0]
+        if pid in self._replacements:
+            # Died before it was ready: keep the worker it was to replace.
+            old = self._replacements.pop(pid)
+            self._retiring.discard(old)
+            log.msg("Prefork worker %d exited before it was ready" % (pid,))
+            if old not in self.workers and not self.stopping:
+                self.reactor.callLater(self.restartDelay, self._spawn)
+            self.reactor.callLater(0, self._replaceNext)
+        elif pid in self._retiring:
+            self._retiring.remove(pid)
+        elif not self.stopping:
+            log.msg("Prefork worker %d exited, restarting it" % (pid,))
+            self.reactor.callLater(self.restartDelay, self._spawn)
+        if self.stopping and not self.workers:
+            waiters, self._stopWaiters = self._stopWaiters, []
+            for d in waiters:
+                d.callback(None)
+
+
+    def restartWorkers(self):
+        """
+        Replace every worker with a new one, one at a time: each new worker
+        is listening before the worker it replaces is told to stop, so no
+        connection is refused.
+        """
+        for pid in self.workers:
+            if (pid not in self._restartQueue and
+                    pid not in self._replacements and
+                    pid not in self._retiring):
+                self._restartQueue.append(pid)
+        if not self._replacements:
+            self.reactor.callLater(0, self._replaceNext)
+
+
+    def _replaceNext(self):
+        """
+        Start replacing the next worker queued by L{restartWorkers}, unless a
+        replacement is already waiting for its new worker to be ready.
+        """
+        if self._replacements:
+            return
+        while self._restartQueue and not self.stopping:
+            pid = self._restartQueue.pop(0)
+            if pid in self.workers:
+                # Not replaced again should it exit before its replacement
+                # is ready.
+                self._retiring.add(pid)
+                self._spawn(pid)
+                return
+
+
+    def stats(self):
+        """
+        Aggregate the stats last reported by the workers.
+
+        @return: A C{dict} with the number of C{workers}, the number of
+            connections C{accepted} so far, including by workers which have
+            exited, and the number of C{active} connections, and, as
+            C{perWorker}, L{workerStats}.
+        """
+        return {
+            "workers": len(self.workers),
+            "accepted": self._retiredAccepted + sum(
+                accepted for accepted, active in self.workerStats.values()),
+            "active": sum(
+                active for accepted, active in self.workerStats.values()),
+            "perWorker": dict(self.workerStats)}
+
+
+    def stopListening(self):
+        """
+        Tell all workers to stop, and release the port.
+
+        @return: A L{Deferred} which fires once all workers have exited.
+        """
+        if not self.stopping:
+            self.stopping = True
+            try:
+                self.reactor.removeSystemEventTrigger(self._shutdownID)
+            except ValueError:
+                pass
+            self._socket.close()
+            for channel in self.workers.values():
+                channel.sendLine(b"stop")
+        if not self.workers:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._stopWaiters.append(d)
+        return d
+
+    loseConnection = stopListening
+
+
+    def getHost(self):
+        return self._addressType('TCP', self.interface, self.port)
+
+
+    def _forget(self):
+        """
+        Drop all resources in a freshly forked worker.
+        """
+        for channel in self.workers.values():
+            channel.socket.close()
+        self.workers = {}
+        self._socket.close()
+        try:
+            self.reactor.removeSystemEventTrigger(self._shutdownID)
+        except ValueError:
+            pass
+
+
+def install(edgeTriggered=False):
     """
     Install the epoll() reactor.
+
+    @param edgeTriggered: Whether to register descriptors which are only
+        being read from with C{EPOLLET}.
     """
-    p = EPollReactor()
+    p = EPollReactor(edgeTriggered=edgeTriggered)
     from twisted.internet.main import installReactor
     installReactor(p)
 
 
 __all__ = ["EPollReactor", "install"]
 
+
+
+
+#--- Benchmarks follow --------------------------------------------------------
+
+class _CountingPoller(object):
+    """
+    Wrap an C{epoll} object, counting the calls made through it, each of which
+    is one system call.
+
+    @ivar calls: A dictionary mapping method names to call counts.
+    """
+
+    def __init__(self, poller):
+        self._poller = poller
+        self.calls = {"poll": 0, "register": 0, "modify": 0, "unregister": 0}
+
+
+    def __getattr__(self, name):
+        method = getattr(self._poller, name)
+        if name not in self.calls:
+            return method
+        def counted(*args):
+            self.calls[name] += 1
+            return method(*args)
+        return counted
+
+
+
+class _BenchmarkReactor(EPollReactor):
+    """
+    An L{EPollReactor} which counts its C{epoll} and C{FIONREAD} system calls.
+    """
+
+    def __init__(self, *args, **kwargs):
+        EPollReactor.__init__(self, *args, **kwargs)
+        self._poller = _CountingPoller(self._poller)
+        self.ioctls = 0
+
+
+    def _readable(self, fd):
+        self.ioctls += 1
+        return EPollReactor._readable(self, fd)
+
+
+    def syscalls(self):
+        return sum(self._poller.calls.values()) + self.ioctls
+
+
+
+class _BenchmarkConnection(object):
+    """
+    One end of a socket pair, echoing what it reads back to the other end
+    the way a transport does: by starting to write, and stopping once its
+    buffer is empty.
+    """
+
+    def __init__(self, reactor, skt):
+        self.reactor = reactor
+        self.socket = skt
+        self.buffer = []
+
+
+    def fileno(self):
+        return self.socket.fileno()
+
+
+    def logPrefix(self):
+        return "benchmark"
+
+
+    def doRead(self):
+        try:
+            data = self.socket.recv(65536)
+        except socket.error as e:
+            if e.args[0] == errno.EAGAIN:
+                return
+            raise
+        if not data:
+            return CONNECTION_DONE
+        self.buffer.append(data)
+        self.reactor.addWriter(self)
+
+
+    def doWrite(self):
+        data = b"".join(self.buffer)
+        sent = self.socket.send(data)
+        if sent < len(data):
+            self.buffer = [data[sent:]]
+        else:
+            self.buffer = []
+            self.reactor.removeWriter(self)
+
+
+    def connectionLost(self, reason):
+        self.reactor.removeReader(self)
+        self.reactor.removeWriter(self)
+
+
+
+def benchmarkEPoll(connections=10000, active=0.1, rounds=200,
+                   chunkSize=4096, edgeTriggered=False):
+    """
+    Echo I{chunkSize} bytes over every I{active} fraction of I{connections}
+    socket pairs, a different slice every round, by calling C{doPoll}
+    directly.
+
+    @return: A tuple of the number of system calls made by the reactor per
+        second, the number of bytes echoed per second, and the elapsed time.
+    """
+    reactor = _BenchmarkReactor(edgeTriggered=edgeTriggered)
+    peers = []
+    sockets = []
+    for i in range(connections):
+        a, b = socket.socketpair()
+        a.setblocking(False)
+        b.setblocking(False)
+        reactor.addReader(_BenchmarkConnection(reactor, a))
+        peers.append(b)
+        sockets.extend((a, b))
+    reactor.doPoll(0)
+    reactor._poller.calls = dict.fromkeys(reactor._poller.calls, 0)
+
+    payload = b"x" * chunkSize
+    step = max(1, int(round(1 / active)))
+    echoed = 0
+    start = time.time()
+    for r in range(rounds):
+        waiting = {}
+        for s in peers[r % step::step]:
+            s.send(payload)
+            waiting[s] = chunkSize
+        while waiting:
+            reactor.doPoll(0)
+            for s, left in list(waiting.items()):
+                try:
+                    left -= len(s.recv(left))
+                except socket.error as e:
+                    if e.args[0] != errno.EAGAIN:
+                        raise
+                if left:
+                    waiting[s] = left
+                else:
+                    del waiting[s]
+                    echoed += chunkSize
+    elapsed = time.time() - start
+
+    syscalls = reactor.syscalls()
+    for s in sockets:
+        s.close()
+    reactor._poller.close()
+    return syscalls / elapsed, echoed / elapsed, elapsed
+
+
+
+def _raiseFileLimit(needed):
+    """
+    Try to raise the soft limit of open files to I{needed}.
+
+    @return: Whether the limit is high enough.
+    """
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        soft = needed
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    return soft >= needed
+
+
+
+if __name__ == '__main__':
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000, 50000]
+    for connections in counts:
+        if not _raiseFileLimit(2 * connections + 100):
+            print("%6d connections: skipped, not enough file descriptors" % (
+                connections,))
+            continue
+        for edgeTriggered in (False, True):
+            syscalls, throughput, elapsed = benchmarkEPoll(
+                connections, edgeTriggered=edgeTriggered)
+            print("%6d connections, %s: %8.0f syscalls/s, %6.1f MB/s "
+                  "(%.1fs)" % (
+                      connections, edgeTriggered and "edge " or "level",
+                      syscalls, throughput / 2 ** 20, elapsed))
@@ -10,13 +10,14 @@
 """
 
 # system imports
-import sys, operator, time
+import sys, os, operator, time, socket, threading
+from collections import deque
 
 # twisted imports
 from twisted.internet.protocol import ServerFactory, Protocol, ClientFactory
 from twisted.internet.interfaces import ITransport
 from twisted.internet import reactor, error
-from twisted.python import log
+from twisted.python import log, logfile
 from zope.interface import implements, providedBy, directlyProvides
 
 class ProtocolWrapper(Protocol):
@@ -114,23 +115,97 @@ class WrappingFactory(ClientFactory):
         del self.protocols[p]
 
 
+def _hostOf(addr):
+    """Return the host of an address, or of an old-style address tuple."""
+    try:
+        return addr.host
+    except AttributeError:
+        return addr[1]
+
+
+class TokenBucket(object):
+    """A token bucket, refilled continuously at a fixed rate.
+
+    Consuming more tokens than the bucket holds puts it in debt rather than
+    failing, and tells the caller how long to wait for the debt to be repaid.
+    A bucket can have a parent, which gets charged for everything charged to
+    the bucket, so buckets can be stacked (global -> peer -> connection).
+
+    @ivar rate: tokens added per second.
+    @ivar burst: the most tokens the bucket holds.
+    @ivar parent: a L{TokenBucket} charged along with this one, or C{None}.
+    @ivar tokens: the tokens currently in the bucket; negative when in debt.
+    """
+
+    def __init__(self, rate, burst=None, parent=None, seconds=time.time):
+        self.rate = float(rate)
+        if burst is None:
+            burst = rate
+        self.burst = float(burst)
+        self.parent = parent
+        self.seconds = seconds
+        self.tokens = self.burst
+        self.updated = seconds()
+
+    def consume(self, amount):
+        """Take tokens from this bucket and its ancestors.
+
+        @return: the number of seconds until none of the buckets is in debt
+            anymore, 0 if none is.
+        """
+        now = self.seconds()
+        wait = 0.0
+        bucket = self
+        while bucket is not None:
+            tokens = bucket.tokens + (now - bucket.updated) * bucket.rate
+            if tokens > bucket.burst:
+                tokens = bucket.burst
+            tokens -= amount
+            bucket.tokens = tokens
+            bucket.updated = now
+            if tokens < 0 and -tokens / bucket.rate > wait:
+                wait = -tokens / bucket.rate
+            bucket = bucket.parent
+        return wait
+
+
 class ThrottlingProtocol(ProtocolWrapper):
-    """Protocol for ThrottlingFactory."""
+    """Protocol for ThrottlingFactory.
+
+    Reads and writes are charged to the protocol's buckets. When a bucket
+    goes into debt only this connection is paused, until the debt is
+    repaid.
+
+    @ivar readBucket: the L{TokenBucket} reads are charged to, or C{None}.
+    @ivar writeBucket: the L{TokenBucket} writes are charged to, or C{None}.
+    """
+
+    readBucket = None
+    writeBucket = None
+    _readResume = None
+    _writeResume = None
 
     # wrap API for tracking bandwidth
 
     def write(self, data):
-        self.factory.registerWritten(len(data))
+        self.registerWritten(len(data))
         ProtocolWrapper.write(self, data)
 
     def writeSequence(self, seq):
-        self.factory.registerWritten(reduce(operator.add, map(len, seq)))
+        self.registerWritten(reduce(operator.add, map(len, seq), 0))
         ProtocolWrapper.writeSequence(self, seq)
 
     def dataReceived(self, data):
-        self.factory.registerRead(len(data))
+        self.registerRead(len(data))
         ProtocolWrapper.dataReceived(self, data)
 
+    def connectionLost(self, reason):
+        for call in self._readResume, self._writeResume:
+            if call is not None and call.active():
+                call.cancel()
+        self._readResume = self._writeResume = None
+        ProtocolWrapper.connectionLost(self, reason)
+
     def registerProducer(self, producer, streaming):
         self.producer = producer
         ProtocolWrapper.registerProducer(self, producer, streaming)
@@ -141,6 +216,42 @@ class ThrottlingProtocol(ProtocolWrapper):
         except AttributeError: pass
         ProtocolWrapper.unregisterProducer(self)
 
+    def registerRead(self, length):
+        """Charge bytes read, pausing reads if a bucket went into debt."""
+        if self.readBucket is not None:
+            wait = self.readBucket.consume(length)
+            if wait:
+                self._readResume = self._pauseFor(
+                    wait, self._readResume, self.throttleReads,
+                    self._resumeReads)
+
+    def registerWritten(self, length):
+        """Charge bytes written, pausing the producer if a bucket went into
+        debt."""
+        if self.writeBucket is not None:
+            wait = self.writeBucket.consume(length)
+            if wait:
+                self._writeResume = self._pauseFor(
+                    wait, self._writeResume, self.throttleWrites,
+                    self._resumeWrites)
+
+    def _pauseFor(self, wait, call, throttle, resume):
+        if call is None:
+            throttle()
+            return self.factory.callLater(wait, resume)
+        # more was charged while paused, push the resumption back
+        if call.getTime() < self.factory.seconds() + wait:
+            call.reset(wait)
+        return call
+
+    def _resumeReads(self):
+        self._readResume = None
+        self.unthrottleReads()
+
+    def _resumeWrites(self):
+        self._writeResume = None
+        self.unthrottleWrites()
+
     def throttleReads(self):
         self.transport.pauseProducing()
 
@@ -157,70 +268,66 @@ class ThrottlingProtocol(ProtocolWrapper):
             self.producer.resumeProducing()
         except AttributeError: pass
 
-READ,WRITE = range(2)
-class ThrottlingPipe(object):
-    """Throttles data in one direction or another, by waiting as long as to keep the rate at a certain level. Call check with every read."""
-    def __init__(self,direction,limit,throttle,unthrottle):
-        """direction = right or left, limit = how many bytes per second, throttle = something that throttles the byte processing operation, unthrottle = vice versa"""
-        self.throttle = throttle
-        self.unthrottle = unthrottle
-        self.direction = direction
-        self.limit = limit
-        self.startTime = time.time()
-        self.lastDuration = 0
-        self.rate = 0.0
-    def check(self,length):
-        if self.limit is None: return
-        now = time.time()
-        duration = now - self.startTime
-        soFar = self.rate * self.lastDuration + length
-        self.rate = soFar / duration
-#        print soFar,duration
-#        print "Rate vs limit: ",self.rate,self.limit
-        if self.rate > self.limit:
-            self.throttle()
-            wait = round(soFar / self.limit - duration,2)
-            self.unthrottleLater(wait)
-        self.lastDuration = duration
-    unthrottleID = None
-    def unthrottleLater(self,wait):
-        if self.unthrottleID:
-            if self.unthrottleID.called: return # XXX: should never happen?
-            self.unthrottleID.cancel()
-#        print "\nWaiting boo",wait
-        self.unthrottleID = reactor.callLater(wait,self.clearAndUnthrottle)
-    def clearAndUnthrottle(self):
-        del self.unthrottleID
-        self.unthrottle()
-    def cancel(self):
-        if self.unthrottleID:
-            if not self.unthrottleID.called:
-                self.unthrottleID.cancel()
-            del self.unthrottleID
 
 class ThrottlingFactory(WrappingFactory):
     """Throttles bandwidth and number of connections.
 
+    Bandwidth is limited by token buckets, refilled continuously: one for
+    the whole factory, one per peer host and one per connection, for reads
+    and for writes, each of which is only used if its limit is given. A
+    connection whose bytes put any of its buckets in debt is paused until
+    the debt is repaid; other connections keep going until they run into
+    debt themselves, so connections are not all stopped and started at
+    once.
+
     Write bandwidth will only be throttled if there is a producer
     registered.
+
+    @cvar burstPeriod: how many seconds worth of its rate a bucket can
+        save up for bursts.
     """
 
     protocol = ThrottlingProtocol
+    burstPeriod = 0.25
+    seconds = time.time
 
-    def __init__(self, wrappedFactory, maxConnectionCount=sys.maxint, readLimit=None, writeLimit=None):
+    def __init__(self, wrappedFactory, maxConnectionCount=sys.maxint,
+                 readLimit=None, writeLimit=None,
+                 peerReadLimit=None, peerWriteLimit=None,
+                 connectionReadLimit=None, connectionWriteLimit=None):
+        """
+        @param readLimit: bytes per second read over all connections.
+        @param writeLimit: bytes per second written over all connections.
+        @param peerReadLimit: bytes per second read from each peer host.
+        @param peerWriteLimit: bytes per second written to each peer host.
+        @param connectionReadLimit: bytes per second read on each connection.
+        @param connectionWriteLimit: bytes per second written on each
+            connection.
+
+        All limits default to C{None}, meaning unlimited.
+        """
         WrappingFactory.__init__(self, wrappedFactory)
         self.connectionCount = 0
         self.maxConnectionCount = maxConnectionCount
-        self.reader = ThrottlingPipe(READ,readLimit,self.throttleReads,self.unthrottleReads)
-        self.writer = ThrottlingPipe(WRITE,writeLimit,self.throttleWrites,self.unthrottleWrites)
+        self.readLimit = readLimit
+        self.writeLimit = writeLimit
+        self.peerReadLimit = peerReadLimit
+        self.peerWriteLimit = peerWriteLimit
+        self.connectionReadLimit = connectionReadLimit
+        self.connectionWriteLimit = connectionWriteLimit
+        self.readBucket = self._bucket(readLimit, None)
+        self.writeBucket = self._bucket(writeLimit, None)
+        # peer host -> [read bucket, write bucket, connection count]
+        self.peers = {}
 
-    def registerWritten(self, length):
-        """Called by protocol to tell us more bytes were written."""
-        self.writer.check(length)
+    def callLater(self, period, func):
+        return reactor.callLater(period, func)
 
-    def registerRead(self, length):
-        """Called by protocol to tell us more bytes were read."""
-        self.reader.check(length)
+    def _bucket(self, limit, parent):
+        if limit is None:
+            return parent
+        return TokenBucket(limit, limit * self.burstPeriod, parent,
+                           self.seconds)
 
     def throttleReads(self):
         """Throttle reads on all protocols."""
@@ -247,19 +354,30 @@ class ThrottlingFactory(WrappingFactory):
             p.unthrottleWrites()
 
     def buildProtocol(self, addr):
-        if self.connectionCount < self.maxConnectionCount:
-            self.connectionCount += 1
-            return WrappingFactory.buildProtocol(self, addr)
-        else:
+        if self.connectionCount >= self.maxConnectionCount:
             log.msg("Max connection count reached!")
             return None
+        self.connectionCount += 1
+        p = WrappingFactory.buildProtocol(self, addr)
+        p.peerHost = host = _hostOf(addr)
+        peer = self.peers.get(host)
+        if peer is None:
+            peer = self.peers[host] = [
+                self._bucket(self.peerReadLimit, self.readBucket),
+                self._bucket(self.peerWriteLimit, self.writeBucket), 0]
+        peer[2] += 1
+        p.readBucket = self._bucket(self.connectionReadLimit, peer[0])
+        p.writeBucket = self._bucket(self.connectionWriteLimit, peer[1])
+        return p
 
     def unregisterProtocol(self, p):
         WrappingFactory.unregisterProtocol(self, p)
         self.connectionCount -= 1
-        if self.connectionCount == 0:
-            self.reader.cancel()
-            self.writer.cancel()
+        peer = self.peers.get(p.peerHost)
+        if peer is not None:
+            peer[2] -= 1
+            if not peer[2]:
+                del self.peers[p.peerHost]
 
 class SpewingProtocol(ProtocolWrapper):
     def dataReceived(self, data):
@@ -274,27 +392,150 @@ class SpewingFactory(WrappingFactory):
     protocol = SpewingProtocol
 
 
+def networkPrefix(host, ipv4Bits=24, ipv6Bits=64):
+    """Return a key for the network of I{host}.
+
+    The key is made of the first I{ipv4Bits} or I{ipv6Bits} bits of the
+    address; IPv4-mapped IPv6 addresses count as IPv4. Hosts that are not
+    IP addresses are their own key.
+    """
+    try:
+        if ':' in host:
+            packed = socket.inet_pton(socket.AF_INET6, host)
+        else:
+            packed = socket.inet_aton(host)
+    except (socket.error, ValueError, TypeError):
+        return host
+    if len(packed) == 16 and packed[:12] == '\0' * 10 + '\xff\xff':
+        packed = packed[12:]
+    if len(packed) == 4:
+        bits, family = ipv4Bits, '4'
+    else:
+        bits, family = ipv6Bits, '6'
+    n, rest = divmod(bits, 8)
+    prefix = packed[:n]
+    if rest:
+        prefix += chr(ord(packed[n]) & (0xff << (8 - rest)) & 0xff)
+    return family + prefix
+
+
 class LimitConnectionsByPeer(WrappingFactory):
-    """Stability: Unstable"""
+    """Limits connections per peer network, and optionally their rate.
+
+    Peers are grouped by network prefix, /24 for IPv4 and /64 for IPv6 by
+    default; set the prefix lengths to 32 and 128 to limit single hosts.
+    Connections are refused before the wrapped protocol is built, by
+    returning C{None} from L{buildProtocol}.
+
+    Bookkeeping is a dictionary entry per network, holding its connection
+    count and accept token bucket. An entry without connections is dropped
+    once its bucket has filled up again, from a queue that is checked on
+    every new connection, so there are no timers. Each network is queued at
+    most once, however many of its connections are refused.
+
+    Stability: Unstable
+
+    @cvar maxConnectionsPerPeer: connections allowed per network at once.
+    @cvar maxAcceptRate: connections accepted per second per network, or
+        C{None} for no limit.
+    @cvar acceptBurst: connections that can be accepted from a network at
+        once, with a rate limit. Defaults to one second's worth.
+    @ivar rejectedByLimit: connections refused because of
+        I{maxConnectionsPerPeer}.
+    @ivar rejectedByRate: connections refused because of I{maxAcceptRate}.
+    """
 
     maxConnectionsPerPeer = 5
+    ipv4PrefixLength = 24
+    ipv6PrefixLength = 64
+    maxAcceptRate = None
+    acceptBurst = None
+    seconds = time.time
+
+    rejectedByLimit = 0
+    rejectedByRate = 0
 
     def startFactory(self):
+        # network -> [connections, accept tokens, last update, expiry],
+        # expiry being None unless the network is in the idle queue
         self.peerConnections = {}
+        self._idle = deque()
+
+    def prefixOf(self, host):
+        return networkPrefix(host, self.ipv4PrefixLength,
+                             self.ipv6PrefixLength)
+
+    def _burst(self):
+        if self.acceptBurst is not None:
+            return self.acceptBurst
+        return max(self.maxAcceptRate, 1)
 
     def buildProtocol(self, addr):
-        peerHost = addr[0]
-        connectionCount = self.peerConnections.get(peerHost, 0)
-        if connectionCount >= self.maxConnectionsPerPeer:
-            return None
-        self.peerConnections[peerHost] = connectionCount + 1
-        return WrappingFactory.buildProtocol(self, addr)
+        now = self.seconds()
+        self._expire(now)
+        prefix = self.prefixOf(_hostOf(addr))
+        entry = self.peerConnections.get(prefix)
+        if entry is None:
+            entry = [0, 0.0, now, None]
+            if self.maxAcceptRate is not None:
+                entry[1] = float(self._burst())
+            self.peerConnections[prefix] = entry
+
+        if entry[0] >= self.maxConnectionsPerPeer:
+            self.rejectedByLimit += 1
+            return self._refused(prefix, entry, now)
+        if self.maxAcceptRate is not None:
+            tokens = min(entry[1] + (now - entry[2]) * self.maxAcceptRate,
+                         self._burst())
+            entry[2] = now
+            if tokens < 1:
+                entry[1] = tokens
+                self.rejectedByRate += 1
+                return self._refused(prefix, entry, now)
+            entry[1] = tokens - 1
+
+        entry[0] += 1
+        p = WrappingFactory.buildProtocol(self, addr)
+        p.peerPrefix = prefix
+        return p
+
+    def _refused(self, prefix, entry, now):
+        if not entry[0]:
+            self._idled(prefix, entry, now)
+        return None
 
     def unregisterProtocol(self, p):
-        peerHost = p.getPeer()[1]
-        self.peerConnections[peerHost] -= 1
-        if self.peerConnections[peerHost] == 0:
-            del self.peerConnections[peerHost]
+        WrappingFactory.unregisterProtocol(self, p)
+        entry = self.peerConnections[p.peerPrefix]
+        entry[0] -= 1
+        if not entry[0]:
+            self._idled(p.peerPrefix, entry, self.seconds())
+
+    def _idled(self, prefix, entry, now):
+        if self.maxAcceptRate is None:
+            del self.peerConnections[prefix]
+            return
+        # keep the entry until its bucket is full, or the rate limit could
+        # be dodged by reconnecting
+        tokens = entry[1] + (now - entry[2]) * self.maxAcceptRate
+        expiry = now + max(self._burst() - tokens, 0) / self.maxAcceptRate
+        if entry[3] is None:
+            self._idle.append((expiry, prefix))
+        entry[3] = expiry
+
+    def _expire(self, now):
+        idle = self._idle
+        while idle and idle[0][0] <= now:
+            expiry, prefix = idle.popleft()
+            entry = self.peerConnections[prefix]
+            if entry[0]:
+                # got connections since, queued again when they are gone
+                entry[3] = None
+            elif entry[3] > now:
+                # idled again since, with a later expiry
+                idle.append((entry[3], prefix))
+            else:
+                del self.peerConnections[prefix]
 
 
 class LimitTotalConnectionsFactory(ServerFactory):
@@ -339,24 +580,192 @@ class LimitTotalConnectionsFactory(ServerFactory):
         self.connectionCount -= 1
 
 
+class _WheelTimer(object):
+    """A timeout scheduled on a L{TimerWheel}.
+
+    Provides the parts of the L{twisted.internet.base.DelayedCall} interface
+    that timeouts use.
+    """
+
+    __slots__ = ('wheel', 'func', 'deadline', 'index', 'called', 'cancelled')
+
+    def __init__(self, wheel, deadline, func):
+        self.wheel = wheel
+        self.func = func
+        self.deadline = deadline
+        self.index = None
+        self.called = self.cancelled = False
+
+    def getTime(self):
+        return self.deadline
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def reset(self, secondsFromNow):
+        """Reschedule the timeout; normally only records the new deadline."""
+        if self.cancelled:
+            raise error.AlreadyCancelled
+        if self.called:
+            raise error.AlreadyCalled
+        wheel = self.wheel
+        self.deadline = wheel.seconds() + secondsFromNow
+        if self.index is None:
+            # taken out of its slot to expire, the wheel checks it again
+            return
+        if self.deadline < self.index * wheel.resolution:
+            # earlier than the slot it is in, which is rare
+            wheel._remove(self)
+            wheel._insert(self)
+
+    def cancel(self):
+        if self.cancelled:
+            raise error.AlreadyCancelled
+        if self.called:
+            raise error.AlreadyCalled
+        self.cancelled = True
+        self.wheel._remove(self)
+
+
+class TimerWheel(object):
+    """A hashed timer wheel, for many coarse timeouts that are reset often.
+
+    Timeouts are kept in slots of I{resolution} seconds, on a wheel of
+    I{size} slots, and a single reactor timed call steps through the slots,
+    expiring all the due timeouts of a slot in one go. Resetting a timeout
+    only records its new deadline; when the slot it sits in comes up, it is
+    moved to the slot of its deadline. A timeout expires within
+    I{resolution} seconds after its deadline.
+
+    @ivar resolution: seconds per slot.
+    """
+
+    def __init__(self, resolution=1.0, size=512, seconds=time.time,
+                 callLater=None):
+        self.resolution = float(resolution)
+        self.seconds = seconds
+        if callLater is None:
+            callLater = reactor.callLater
+        self._callLater = callLater
+        self._slots = [{} for _ in xrange(size)]
+        # the index of the next slot to expire, counted from the epoch
+        self._position = int(seconds() / self.resolution)
+        self._count = 0
+        self._tickCall = None
+
+    def __len__(self):
+        return self._count
+
+    def callLater(self, period, func):
+        """Call I{func} in about I{period} seconds.
+
+        @return: an object with C{reset}, C{cancel}, C{active} and
+            C{getTime} methods, like a L{twisted.internet.base.DelayedCall}.
+        """
+        timer = _WheelTimer(self, self.seconds() + period, func)
+        self._insert(timer)
+        return timer
+
+    def _insert(self, timer):
+        if not self._count:
+            # the wheel was idle, skip the slots that passed meanwhile
+            self._position = max(self._position,
+                                 int(self.seconds() / self.resolution))
+        index = max(int(timer.deadline / self.resolution), self._position)
+        timer.index = index
+        self._slots[index % len(self._slots)][timer] = None
+        self._count += 1
+        if self._tickCall is None:
+            self._schedule()
+
+    def _remove(self, timer):
+        if timer.index is None:
+            # already taken out of its slot by _tick
+            return
+        del self._slots[timer.index % len(self._slots)][timer]
+        timer.index = None
+        self._count -= 1
+        if not self._count and self._tickCall is not None:
+            self._tickCall.cancel()
+            self._tickCall = None
+
+    def _schedule(self):
+        # slot n is expired once its time span is over
+        delay = (self._position + 1) * self.resolution - self.seconds()
+        self._tickCall = self._callLater(max(delay, 0), self._tick)
+
+    def _tick(self):
+        self._tickCall = None
+        now = self.seconds()
+        end = int(now / self.resolution)
+        size = len(self._slots)
+        # after a stall, one turn of the wheel visits every timeout
+        position = max(self._position, end - size)
+        due = []
+        while position < end:
+            slot = self._slots[position % size]
+            for timer in slot.keys():
+                if timer.deadline <= now:
+                    del slot[timer]
+                    timer.index = None
+                    due.append(timer)
+                else:
+                    index = timer.index = int(timer.deadline / self.resolution)
+                    if index % size != position % size:
+                        del slot[timer]
+                        self._slots[index % size][timer] = None
+            position += 1
+        self._position = position
+        self._count -= len(due)
+        due.sort(key=operator.attrgetter('deadline'))
+        for timer in due:
+            # an earlier callback may have cancelled or reset this one
+            if timer.cancelled:
+                continue
+            if timer.deadline > now:
+                self._insert(timer)
+                continue
+            timer.called = True
+            try:
+                timer.func()
+            except:
+                log.err()
+        if self._count and self._tickCall is None:
+            self._schedule()
+
+
 class TimeoutProtocol(ProtocolWrapper):
     """Protocol that automatically disconnects when the connection is idle.
 
     Stability: Unstable
+
+    @ivar timerWheel: a L{TimerWheel} to schedule the timeout on, or C{None}
+        to use the reactor.
     """
 
-    def __init__(self, factory, wrappedProtocol, timeoutPeriod):
+    timerWheel = None
+
+    def __init__(self, factory, wrappedProtocol, timeoutPeriod,
+                 timerWheel=None):
         """Constructor.
 
         @param factory: An L{IFactory}.
         @param wrappedProtocol: A L{Protocol} to wrapp.
         @param timeoutPeriod: Number of seconds to wait for activity before
             timing out.
+        @param timerWheel: A L{TimerWheel} to schedule the timeout on.
         """
         ProtocolWrapper.__init__(self, factory, wrappedProtocol)
+        if timerWheel is not None:
+            self.timerWheel = timerWheel
         self.timeoutCall = None
         self.setTimeout(timeoutPeriod)
 
+    def callLater(self, period, func):
+        if self.timerWheel is not None:
+            return self.timerWheel.callLater(period, func)
+        return reactor.callLater(period, func)
+
     def setTimeout(self, timeoutPeriod=None):
         """Set a timeout.
 
@@ -368,7 +777,7 @@ class TimeoutProtocol(ProtocolWrapper):
         self.cancelTimeout()
         if timeoutPeriod is not None:
             self.timeoutPeriod = timeoutPeriod
-        self.timeoutCall = reactor.callLater(self.timeoutPeriod, self.timeoutFunc)
+        self.timeoutCall = self.callLater(self.timeoutPeriod, self.timeoutFunc)
 
     def cancelTimeout(self):
         """Cancel the timeout.
@@ -416,16 +825,24 @@ class TimeoutFactory(WrappingFactory):
     """Factory for TimeoutWrapper.
 
     Stability: Unstable
+
+    Pass a shared L{TimerWheel} as I{timerWheel} when there are many
+    connections, to keep their timeouts off the reactor's timed calls.
     """
     protocol = TimeoutProtocol
 
-    def __init__(self, wrappedFactory, timeoutPeriod=30*60):
+    def __init__(self, wrappedFactory, timeoutPeriod=30*60, timerWheel=None):
         self.timeoutPeriod = timeoutPeriod
+        self.timerWheel = timerWheel
         WrappingFactory.__init__(self, wrappedFactory)
 
     def buildProtocol(self, addr):
+        if self.timerWheel is None:
+            return self.protocol(self, self.wrappedFactory.buildProtocol(addr),
+                                 timeoutPeriod=self.timeoutPeriod)
         return self.protocol(self, self.wrappedFactory.buildProtocol(addr),
-                             timeoutPeriod=self.timeoutPeriod)
+                             timeoutPeriod=self.timeoutPeriod,
+                             timerWheel=self.timerWheel)
 
 
 class TrafficLoggingProtocol(ProtocolWrapper):
@@ -449,7 +866,7 @@ class TrafficLoggingProtocol(ProtocolWrapper):
 
     # IProtocol
     def connectionMade(self):
-        self._log('*')
+        self._log('* %d' % (self._number,))
         return ProtocolWrapper.connectionMade(self)
 
     def dataReceived(self, data):
@@ -475,36 +892,159 @@ class TrafficLoggingProtocol(ProtocolWrapper):
         return ProtocolWrapper.loseConnection(self)
 
 
+class TrafficLogWriter(object):
+    """A file-like object that buffers lines in memory and writes them to a
+    rotating log file from a background thread.
+
+    Writing only appends to a bounded buffer, so it never blocks on disk;
+    when the buffer is full, lines are dropped and counted. The thread
+    writes everything buffered in one go every I{flushInterval} seconds, or
+    sooner when the buffer is half full. It is started by the first write
+    and stopped, after writing out the buffer, when the reactor shuts down.
+    One writer can be shared by any number of connections.
+
+    @ivar bufferSize: the most writes held in the buffer.
+    @ivar dropped: writes dropped because the buffer was full.
+    @ivar written: writes written to the file.
+    """
+
+    def __init__(self, path, rotateLength=1000000, bufferSize=10000,
+                 flushInterval=0.5):
+        self.path = path
+        self.rotateLength = rotateLength
+        self.bufferSize = bufferSize
+        self.flushInterval = flushInterval
+        self.dropped = 0
+        self.written = 0
+        # appending and popping on the ends of a deque are thread safe
+        self._buffer = deque()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopping = False
+        self._triggerID = None
+
+    def openFile(self):
+        directory, name = os.path.split(os.path.abspath(self.path))
+        return logfile.LogFile(name, directory, self.rotateLength)
+
+    def write(self, data):
+        buffer = self._buffer
+        if len(buffer) >= self.bufferSize:
+            self.dropped += 1
+            return
+        buffer.append(data)
+        if self._thread is None:
+            self.start()
+        elif len(buffer) == self.bufferSize // 2:
+            self._wakeup.set()
+
+    def flush(self):
+        """Does nothing, the buffer is flushed by the writer thread."""
+
+    def start(self):
+        """Start the writer thread."""
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="TrafficLogWriter")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self._triggerID = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self._shutdown)
+
+    def _shutdown(self):
+        # the trigger is spent once it fires
+        self._triggerID = None
+        self.stop()
+
+    def stop(self):
+        """Write out the buffer and stop the writer thread."""
+        if self._triggerID is not None:
+            reactor.removeSystemEventTrigger(self._triggerID)
+            self._triggerID = None
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        f = self.openFile()
+        try:
+            while not self._stopping:
+                self._wakeup.wait(self.flushInterval)
+                self._wakeup.clear()
+                self._drain(f)
+            self._drain(f)
+        finally:
+            f.close()
+
+    def _drain(self, f):
+        buffer = self._buffer
+        lines = []
+        try:
+            while True:
+                lines.append(buffer.popleft())
+        except IndexError:
+            pass
+        if lines:
+            try:
+                f.write(''.join(lines))
+                f.flush()
+            except:
+                log.err(None, "TrafficLogWriter failed to write %d lines"
+                        % (len(lines),))
+            else:
+                self.written += len(lines)
+
+
 class TrafficLoggingFactory(WrappingFactory):
+    """Logs the traffic of every connection.
+
+    By default each connection gets its own file, named after
+    I{logfilePrefix}, written synchronously. Pass a L{TrafficLogWriter} as
+    I{writer} to log all connections to it instead, off the reactor thread.
+    """
     protocol = TrafficLoggingProtocol
 
     _counter = 0
 
-    def __init__(self, wrappedFactory, logfilePrefix, lengthLimit=None):
+    def __init__(self, wrappedFactory, logfilePrefix, lengthLimit=None,
+                 writer=None):
         self.logfilePrefix = logfilePrefix
         self.lengthLimit = lengthLimit
+        self.writer = writer
         WrappingFactory.__init__(self, wrappedFactory)
 
     def open(self, name):
         return file(name, 'w')
 
     def buildProtocol(self, addr):
-        self._counter += 1
-        logfile = self.open(self.logfilePrefix + '-' + str(self._counter))
+        if self.writer is not None:
+            f = self.writer
+        else:
+            self._counter += 1
+            f = self.open(self.logfilePrefix + '-' + str(self._counter))
         return self.protocol(self, self.wrappedFactory.buildProtocol(addr),
-                             logfile, self.lengthLimit)
+                             f, self.lengthLimit)
 
 
 class TimeoutMixin:
     """Mixin for protocols which wish to timeout connections
 
     @cvar timeOut: The number of seconds after which to timeout the connection.
+    @cvar timerWheel: A L{TimerWheel} to schedule the timeout on, or C{None}
+        to use the reactor. Share one between many connections that reset
+        their timeouts often.
     """
     timeOut = None
+    timerWheel = None
 
     __timeoutCall = None
 
     def callLater(self, period, func):
+        if self.timerWheel is not None:
+            return self.timerWheel.callLater(period, func)
         return reactor.callLater(period, func)
 
 
@@ -543,3 +1083,117 @@ class TimeoutMixin:
         Override to define behavior other than dropping the connection.
         """
         self.transport.loseConnection()
+
+
+#--- Benchmarks follow --------------------------------------------------------
+
+class _BenchmarkTransport:
+    """A transport that only records whether it is paused."""
+
+    paused = False
+
+    def __init__(self, host):
+        self.host = host
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def getPeer(self):
+        from twisted.internet.address import IPv4Address
+        return IPv4Address('TCP', self.host, 1234)
+
+
+def benchmarkThrottling(connections=100, peers=10, rate=1000000.0,
+                        duration=5.0, chunkSize=4096, tick=0.001,
+                        window=0.1):
+    """Run a simulated, saturated L{ThrottlingFactory} on a fake clock.
+
+    Every tick, each of I{connections} connections from I{peers} hosts that
+    is not paused reads I{chunkSize} bytes, against a global read limit of
+    I{rate} and a per-peer limit of twice the fair share.
+
+    @return: a tuple of the achieved throughput as a fraction of I{rate},
+        the jitter (standard deviation of the throughput over I{window}
+        second windows, as a fraction of its mean) and the time taken, in
+        seconds.
+    """
+    from twisted.internet import task
+    clock = task.Clock()
+    wrapped = ServerFactory()
+    wrapped.protocol = Protocol
+    class SimulatedThrottlingFactory(ThrottlingFactory):
+        callLater = clock.callLater
+        seconds = clock.seconds
+    factory = SimulatedThrottlingFactory(wrapped, readLimit=rate,
+                                         peerReadLimit=2 * rate / peers)
+
+    transports = []
+    for i in xrange(connections):
+        t = _BenchmarkTransport('10.0.0.%d' % (i % peers))
+        p = factory.buildProtocol(t.getPeer())
+        p.makeConnection(t)
+        transports.append((t, p))
+
+    data = 'x' * chunkSize
+    ticksPerWindow = int(round(window / tick))
+    windows = []
+    received = 0
+    t0 = time.time()
+    for n in xrange(int(round(duration / tick))):
+        for t, p in transports:
+            if not t.paused:
+                p.dataReceived(data)
+                received += chunkSize
+        clock.advance(tick)
+        if (n + 1) % ticksPerWindow == 0:
+            windows.append(received / window)
+            received = 0
+    elapsed = time.time() - t0
+
+    # skip the first window, which includes the initial burst
+    windows = windows[1:]
+    mean = sum(windows) / len(windows)
+    deviation = (sum([(w - mean) ** 2 for w in windows]) / len(windows)) ** 0.5
+    return mean / rate, deviation / mean, elapsed
+
+
+def benchmarkTimeouts(connections=100000, events=200000, timerWheel=None):
+    """Time data events on I{connections} idle L{TimeoutProtocol}s.
+
+    The timeouts are scheduled on the reactor, or on I{timerWheel} if
+    given. The reactor is not run.
+
+    @return: a tuple of the cost of setting up a connection and of a data
+        event on a random connection, in microseconds.
+    """
+    import random
+    wrapped = ServerFactory()
+    wrapped.protocol = Protocol
+    factory = TimeoutFactory(wrapped, timerWheel=timerWheel)
+    t0 = time.time()
+    protocols = [factory.buildProtocol(None) for _ in xrange(connections)]
+    t1 = time.time()
+    order = [random.choice(protocols) for _ in xrange(events)]
+    t2 = time.time()
+    for p in order:
+        p.dataReceived('')
+    t3 = time.time()
+    for p in protocols:
+        p.cancelTimeout()
+    return 1e6 * (t1 - t0) / connections, 1e6 * (t3 - t2) / events
+
+
+if __name__ == '__main__':
+    for connections in (10, 100, 1000):
+        achieved, jitter, elapsed = benchmarkThrottling(connections)
+        print "%5d connections: %6.1f%% of rate, jitter %5.1f%% (%.1fs)" % (
+            connections, 100 * achieved, 100 * jitter, elapsed)
+
+    for connections in (1000, 10000, 100000):
+        for name, wheel in (("reactor", None), ("wheel", TimerWheel())):
+            setup, event = benchmarkTimeouts(connections, timerWheel=wheel)
+            print "%6d connections, %-7s: setup %5.2f us, event %5.2f us" % (
+                connections, name, setup, event)
@@ -0,0 +1,441 @@
+"""
+Tests for L{twisted.protocols.policies}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor, task, error, protocol, address
+from twisted.protocols import policies
+from twisted.test import proto_helpers
+
+
+class TimerWheelTestCase(unittest.TestCase):
+    """
+    Tests for L{policies.TimerWheel}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = policies.TimerWheel(
+            1.0, size=8, seconds=self.clock.seconds,
+            callLater=self.clock.callLater)
+
+
+    def test_expires(self):
+        """
+        A timeout fires within one slot after its deadline, and the wheel
+        stops its timed call once it holds no timeouts.
+        """
+        fired = []
+        self.wheel.callLater(2.5, lambda: fired.append(self.clock.seconds()))
+        self.clock.pump([0.5] * 10)
+        self.assertEquals(fired, [3.0])
+        self.assertEquals(len(self.wheel), 0)
+        self.failIf(self.clock.calls)
+
+
+    def test_reset(self):
+        """
+        Resetting a timeout postpones it to the new deadline.
+        """
+        fired = []
+        timer = self.wheel.callLater(2, lambda: fired.append(True))
+        self.clock.advance(1.5)
+        timer.reset(2)
+        self.clock.advance(1.5)
+        self.assertEquals(fired, [])
+        self.clock.advance(1)
+        self.assertEquals(fired, [True])
+
+
+    def test_cancelDueInSameTick(self):
+        """
+        A timeout cancelled by the callback of another one due in the same
+        tick doesn't fire, and the wheel keeps its count right.
+        """
+        fired = []
+        timers = []
+
+        def first():
+            fired.append('first')
+            timers[1].cancel()
+
+        timers.append(self.wheel.callLater(1.2, first))
+        timers.append(self.wheel.callLater(1.4, lambda: fired.append('second')))
+        self.clock.advance(2)
+        self.assertEquals(fired, ['first'])
+        self.failIf(timers[1].active())
+        self.assertEquals(len(self.wheel), 0)
+        self.failIf(self.clock.calls)
+        self.assertRaises(error.AlreadyCancelled, timers[1].cancel)
+
+
+    def test_resetDueInSameTick(self):
+        """
+        A timeout reset by the callback of another one due in the same tick
+        fires at its new deadline instead.
+        """
+        fired = []
+        timers = []
+
+        def first():
+            fired.append('first')
+            timers[1].reset(3)
+
+        timers.append(self.wheel.callLater(1.2, first))
+        timers.append(self.wheel.callLater(
+            1.4, lambda: fired.append(self.clock.seconds())))
+        self.clock.advance(2)
+        self.assertEquals(fired, ['first'])
+        self.assertEquals(len(self.wheel), 1)
+        self.clock.pump([1] * 4)
+        self.assertEquals(fired, ['first', 6])
+        self.assertEquals(len(self.wheel), 0)
+
+
+
+class LimitConnectionsByPeerTestCase(unittest.TestCase):
+    """
+    Tests for L{policies.LimitConnectionsByPeer}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        wrapped = protocol.ServerFactory()
+        wrapped.protocol = protocol.Protocol
+        self.factory = policies.LimitConnectionsByPeer(wrapped)
+        self.factory.seconds = self.clock.seconds
+        self.factory.maxConnectionsPerPeer = 2
+        self.factory.doStart()
+
+
+    def connect(self, host):
+        """
+        Build a protocol for a connection from I{host} and connect it, if
+        the factory doesn't refuse it.
+        """
+        p = self.factory.buildProtocol(address.IPv4Address('TCP', host, 1234))
+        if p is not None:
+            p.makeConnection(proto_helpers.StringTransport())
+        return p
+
+
+    def test_networkPrefix(self):
+        """
+        Hosts are grouped by their /24 or /64 network, IPv4-mapped IPv6
+        addresses count as IPv4, and other hosts are their own group.
+        """
+        prefix = policies.networkPrefix
+        self.assertEquals(prefix('10.0.0.1'), prefix('10.0.0.200'))
+        self.assertNotEquals(prefix('10.0.0.1'), prefix('10.0.1.1'))
+        self.assertEquals(prefix('::ffff:10.0.0.1'), prefix('10.0.0.9'))
+        self.assertEquals(prefix('2001:db8::1'), prefix('2001:db8::2'))
+        self.assertNotEquals(prefix('2001:db8::1'), prefix('2001:db8:0:1::1'))
+        self.assertNotEquals(prefix('10.0.0.1', 32), prefix('10.0.0.2', 32))
+        self.assertEquals(prefix('10.0.0.1', 20), prefix('10.0.15.1', 20))
+        self.assertEquals(prefix('localhost'), 'localhost')
+
+
+    def test_perPrefixLimit(self):
+        """
+        No more than I{maxConnectionsPerPeer} connections are accepted from
+        a network at once; other networks are not affected.
+        """
+        first = self.connect('10.0.0.1')
+        self.failIf(self.connect('10.0.0.2') is None)
+        self.assertIdentical(self.connect('10.0.0.3'), None)
+        self.assertEquals(self.factory.rejectedByLimit, 1)
+        self.failIf(self.connect('10.0.1.1') is None)
+        first.connectionLost(None)
+        self.failIf(self.connect('10.0.0.3') is None)
+
+
+    def test_acceptRate(self):
+        """
+        With I{maxAcceptRate}, a network can open I{acceptBurst} connections
+        at once, and then one more every 1 / I{maxAcceptRate} seconds.
+        """
+        self.factory.maxConnectionsPerPeer = 100
+        self.factory.maxAcceptRate = 2
+        self.factory.acceptBurst = 3
+        for i in range(3):
+            self.failIf(self.connect('10.0.0.1') is None)
+        self.assertIdentical(self.connect('10.0.0.1'), None)
+        self.assertEquals(self.factory.rejectedByRate, 1)
+        self.failIf(self.connect('10.0.1.1') is None)
+        self.clock.advance(0.5)
+        self.failIf(self.connect('10.0.0.1') is None)
+        self.assertIdentical(self.connect('10.0.0.1'), None)
+        self.assertEquals(self.factory.rejectedByRate, 2)
+
+
+    def test_idleExpiry(self):
+        """
+        A network without connections is forgotten once its bucket is full
+        again, not before.
+        """
+        self.factory.maxAcceptRate = 10
+        p = self.connect('10.0.0.1')
+        p.connectionLost(None)
+        key = policies.networkPrefix('10.0.0.1')
+        self.assertIn(key, self.factory.peerConnections)
+        self.clock.advance(0.05)
+        self.connect('10.0.1.1')
+        self.assertIn(key, self.factory.peerConnections)
+        self.clock.advance(0.1)
+        self.connect('10.0.1.1')
+        self.assertNotIn(key, self.factory.peerConnections)
+
+
+    def test_floodQueuedOnce(self):
+        """
+        However many connections of an idle network are refused by the rate
+        limit, the network is queued for expiry only once.
+        """
+        self.factory.maxAcceptRate = 10
+        self.factory.acceptBurst = 10
+        longest = 0
+        for i in range(10000):
+            p = self.connect('10.0.0.%d' % (i % 256,))
+            if p is not None:
+                p.connectionLost(None)
+            longest = max(longest, len(self.factory._idle))
+            self.clock.advance(0.0001)
+        self.assertEquals(longest, 1)
+        # a burst of 10, then 10 per second for a second
+        self.assertApproximates(self.factory.rejectedByRate, 10000 - 20, 1)
+        self.clock.advance(2)
+        self.connect('10.0.1.1')
+        self.assertEquals(self.factory.peerConnections.keys(),
+                          [policies.networkPrefix('10.0.1.1')])
+
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    """
+    Tests for L{policies.TokenBucket}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+
+    def test_burst(self):
+        """
+        A bucket starts full and gives out up to I{burst} tokens at once;
+        taking more puts it in debt, to be repaid at I{rate} tokens per
+        second.
+        """
+        bucket = policies.TokenBucket(10, 5, seconds=self.clock.seconds)
+        self.assertEquals(bucket.consume(5), 0)
+        self.assertEquals(bucket.consume(5), 0.5)
+        self.assertEquals(bucket.tokens, -5)
+
+
+    def test_refill(self):
+        """
+        Tokens come back at I{rate} per second, up to I{burst}.
+        """
+        bucket = policies.TokenBucket(10, 5, seconds=self.clock.seconds)
+        bucket.consume(5)
+        self.clock.advance(0.25)
+        self.assertEquals(bucket.consume(2.5), 0)
+        self.assertEquals(bucket.consume(1), 0.1)
+        self.clock.advance(100)
+        self.assertEquals(bucket.consume(5), 0)
+        self.assertEquals(bucket.consume(1), 0.1)
+
+
+    def test_parent(self):
+        """
+        Tokens are taken from the parent too, and the wait is for the
+        bucket furthest in debt.
+        """
+        parent = policies.TokenBucket(1, 1, seconds=self.clock.seconds)
+        bucket = policies.TokenBucket(100, 100, parent, self.clock.seconds)
+        self.assertEquals(bucket.consume(3), 2)
+        self.assertEquals(parent.tokens, -2)
+        self.assertEquals(bucket.tokens, 97)
+
+
+
+class ThrottlingFactoryTestCase(unittest.TestCase):
+    """
+    Tests for L{policies.ThrottlingFactory}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+
+    def buildFactory(self, **limits):
+        wrapped = protocol.ServerFactory()
+        wrapped.protocol = protocol.Protocol
+        factory = policies.ThrottlingFactory(wrapped, **limits)
+        factory.seconds = self.clock.seconds
+        factory.callLater = self.clock.callLater
+        return factory
+
+
+    def connect(self, factory, host='10.0.0.1'):
+        p = factory.buildProtocol(address.IPv4Address('TCP', host, 1234))
+        p.makeConnection(proto_helpers.StringTransport())
+        return p
+
+
+    def test_throttleReads(self):
+        """
+        Reading more than the burst of a connection pauses its transport
+        until the debt is repaid.
+        """
+        factory = self.buildFactory(connectionReadLimit=100)
+        p = self.connect(factory)
+        p.dataReceived("x" * 25)
+        self.assertEquals(p.transport.producerState, 'producing')
+        p.dataReceived("x" * 25)
+        self.assertEquals(p.transport.producerState, 'paused')
+        self.clock.advance(0.2)
+        self.assertEquals(p.transport.producerState, 'paused')
+        self.clock.advance(0.05)
+        self.assertEquals(p.transport.producerState, 'producing')
+
+
+    def test_readWhilePaused(self):
+        """
+        Data read while paused pushes the resumption back, and the transport
+        is paused only once.
+        """
+        factory = self.buildFactory(connectionReadLimit=100)
+        p = self.connect(factory)
+        p.dataReceived("x" * 50)
+        p.transport.pauseProducing = lambda: self.fail("paused twice")
+        p.dataReceived("x" * 50)
+        self.clock.advance(0.7)
+        self.assertEquals(p.transport.producerState, 'paused')
+        self.clock.advance(0.05)
+        self.assertEquals(p.transport.producerState, 'producing')
+        self.failIf(self.clock.calls)
+
+
+    def test_throttleWrites(self):
+        """
+        Writing more than the burst of a connection pauses its producer
+        until the debt is repaid.
+        """
+        factory = self.buildFactory(connectionWriteLimit=100)
+        p = self.connect(factory)
+        producer = proto_helpers.StringTransport()
+        p.registerProducer(producer, True)
+        p.write("x" * 75)
+        self.assertEquals(producer.producerState, 'paused')
+        self.clock.advance(0.5)
+        self.assertEquals(producer.producerState, 'producing')
+        self.assertEquals(p.transport.value(), "x" * 75)
+
+
+    def test_peerLimit(self):
+        """
+        Connections from the same host share its bucket, so only the one
+        that runs it into debt is paused; other hosts are not affected.
+        """
+        factory = self.buildFactory(peerReadLimit=100)
+        first = self.connect(factory)
+        second = self.connect(factory)
+        other = self.connect(factory, '10.0.0.2')
+        first.dataReceived("x" * 20)
+        second.dataReceived("x" * 20)
+        other.dataReceived("x" * 20)
+        self.assertEquals(first.transport.producerState, 'producing')
+        self.assertEquals(second.transport.producerState, 'paused')
+        self.assertEquals(other.transport.producerState, 'producing')
+        self.clock.advance(0.15)
+        self.assertEquals(second.transport.producerState, 'producing')
+
+
+    def test_connectionLostCancelsResume(self):
+        """
+        Losing a paused connection cancels its resumption.
+        """
+        factory = self.buildFactory(connectionReadLimit=100)
+        p = self.connect(factory)
+        p.dataReceived("x" * 50)
+        self.assertEquals(len(self.clock.calls), 1)
+        p.connectionLost(None)
+        self.failIf(self.clock.calls)
+        self.assertEquals(factory.peers, {})
+
+
+
+class BrokenFile(object):
+    """
+    A file that can't be written to.
+    """
+
+    def write(self, data):
+        raise IOError("disk full")
+
+
+    def flush(self):
+        pass
+
+
+
+class TrafficLogWriterTestCase(unittest.TestCase):
+    """
+    Tests for L{policies.TrafficLogWriter}.
+    """
+
+    def setUp(self):
+        self.writer = policies.TrafficLogWriter(
+            self.mktemp(), bufferSize=2, flushInterval=60)
+        self.addCleanup(self.writer.stop)
+
+
+    def test_dropWhenFull(self):
+        """
+        Writes beyond I{bufferSize} are dropped and counted.
+        """
+        self.writer.start = lambda: None
+        for line in "abc":
+            self.writer.write(line)
+        self.assertEquals(list(self.writer._buffer), ["a", "b"])
+        self.assertEquals(self.writer.dropped, 1)
+
+
+    def test_flushOnStop(self):
+        """
+        Stopping the writer writes out what is buffered before the thread
+        ends, however long the flush interval.
+        """
+        self.writer.bufferSize = 100
+        self.writer.write("one\n")
+        self.writer.write("two\n")
+        self.writer.stop()
+        self.assertEquals(file(self.writer.path).read(), "one\ntwo\n")
+        self.assertEquals(self.writer.written, 2)
+        self.assertIdentical(self.writer._thread, None)
+
+
+    def test_stopRemovesTrigger(self):
+        """
+        Stopping the writer removes its shutdown trigger, so the reactor
+        doesn't keep the writer around.
+        """
+        self.writer.write("one\n")
+        triggerID = self.writer._triggerID
+        self.failIf(triggerID is None)
+        self.writer.stop()
+        self.assertIdentical(self.writer._triggerID, None)
+        self.assertRaises(ValueError, reactor.removeSystemEventTrigger,
+                          triggerID)
+
+
+    def test_failedWriteNotCounted(self):
+        """
+        Lines that fail to be written are logged and not counted as
+        written.
+        """
+        self.writer.start = lambda: None
+        self.writer.write("one\n")
+        self.writer._drain(BrokenFile())
+        self.assertEquals(self.writer.written, 0)
+        self.assertEquals(len(self.flushLoggedErrors(IOError)), 1)
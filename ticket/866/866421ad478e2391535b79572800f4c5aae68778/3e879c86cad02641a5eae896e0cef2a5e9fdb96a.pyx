@@ -3,23 +3,20 @@
 
 """
 Interface to epoll I/O event notification facility.
-"""
-
-cdef extern from "stdio.h":
-    cdef extern void *malloc(int)
-    cdef extern void free(void *)
-    cdef extern int close(int)
 
-cdef extern from "errno.h":
-    cdef extern int errno
-    cdef extern char *strerror(int)
+Build with Cython.  L{epoll.poll} stores the readiness of the file
+descriptors in a preallocated array instead of building a list of tuples,
+so that polling creates no Python objects per event.
+"""
 
-cdef extern from "string.h":
-    cdef extern void *memset(void* s, int c, int n)
+from libc.errno cimport errno, EBADF
+from libc.stdlib cimport malloc, free
+from libc.stdint cimport uint32_t, uint64_t
+from libc.string cimport strerror
+from posix.unistd cimport close
 
-cdef extern from "stdint.h":
-    ctypedef unsigned long uint32_t
-    ctypedef unsigned long long uint64_t
+from cpython cimport array
+import array
 
 cdef extern from "sys/epoll.h":
 
@@ -39,6 +36,8 @@ cdef extern from "sys/epoll.h":
         EPOLLMSG = 0x400
         EPOLLERR = 0x008
         EPOLLHUP = 0x010
+        EPOLLRDHUP = 0x2000
+        EPOLLONESHOT = (1 << 30)
         EPOLLET = (1 << 31)
 
     ctypedef union epoll_data_t:
@@ -51,42 +50,62 @@ cdef extern from "sys/epoll.h":
         uint32_t events
         epoll_data_t data
 
-    int epoll_create(int size)
-    int epoll_ctl(int epfd, int op, int fd, epoll_event *event)
-    int epoll_wait(int epfd, epoll_event *events, int maxevents, int timeout)
+    int epoll_create(int size) nogil
+    int epoll_ctl(int epfd, int op, int fd, epoll_event *event) nogil
+    int epoll_wait(int epfd, epoll_event *events, int maxevents,
+                   int timeout) nogil
+
+
+cdef raiseError(int error):
+    raise IOError(error, strerror(error).decode("ascii"))
 
-cdef extern from "Python.h":
-    ctypedef struct PyThreadState
-    cdef extern PyThreadState *PyEval_SaveThread()
-    cdef extern void PyEval_RestoreThread(PyThreadState*)
 
 cdef class epoll:
     """
     Represent a set of file descriptors being monitored for events.
+
+    @ivar maxevents: The largest number of events L{poll} reports at once.
+
+    @ivar ready: An C{array.array} of C{2 * maxevents} C{int}s, where L{poll}
+        stores the file descriptor and the events of the I{n}th event at
+        C{2 * n} and C{2 * n + 1}.  The same array is reused by every call.
     """
 
     cdef int fd
     cdef int initialized
-
-    def __init__(self, int size):
+    cdef epoll_event *events
+    cdef readonly int maxevents
+    cdef readonly array.array ready
+
+    def __cinit__(self, int size, int maxevents=1024):
+        self.initialized = 0
+        self.events = NULL
+        if maxevents < 1:
+            raise ValueError("maxevents must be positive")
+        self.events = <epoll_event*>malloc(sizeof(epoll_event) * maxevents)
+        if self.events == NULL:
+            raise MemoryError()
+        self.maxevents = maxevents
+        self.ready = array.array('i', [0]) * (2 * maxevents)
         self.fd = epoll_create(size)
         if self.fd == -1:
-            raise IOError(errno, strerror(errno))
+            raiseError(errno)
         self.initialized = 1
 
     def __dealloc__(self):
         if self.initialized:
             close(self.fd)
             self.initialized = 0
+        free(self.events)
 
     def close(self):
         """
         Close the epoll file descriptor.
         """
         if self.initialized:
-            if close(self.fd) == -1:
-                raise IOError(errno, strerror(errno))
             self.initialized = 0
+            if close(self.fd) == -1:
+                raiseError(errno)
 
     def fileno(self):
         """
@@ -97,7 +116,7 @@ cdef class epoll:
     def _control(self, int op, int fd, int events):
         """
         Modify the monitored state of a particular file descriptor.
-        
+
         Wrap epoll_ctl(2).
 
         @type op: C{int}
@@ -109,15 +128,74 @@ cdef class epoll:
         @type events: C{int}
         @param events: A bit set of IN, OUT, PRI, ERR, HUP, and ET.
 
-        @raise IOError: Raised if the underlying epoll_ctl() call fails.
+        @raise IOError: Raised if the underlying epoll_ctl() call fails, or
+            with C{EBADF} if the epoll file descriptor was closed.
         """
-        cdef int result
         cdef epoll_event evt
-        evt.events = events
+        if not self.initialized:
+            # the descriptor number may belong to another file by now
+            raiseError(EBADF)
+        evt.events = <uint32_t>events
+        evt.data.u64 = 0
         evt.data.fd = fd
-        result = epoll_ctl(self.fd, op, fd, &evt)
+        if epoll_ctl(self.fd, op, fd, &evt) == -1:
+            raiseError(errno)
+
+    def register(self, int fd, int events):
+        """
+        Start monitoring a file descriptor for C{events}.
+        """
+        self._control(EPOLL_CTL_ADD, fd, events)
+
+    def modify(self, int fd, int events):
+        """
+        Change the events monitored for a file descriptor.
+        """
+        self._control(EPOLL_CTL_MOD, fd, events)
+
+    def unregister(self, int fd):
+        """
+        Stop monitoring a file descriptor.
+        """
+        self._control(EPOLL_CTL_DEL, fd, 0)
+
+    def poll(self, int timeout, int maxevents=-1):
+        """
+        Wait for I/O events, storing them in L{ready}.
+
+        @type timeout: C{int}
+        @param timeout: Maximum time waiting for events, in milliseconds. 0
+            makes it return immediately whereas -1 makes it wait
+            indefinitely.
+
+        @type maxevents: C{int}
+        @param maxevents: Maximum number of events stored, at most (and by
+            default) L{maxevents}.
+
+        @return: The number of events stored in L{ready}.
+
+        @raise IOError: Raised if the underlying epoll_wait() call fails,
+            including when it is interrupted by a signal (C{EINTR}), or with
+            C{EBADF} if the epoll file descriptor was closed.
+        """
+        cdef int result, i
+        cdef int *ready = self.ready.data.as_ints
+        cdef int fd = self.fd
+        cdef epoll_event *events = self.events
+
+        if not self.initialized:
+            raiseError(EBADF)
+        if maxevents < 1 or maxevents > self.maxevents:
+            maxevents = self.maxevents
+
+        with nogil:
+            result = epoll_wait(fd, events, maxevents, timeout)
         if result == -1:
-            raise IOError(errno, strerror(errno))
+            raiseError(errno)
+        for i in range(result):
+            ready[2 * i] = events[i].data.fd
+            ready[2 * i + 1] = <int>events[i].events
+        return result
 
     def wait(self, unsigned int maxevents, int timeout):
         """
@@ -129,33 +207,18 @@ cdef class epoll:
         @type timeout: C{int}
         @param timeout: Maximum time waiting for events. 0 makes it return
             immediately whereas -1 makes it wait indefinitely.
-        
-        @raise IOError: Raised if the underlying epoll_wait() call fails.
-        """
-        cdef epoll_event *events
-        cdef int result
-        cdef int nbytes
-        cdef int fd
-        cdef PyThreadState *_save
 
-        nbytes = sizeof(epoll_event) * maxevents
-        events = <epoll_event*>malloc(nbytes)
-        memset(events, 0, nbytes)
-        try:
-            fd = self.fd
+        @return: A C{list} of C{(fd, events)} tuples.  L{poll} does the same
+            without building it.
 
-            _save = PyEval_SaveThread()
-            result = epoll_wait(fd, events, maxevents, timeout)
-            PyEval_RestoreThread(_save)
-
-            if result == -1:
-                raise IOError(result, strerror(result))
-            results = []
-            for i from 0 <= i < result:
-                results.append((events[i].data.fd, <int>events[i].events))
-            return results
-        finally:
-            free(events)
+        @raise IOError: Raised if the underlying epoll_wait() call fails.
+        """
+        cdef int n, i
+        if maxevents > <unsigned int>self.maxevents:
+            maxevents = self.maxevents
+        n = self.poll(timeout, maxevents)
+        ready = self.ready
+        return [(ready[2 * i], ready[2 * i + 1]) for i in range(n)]
 
 CTL_ADD = EPOLL_CTL_ADD
 CTL_DEL = EPOLL_CTL_DEL
@@ -166,6 +229,8 @@ OUT = EPOLLOUT
 PRI = EPOLLPRI
 ERR = EPOLLERR
 HUP = EPOLLHUP
+RDHUP = EPOLLRDHUP
+ONESHOT = EPOLLONESHOT
 ET = EPOLLET
 
 RDNORM = EPOLLRDNORM
@@ -173,4 +238,3 @@ RDBAND = EPOLLRDBAND
 WRNORM = EPOLLWRNORM
 WRBAND = EPOLLWRBAND
 MSG = EPOLLMSG
-
@@ -1,6 +1,14 @@
+import math, random, struct, sys, time
+from bisect import bisect
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
 from zope.interface import Interface, implements
-from twisted.python import log
-from twisted.internet import defer
+from twisted.python import failure, log
+from twisted.internet import defer, protocol
 
 import memcache
 
@@ -34,34 +42,414 @@ class Resolver(object):
 
         raise Exception("unable to resolve the key '%s'" % key)
 
+
+class HashRing(object):
+    """An IResolver implementation that maps the keys on a ketama-style
+    consistent hash ring.
+
+    Each backend owns C{replicas * weight} points on the ring, and a key
+    belongs to the backend owning the first point following its hash.
+    Since the points of a backend don't depend on the other backends,
+    adding or removing one of N backends only remaps about 1/N of the
+    keys.
+    """
+
+    implements(IResolver)
+    replicas = 160
+
+    def __init__(self, servers=(), replicas=None):
+        """servers is a sequence of (host, port) addresses, or of
+        ((host, port), weight) pairs.
+        """
+        if replicas is not None:
+            self.replicas = replicas
+        self.weights = {}
+        self._points = []
+        self._addresses = []
+
+        for server in servers:
+            if isinstance(server[0], tuple):
+                self.weights[server[0]] = server[1]
+            else:
+                self.weights[server] = 1
+        self._build()
+
+    def _build(self):
+        ring = {}
+        for address, weight in self.weights.items():
+            # Each md5 digest gives 4 points on the ring
+            for i in xrange(int(self.replicas * weight) // 4):
+                digest = md5("%s:%d-%d" % (address[0], address[1], i)).digest()
+                for point in struct.unpack("<4L", digest):
+                    ring[point] = address
+
+        self._points = sorted(ring)
+        self._addresses = [ring[point] for point in self._points]
+
+    def add(self, address, weight=1):
+        """Add a backend to the ring, or change its weight.
+        """
+        self.weights[address] = weight
+        self._build()
+
+    def remove(self, address):
+        """Remove a backend from the ring: its keys are spread on the
+        remaining backends.
+        """
+        del self.weights[address]
+        self._build()
+
+    def resolve(self, key):
+        if not self._points:
+            raise Exception("unable to resolve the key '%s'" % key)
+
+        point = struct.unpack("<L", md5(key).digest()[:4])[0]
+        i = bisect(self._points, point)
+        if i == len(self._points):
+            i = 0
+        return self._addresses[i]
+
+
+class _ConnectionFactory(protocol.ReconnectingClientFactory):
+    """Keep one connection of a _ServerPool alive, reconnecting when it is
+    lost.
+    """
+
+    maxDelay = 30
+    noisy = False
+
+    def __init__(self, pool, protocolFactory):
+        self.pool = pool
+        self.protocol = protocolFactory
+        self.proto = None
+
+    def clientConnectionMade(self, proto):
+        # Called by MemCacheProtocol.connectionMade
+        self.resetDelay()
+        self.proto = proto
+        self.pool.connectionMade(proto)
+
+    def clientConnectionLost(self, connector, reason):
+        if self.proto is not None:
+            self.pool.connectionLost(self.proto)
+            self.proto = None
+        protocol.ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.pool.connectionFailed(reason)
+        protocol.ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason)
+
+
+class _ServerPool(object):
+    """A pool of persistent connections to a memcache backend, used in
+    turn.
+
+    The keys requested within batchDelay seconds (or within the same
+    reactor iteration) are fetched with a single multiple get.
+    """
+
+    # The most keys fetched by a single get
+    maxKeys = 100
+
+    def __init__(self, address, size, protocolFactory, batchDelay=0):
+        self.address = address
+        self.size = size
+        self.protocolFactory = protocolFactory
+        self.batchDelay = batchDelay
+        self.connected = []
+        self.factories = []
+        self.waiting = []
+        self._next = 0
+        # The calls waiting for the next batch, mapped by key
+        self._batch = {}
+        self._flushCall = None
+
+    def start(self):
+        from twisted.internet import reactor
+
+        host, port = self.address
+        for i in xrange(self.size):
+            factory = _ConnectionFactory(self, self.protocolFactory)
+            self.factories.append(factory)
+            # Let stopTrying also abort the pending connection attempt
+            factory.connector = reactor.connectTCP(host, port, factory)
+
+    def stop(self):
+        for factory in self.factories:
+            factory.stopTrying()
+            if factory.proto is not None:
+                factory.proto.transport.loseConnection()
+        self.factories = []
+
+    def acquire(self):
+        """Return a Deferred firing with a connected protocol.
+        """
+        if not self.factories:
+            self.start()
+
+        if self.connected:
+            self._next = (self._next + 1) % len(self.connected)
+            return defer.succeed(self.connected[self._next])
+
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    def get(self, key):
+        """Return a Deferred firing with the value of key, or None.
+        """
+        try:
+            self._batch[key].append(defer.Deferred())
+        except KeyError:
+            self._batch[key] = [defer.Deferred()]
+
+        if self._flushCall is None:
+            from twisted.internet import reactor
+            self._flushCall = reactor.callLater(self.batchDelay, self.flush)
+        return self._batch[key][-1]
+
+    def flush(self):
+        """Send the batched gets.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+
+        batch, self._batch = self._batch, {}
+        keys = batch.keys()
+        for i in xrange(0, len(keys), self.maxKeys):
+            self._getMultiple(batch, keys[i:i + self.maxKeys])
+
+    def _getMultiple(self, batch, keys):
+        def cbConnect(proto):
+            return proto.getMultiple(keys)
+
+        def cbGet(values):
+            for key in keys:
+                value = values.get(key)
+                for d in batch[key]:
+                    d.callback(value)
+
+        def ebGet(reason):
+            for key in keys:
+                for d in batch[key]:
+                    d.errback(reason)
+
+        self.acquire().addCallback(cbConnect).addCallbacks(cbGet, ebGet)
+
+    def connectionMade(self, proto):
+        self.connected.append(proto)
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(proto)
+
+    def connectionLost(self, proto):
+        self.connected.remove(proto)
+
+    def connectionFailed(self, reason):
+        # Don't keep the callers waiting while the backend is down, the
+        # connections are retried in the background
+        if not self.connected:
+            waiting, self.waiting = self.waiting, []
+            for d in waiting:
+                d.errback(reason)
+
         
+class LRUCache(object):
+    """A bounded in-process cache, dropping the least recently used
+    entries when the values take more than maxSize bytes.
+
+    The entries expire after expireTime seconds: keep it short, since the
+    other processes can't invalidate them.
+    """
+
+    def __init__(self, maxSize, expireTime=1.0):
+        self.maxSize = maxSize
+        self.expireTime = expireTime
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        # The entries are linked in a circular list, the most recently used
+        # first, each link being [previous, next, key, value, size, expires]
+        self._root = root = []
+        root[:] = [root, root, None, None, 0, 0]
+
+    def sizeOf(self, value):
+        """Return an estimate of the size of a value, in bytes: the length
+        of a string, else the size of the object and of its direct items.
+        Pass the size to set() when a better one is known.
+        """
+        if isinstance(value, str):
+            return len(value)
+        size = sys.getsizeof(value)
+        if isinstance(value, dict):
+            for item in value.iteritems():
+                size += sys.getsizeof(item[0]) + sys.getsizeof(item[1])
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            for item in value:
+                size += sys.getsizeof(item)
+        return size
+
+    def get(self, key):
+        """Return the value associated with the given key, or None.
+        """
+        try:
+            link = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        if link[5] < time.time():
+            self._remove(link)
+            self.misses += 1
+            return None
+
+        # Move the entry first
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+        root = self._root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = root[1] = link
+
+        self.hits += 1
+        return link[3]
+
+    def set(self, key, value, expireTime=None, size=None):
+        """Associate a value with the given key, for expireTime seconds
+        (by default, the expireTime of the cache).  The size of the value
+        is estimated by sizeOf() unless given.
+        """
+        link = self._entries.get(key)
+        if link is not None:
+            self._remove(link)
+
+        if size is None:
+            size = self.sizeOf(value)
+        if size > self.maxSize:
+            return
+        if expireTime is None:
+            expireTime = self.expireTime
+
+        root = self._root
+        first = root[1]
+        link = [root, first, key, value, size, time.time() + expireTime]
+        first[0] = root[1] = link
+        self._entries[key] = link
+        self.size += size
+
+        # Drop the least recently used entries
+        while self.size > self.maxSize:
+            self._remove(root[0])
+
+    def _remove(self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+        del self._entries[link[2]]
+        self.size -= link[4]
+
+    def invalidate(self, key):
+        """Remove the entry associated with the given key.
+        """
+        link = self._entries.get(key)
+        if link is not None:
+            self._remove(link)
+
+    def clear(self):
+        """Remove all the entries.
+        """
+        root = self._root
+        root[:] = [root, root, None, None, 0, 0]
+        self._entries.clear()
+        self.size = 0
+
+    def hitRatio(self):
+        """Return the ratio of the lookups which found a value.
+        """
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+
 class MemCacheClient(object):
     """An high level memcache backend.
+
+    It keeps poolSize persistent connections to each backend returned by
+    the resolver, opened on first use.  The lookups are batched: the keys
+    requested within batchDelay seconds (by default, within the same
+    reactor iteration) are fetched with a single command per backend.
+
+    If expireTime is set, the cached values expire after expireTime
+    seconds, or slightly before (see beta) so that they are recomputed by
+    a single caller.  If staleTime is set too, an expired value is still
+    served for staleTime seconds while it is refreshed in the background.
+    Those values are stored along with their expiration time, so the
+    clients sharing them must agree on expireTime.
+
+    If localCache is set (see LRUCache), the values returned by cache()
+    are kept in it too, and the hot keys are found without a round-trip
+    to the backend.
     """
     
-    def __init__(self, resolver, protocolFactory=memcache.MemCacheProtocol):
+    # How early the values expire, relatively to the time taken to compute
+    # them
+    beta = 1.0
+
+    def __init__(self, resolver, protocolFactory=memcache.MemCacheProtocol,
+                 poolSize=1, expireTime=0, staleTime=0, batchDelay=0,
+                 localCache=None):
         self.resolver = resolver
         self.protocolFactory = protocolFactory
+        self.poolSize = poolSize
+        self.batchDelay = batchDelay
+        self.expireTime = expireTime
+        self.staleTime = staleTime
+        self.localCache = localCache
         # Keep persistent connections, mapped by backend address
         self.connections = {}
+        # The calls waiting for a lookup in progress, mapped by key
+        self._pending = {}
+        self._refreshing = set()
+        # The invalidations of the keys with a lookup or a refresh in
+        # progress, so that the value it gets isn't kept in localCache
+        self._generations = {}
 
 
-    def connect(self, key):
-        def cb(proto):
-            self.connections[(host, port)] = proto
-            return proto
+    def _getPool(self, key):
+        address = self.resolver.resolve(key)
 
-        host, port = self.resolver.resolve(key)
-        
         try:
-            proto = self.connections[(host, port)]
-            return defer.succeed(self.protocol)
+            return self.connections[address]
         except KeyError:
-            from twisted.internet import protocol, reactor
+            pool = self.connections[address] = _ServerPool(
+                address, self.poolSize, self.protocolFactory, self.batchDelay)
+            return pool
+
+    def connect(self, key):
+        return self._getPool(key).acquire()
+
+    def get(self, key):
+        """Return the value associated with the given key, or None.
+
+        The keys requested by concurrent calls are fetched with a single
+        command per backend.
+        """
+        return self._getPool(key).get(key)
 
-            d = protocol.ClientCreator(reactor, self.protocolFactory
-                                       ).connectTCP(host, port) 
-            return d.addCallback(cb)
+    def disconnect(self):
+        """Close all the connections.
+        """
+        for pool in self.connections.values():
+            pool.stop()
+        self.connections.clear()
 
     def cache(self, key, callable, *args, **kwargs):
         """If an entry with the given key if found in the cache, it is
@@ -69,43 +457,132 @@ class MemCacheClient(object):
         Else the callable function is called with the given arguments
         and the returned value is stored in cache.
 
-        Returns the result of the the callable function.
+        Concurrent calls for the same key share the same lookup, so that
+        the callable function is called only once on a miss.
 
-        XXX TODO: handle connection errors
+        Returns the result of the the callable function, which is also
+        called when the backend is unavailable.
         """
 
-        def cbConnect(proto):
-            def cbGet(value):
-                if value is None:
-                    return call()
-                else:
-                    # Return the cached value
-                    return value
-
-            def ebGet(reason):
-                # Ignore the error
-                # XXX return callable(*args, **kwargs)
+        if self.localCache is not None:
+            value = self.localCache.get(key)
+            if value is not None:
+                return defer.succeed(value)
+
+        try:
+            waiting = self._pending[key]
+        except KeyError:
+            pass
+        else:
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+
+        self._pending[key] = []
+        generation = self._generations.setdefault(key, 0)
+        d = self._cache(key, callable, args, kwargs)
+        if self.localCache is not None:
+            d.addCallback(self._store, key, generation)
+        return d.addBoth(self._release, key)
+
+    def _store(self, value, key, generation):
+        # Unless the key was invalidated since the lookup started
+        if self._generations.get(key) == generation:
+            self.localCache.set(key, value)
+        return value
+
+    def _release(self, result, key):
+        # Give the result to the calls which waited for this lookup
+        waiting = self._pending.pop(key)
+        if key not in self._refreshing:
+            del self._generations[key]
+        for d in waiting:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        return result
+
+    def _isFresh(self, expires, delta):
+        # Expire the entry early with a probability increasing as its
+        # expiration time approaches, and with the time it takes to
+        # compute it: a single caller recomputes it before the others
+        # miss it.  random() can return 0.0 but never 1.0, log() takes
+        # 1.0 - random() instead.
+        return (time.time()
+                - delta * self.beta * math.log(1.0 - random.random())
+                < expires)
+
+    def _cache(self, key, callable, args, kwargs):
+        def cbGet(value):
+            if value is None:
                 return call()
-            
-            def call():
-                # Compute the value from the function and store it in
-                # the cache
-                return defer.maybeDeferred(callable, *args,
-                                           **kwargs).addCallback(set)
-            
-            def set(value):
-                # Set the value in the cache, ignoring errors
-                return proto.set(key, value).addBoth(lambda _: value)
-
-            # Check for the value in the cache
-            return proto.get(key).addCallbacks(cbGet, ebGet)
-                
-        # Make sure to be connected
-        return self.connect(key).addCallbacks(cbConnect)
+            elif not self.expireTime:
+                # Return the cached value
+                return value
+
+            value, expires, delta = value
+            if self._isFresh(expires, delta):
+                return value
+            elif self.staleTime and time.time() < expires + self.staleTime:
+                # Serve the stale value while it is refreshed
+                self._refresh(key, call)
+                return value
+            else:
+                return call()
+
+        def ebGet(reason):
+            # Ignore the error
+            # XXX return callable(*args, **kwargs)
+            return call()
+        
+        def call():
+            # Compute the value from the function and store it in
+            # the cache
+            started = time.time()
+            return defer.maybeDeferred(callable, *args,
+                                       **kwargs).addCallback(set, started)
+        
+        def set(value, started):
+            def cbConnect(proto):
+                if not self.expireTime:
+                    return proto.set(key, value)
+                now = time.time()
+                entry = (value, now + self.expireTime, now - started)
+                return proto.set(key, entry, self.expireTime + self.staleTime)
+
+            # Set the value in the cache, ignoring errors
+            d = self.connect(key).addCallback(cbConnect)
+            return d.addBoth(lambda _: value)
+
+        # Check for the value in the cache
+        return self.get(key).addCallbacks(cbGet, ebGet)
+
+    def _refresh(self, key, call):
+        # Only one refresh at a time for a given key
+        if key in self._refreshing:
+            return
+
+        def done(result):
+            self._refreshing.remove(key)
+            if isinstance(result, failure.Failure):
+                log.err(result, "memcache: unable to refresh '%s'" % key)
+            elif self.localCache is not None:
+                self._store(result, key, generation)
+            if key not in self._pending:
+                del self._generations[key]
+
+        self._refreshing.add(key)
+        generation = self._generations.setdefault(key, 0)
+        call().addBoth(done)
 
     def invalidate(self, key):
         """Invalidate the cache value associated with the given key.
         """
+        if self.localCache is not None:
+            self.localCache.invalidate(key)
+        if key in self._generations:
+            self._generations[key] += 1
 
         def cbConnect(proto):
             return proto.delete(key)
@@ -136,12 +613,8 @@ if __name__ == '__main__':
         reason.printTraceback()
 
 
-    config = [
-        (r'[a-z]+', ('127.0.0.1', 11211)),
-        (r'\d+', ('127.0.0.1', 11212))
-         ]
-    resolver = Resolver(config)
-    client = MemCacheClient(resolver)
+    resolver = HashRing([('127.0.0.1', 11211), ('127.0.0.1', 11212)])
+    client = MemCacheClient(resolver, poolSize=4)
 
     client.cache('x', fun, '2', '3'
                  ).addCallbacks(callback, errback
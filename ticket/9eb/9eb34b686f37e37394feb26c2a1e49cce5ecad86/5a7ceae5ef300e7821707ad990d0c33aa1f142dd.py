@@ -1,6 +1,8 @@
 import memcache
 
 from twisted.trial import unittest
+from twisted.internet.defer import DeferredList
+from twisted.internet.error import ConnectionDone
 from twisted.test.proto_helpers import StringTransportWithDisconnection
 
 class Bean(object):
@@ -31,6 +33,33 @@ class MemCacheTestCase(unittest.TestCase):
         self.proto.dataReceived("END\r\n")
         return d
 
+    def test_splitGet(self):
+        def cb(res):
+            self.assertEquals(res, "bar")
+        d = self.proto.get("foo")
+        d.addCallback(cb)
+        self.proto.dataReceived("VALUE foo 0 3\r\nbar")
+        self.proto.dataReceived("\r\nEND\r\n")
+        return d
+
+    def test_getMultiple(self):
+        def cb(res):
+            self.assertEquals(res, {"foo": "bar", "egg": 12})
+        d = self.proto.getMultiple(["foo", "spam", "egg"])
+        d.addCallback(cb)
+        self.assertEquals(self.transport.value(), "get foo spam egg\r\n")
+        self.proto.dataReceived("VALUE foo 0 3\r\nbar\r\n"
+                                "VALUE egg 2 2\r\n12\r\nEND\r\n")
+        return d
+
+    def test_emptyGetMultiple(self):
+        def cb(res):
+            self.assertEquals(res, {})
+        d = self.proto.getMultiple(["foo", "egg"])
+        d.addCallback(cb)
+        self.proto.dataReceived("END\r\n")
+        return d
+
     def test_set(self):
         def cb(res):
             self.assert_(res)
@@ -223,3 +252,11 @@ class MemCacheTestCase(unittest.TestCase):
         return d
 
 
+
+    def test_connectionLost(self):
+        d1 = self.proto.get("foo")
+        d2 = self.proto.set("bar", "egg")
+        self.transport.loseConnection()
+        d1 = self.assertFailure(d1, ConnectionDone)
+        d2 = self.assertFailure(d2, ConnectionDone)
+        return DeferredList([d1, d2], fireOnOneErrback=True)
@@ -44,6 +44,7 @@ class MemCacheProtocol(basic.LineReceiver):
         self._current = deque()
         self._lenExpected = 0
         self._getBuffer = ""
+        self._getValue = None
 
     def connectionMade(self):
         """
@@ -52,15 +53,31 @@ class MemCacheProtocol(basic.LineReceiver):
         if self.factory:
             self.factory.clientConnectionMade(self)
 
+    def connectionLost(self, reason):
+        """
+        Called when connection is lost: fail the pending requests, they
+        won't get any answer.
+        """
+        basic.LineReceiver.connectionLost(self, reason)
+        while self._current:
+            d = self._current.popleft()[0]
+            d.errback(reason)
+
     def rawDataReceived(self, data):
         """
         Collect data for a get.
         """
         self._getBuffer += data
-        if len(self._getBuffer) >= self._lenExpected:
+        # Wait for the trailing delimiter too
+        if len(self._getBuffer) >= self._lenExpected + 2:
             buf = self._getBuffer[:self._lenExpected]
             rem = self._getBuffer[self._lenExpected+2:]
-            d, key, flags, length = self._current[0]
+            data = self._current[0]
+            if len(data) == 2:
+                # Multiple get
+                key, flags = self._getValue
+            else:
+                d, key, flags, length = data
             val = buf
             if flags & self._FLAG_INTEGER:
                 val = int(val)
@@ -74,7 +91,10 @@ class MemCacheProtocol(basic.LineReceiver):
                 val = pickle.loads(val)
             self._lenExpected = 0
             self._getBuffer = ""
-            self._current[0].append(val)
+            if len(data) == 2:
+                data[1][key] = val
+            else:
+                data.append(val)
             self.setLineMode(rem)
 
     def lineReceived(self, line):
@@ -98,7 +118,7 @@ class MemCacheProtocol(basic.LineReceiver):
                 # Empty get
                 data[0].callback(None)
             else:
-                # Stats
+                # Stats or multiple get
                 data[0].callback(data[1])
         elif line == "NOT FOUND":
             # Incr/Decr/Delete
@@ -109,7 +129,12 @@ class MemCacheProtocol(basic.LineReceiver):
             ign, key, flags, length = line.split()
             self._lenExpected = int(length)
             self._getBuffer = ""
-            self._current[0].extend([key, int(flags), int(length)])
+            data = self._current[0]
+            if len(data) == 2:
+                # Multiple get: the value goes in the dict
+                self._getValue = (key, int(flags))
+            else:
+                data.extend([key, int(flags), int(length)])
             self.setRawMode()
         elif line.startswith("STAT"):
             # Stat response
@@ -247,6 +272,18 @@ class MemCacheProtocol(basic.LineReceiver):
         self._current.append([d])
         return d
 
+    def getMultiple(self, keys):
+        """
+        Get the given C{keys} with a single command. It will be available as
+        a dict, without the keys not found.
+        """
+        fullcmd = "get %s" % " ".join(keys)
+        self.sendLine(fullcmd)
+        d = defer.Deferred()
+        # Add with a dict that will hold the values
+        self._current.append([d, {}])
+        return d
+
     def stats(self):
         """
         Get some stats from the server. It will be available as a dict.
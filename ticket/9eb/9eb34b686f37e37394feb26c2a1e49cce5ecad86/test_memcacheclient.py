@@ -0,0 +1,173 @@
+import sys, time, random
+
+import memcacheclient
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+
+class FakeProtocol(object):
+    """A memcache connection storing the values in a dict.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def set(self, key, value, expireTime=0):
+        self.data[key] = value
+        return defer.succeed(True)
+
+    def delete(self, key):
+        return defer.succeed(self.data.pop(key, None) is not None)
+
+
+class FakeClient(memcacheclient.MemCacheClient):
+    """A client whose lookups are answered by calling answer().
+    """
+    def __init__(self, **kwargs):
+        memcacheclient.MemCacheClient.__init__(self, None, **kwargs)
+        self.data = {}
+        self.lookups = []
+
+    def get(self, key):
+        d = defer.Deferred()
+        self.lookups.append((key, d))
+        return d
+
+    def connect(self, key):
+        return defer.succeed(FakeProtocol(self.data))
+
+    def answer(self):
+        lookups, self.lookups = self.lookups, []
+        for key, d in lookups:
+            d.callback(self.data.get(key))
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = memcacheclient.LRUCache(100, expireTime=60)
+
+    def test_evictLeastRecentlyUsed(self):
+        self.cache.set("a", "x" * 40)
+        self.cache.set("b", "y" * 40)
+        self.cache.get("a")
+        self.cache.set("c", "z" * 40)
+        self.assertEquals(self.cache.get("b"), None)
+        self.assertEquals(self.cache.get("a"), "x" * 40)
+        self.assertEquals(self.cache.get("c"), "z" * 40)
+        self.assertEquals(self.cache.size, 80)
+
+    def test_tooBig(self):
+        self.cache.set("a", "x" * 40)
+        self.cache.set("big", "y" * 101)
+        self.assertEquals(self.cache.get("big"), None)
+        self.assertEquals(self.cache.get("a"), "x" * 40)
+
+    def test_replace(self):
+        self.cache.set("a", "x" * 40)
+        self.cache.set("a", "y" * 10)
+        self.assertEquals(self.cache.get("a"), "y" * 10)
+        self.assertEquals(self.cache.size, 10)
+
+    def test_givenSize(self):
+        self.cache.set("a", 1, size=60)
+        self.assertEquals(self.cache.size, 60)
+        self.cache.set("b", 2, size=60)
+        self.assertEquals(self.cache.get("a"), None)
+        self.assertEquals(self.cache.get("b"), 2)
+        self.assertEquals(self.cache.size, 60)
+
+    def test_sizeOf(self):
+        self.assertEquals(self.cache.sizeOf("abc"), 3)
+        value = ["x" * 1000]
+        self.assertEquals(self.cache.sizeOf(value),
+                          sys.getsizeof(value) + sys.getsizeof(value[0]))
+        self.failUnless(self.cache.sizeOf({"k": "x" * 1000}) > 1000)
+
+    def test_invalidate(self):
+        self.cache.set("a", "x" * 40)
+        self.cache.invalidate("a")
+        self.cache.invalidate("missing")
+        self.assertEquals(self.cache.get("a"), None)
+        self.assertEquals(self.cache.size, 0)
+
+    def test_hitRatio(self):
+        self.cache.set("a", "x")
+        self.cache.get("a")
+        self.cache.get("b")
+        self.assertEquals(self.cache.hitRatio(), 0.5)
+
+
+class LocalCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient(localCache=memcacheclient.LRUCache(1000))
+
+    def test_localHit(self):
+        d = self.client.cache("k", lambda: "value")
+        self.client.answer()
+        self.assertEquals(self.successResultOf(d), "value")
+        d = self.client.cache("k", lambda: "other")
+        self.assertEquals(self.successResultOf(d), "value")
+        self.assertEquals(self.client.lookups, [])
+
+    def test_invalidateDuringLookup(self):
+        d = self.client.cache("k", lambda: "old-value")
+        self.client.invalidate("k")
+        self.client.answer()
+        self.assertEquals(self.successResultOf(d), "old-value")
+        self.assertEquals(self.client.localCache.get("k"), None)
+        self.assertEquals(self.client._generations, {})
+
+    def test_lookupAfterInvalidate(self):
+        self.client.invalidate("k")
+        d = self.client.cache("k", lambda: "value")
+        self.client.answer()
+        self.assertEquals(self.successResultOf(d), "value")
+        self.assertEquals(self.client.localCache.get("k"), "value")
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient(expireTime=10, staleTime=60)
+        self.calls = []
+        self.results = []
+
+    def compute(self):
+        d = defer.Deferred()
+        self.calls.append(d)
+        return d
+
+    def test_singleFlight(self):
+        ds = [self.client.cache("k", self.compute) for i in range(5)]
+        self.assertEquals(len(self.client.lookups), 1)
+        self.client.answer()
+        self.assertEquals(len(self.calls), 1)
+        self.calls[0].callback("value")
+        self.assertEquals([self.successResultOf(d) for d in ds],
+                          ["value"] * 5)
+        self.assertEquals(self.client.data["k"][0], "value")
+        self.assertEquals(self.client._pending, {})
+
+    def test_staleWhileRevalidate(self):
+        self.client.data["k"] = ("old", time.time() - 1, 0.001)
+        d = self.client.cache("k", self.compute)
+        self.client.answer()
+        self.assertEquals(self.successResultOf(d), "old")
+        self.assertEquals(len(self.calls), 1)
+
+        # still stale while the refresh runs, but not refreshed again
+        d = self.client.cache("k", self.compute)
+        self.client.answer()
+        self.assertEquals(self.successResultOf(d), "old")
+        self.assertEquals(len(self.calls), 1)
+
+        self.calls[0].callback("new")
+        self.assertEquals(self.client.data["k"][0], "new")
+        self.assertEquals(self.client._refreshing, set())
+        d = self.client.cache("k", self.compute)
+        self.client.answer()
+        self.assertEquals(self.successResultOf(d), "new")
+        self.assertEquals(len(self.calls), 1)
+
+    def test_isFreshRandomZero(self):
+        self.patch(random, "random", lambda: 0.0)
+        self.failUnless(self.client._isFresh(time.time() + 100, 1))
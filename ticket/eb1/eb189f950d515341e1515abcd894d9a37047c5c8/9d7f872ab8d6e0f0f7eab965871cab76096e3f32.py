@@ -34,10 +34,18 @@ Priority queueing of tasks to one or more threaded or asynchronous workers.
 """
 
 # Imports
-import copy, heapq, threading, sys
+import copy, heapq, threading, sys, os, struct, time
+import cPickle as pickle
+from collections import deque
 from zope.interface import implements, invariant, Interface, Attribute, Invalid
-from twisted.python import failure
-from twisted.internet import defer, reactor, interfaces, task
+from twisted.python import failure, log
+from twisted.internet import defer, reactor, interfaces, task, protocol
+
+
+# Task priorities assigned by the I{doNext} and I{doLast} keywords of
+# TaskQueue.call
+PRIORITY_NEXT = -1000000
+PRIORITY_LAST = +1000000
 
 
 class QueueRunError(Exception):
@@ -70,7 +78,12 @@ class _Task(object):
     @ivar series: A hashable object identifying the series of which this task
         is a part.
 
+    @ivar niceness: The scheduling niceness of the task, set by
+        L{_TaskFactory.new}.
+
     """
+    niceness = 0
+    
     def __init__(self, f, args, kw, priority, series):
         if not isinstance(args, (tuple, list)):
             raise TypeError("Second argument 'args' isn't a sequence")
@@ -122,6 +135,7 @@ class _TaskFactory(object):
         # Setting a non-default TaskClass is mostly for testing
         self.TaskClass = TaskClass
         self.seriesNumbers = {}
+        self.maxSerial = 0
 
     def new(self, func, args, kw, niceness, series=None):
         """
@@ -149,7 +163,9 @@ class _TaskFactory(object):
                 "Niceness must be an integer between -20 and +20")
         positivized = niceness + 20
         priority = self._serial(series) * (1 + (float(positivized)/10)**2)
-        return self.TaskClass(func, args, kw, priority, series)
+        task = self.TaskClass(func, args, kw, priority, series)
+        task.niceness = niceness
+        return task
     
     def _serial(self, series):
         """
@@ -157,13 +173,15 @@ class _TaskFactory(object):
         that the numbers in each series increment independently except that any
         new series starts at a value greater than the maximum serial number
         currently found in any series.
+
+        Serial numbers only ever increase, so the maximum is tracked as they
+        are issued rather than searched for each time a new series appears.
         """
-        if series not in self.seriesNumbers:
-            eachSeries = [0] + self.seriesNumbers.values()
-            maxCurrentSN = max(eachSeries)
-            self.seriesNumbers[series] = maxCurrentSN
-        self.seriesNumbers[series] += 1
-        return float(self.seriesNumbers[series])
+        serial = self.seriesNumbers.get(series, self.maxSerial) + 1
+        self.seriesNumbers[series] = serial
+        if serial > self.maxSerial:
+            self.maxSerial = serial
+        return float(serial)
     
 
 class IWorker(Interface):
@@ -232,91 +250,471 @@ class IWorker(Interface):
         """
 
 
-class Priority(object):
-    """
-    I provide simple, asynchronous access to a priority heap.
+class _Waiters(object):
     """
-    def __init__(self):
-        self.heap = []
-        self.pendingGetCalls = []
+    I am a mixin that manages the deferreds of pending C{get} calls for an
+    asynchronous queue, oldest first.
 
+    Subclasses must implement C{__len__} and C{_pop}.
+    """
     def shutdown(self):
         """
-        Shuts down the priority heap, firing errbacks of the deferreds of any
-        get requests that will not be fulfilled.
+        Shuts down the queue, firing errbacks of the deferreds of any get
+        requests that will not be fulfilled.
         """
         if self.pendingGetCalls:
             msg = "No more items forthcoming"
             theFailure = failure.Failure(QueueRunError(msg))
-            for d in self.pendingGetCalls:
-                d.errback(theFailure)
+            while self.pendingGetCalls:
+                self.pendingGetCalls.popleft().errback(theFailure)
     
     def get(self):
         """
-        Gets an item with the highest priority (lowest value) from the heap,
-        returning a deferred that fires when the item becomes available.
+        Gets the next item from the queue, returning a deferred that fires
+        when the item becomes available.
         """
-        if len(self.heap):
-            d = defer.succeed(heapq.heappop(self.heap))
+        if len(self):
+            d = defer.succeed(self._pop())
         else:
             d = defer.Deferred()
-            self.pendingGetCalls.insert(0, d)
+            self.pendingGetCalls.append(d)
         return d
+
+    def _fireWaiter(self):
+        """
+        Fires the oldest getter deferred with the next item if any L{get} calls
+        are pending.
+        """
+        if self.pendingGetCalls:
+            self.pendingGetCalls.popleft().callback(self._pop())
+
+
+class Priority(_Waiters):
+    """
+    I provide simple, asynchronous access to a priority heap.
+
+    Heap entries are C{(priority, serial, item)} tuples so that ordering is
+    done by fast tuple comparisons rather than calls to C{_Task.__cmp__}, with
+    items of equal priority coming out in the order they were put in. A
+    C{None} item sorts after everything else.
+    """
+    def __init__(self):
+        self.heap = []
+        self.pendingGetCalls = deque()
+        self._serial = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def _pop(self):
+        return heapq.heappop(self.heap)[2]
     
     def put(self, item):
         """
         Adds the supplied I{item} to the heap, firing the oldest getter
         deferred if any L{get} calls are pending.
         """
-        heapq.heappush(self.heap, item)
-        if len(self.pendingGetCalls):
-            d = self.pendingGetCalls.pop()
-            d.callback(heapq.heappop(self.heap))
+        self._serial += 1
+        if item is None:
+            key = float('inf')
+        else:
+            key = item.priority
+        heapq.heappush(self.heap, (key, self._serial, item))
+        self._fireWaiter()
 
 
-class LoadAverageProducer(object):
+class _Series(object):
+    """
+    I hold the pending tasks of one series for L{Scheduler}, as a heap of
+    C{(niceness, serial, task)} tuples, along with the series' deficit
+    counter.
+    """
+    __slots__ = ['heap', 'deficit']
+
+    def __init__(self):
+        self.heap = []
+        self.deficit = 0.0
+
+
+class Scheduler(_Waiters):
+    """
+    I provide asynchronous access to tasks queued up in one or more series,
+    with deficit round-robin scheduling between the series.
+
+    Each series with pending tasks gets a turn in rotation. On its turn, a
+    series is credited with a quantum of C{4 * 2**(-niceness/10)} tasks, where
+    I{niceness} is that of the next task in the series, and it is dispatched
+    from until its credit drops below one task. Any fractional credit is
+    carried over to the next turn, so a series with niceness N+10 is run at
+    exactly half the rate of a series with niceness N, and the quantum never
+    drops below one task. Within a series, tasks are run in the order they
+    were queued except that a lower niceness gets a task run sooner.
+
+    Tasks with a priority of L{PRIORITY_NEXT} or L{PRIORITY_LAST} bypass the
+    rotation to be run before or after everything else, respectively. A
+    C{None} item, which signals shutdown, is only returned after all tasks
+    have been.
+
+    All operations take constant or (within a series) logarithmic time,
+    regardless of how many series are queued up.
+    """
+    quantum = 4.0
+    
+    def __init__(self):
+        self.pendingGetCalls = deque()
+        self.series = {}
+        self._active = deque()
+        self._next = deque()
+        self._last = deque()
+        self._stops = 0
+        self._count = 0
+        self._serial = 0
+        self._weights = dict(
+            [(n, self.quantum * 2**(-n/10.0)) for n in xrange(-20, 21)])
+
+    def __len__(self):
+        return self._count + self._stops
+
+    def put(self, item):
+        """
+        Adds the supplied task I{item} to the queue, firing the oldest getter
+        deferred if any L{get} calls are pending.
+        """
+        if item is None:
+            self._stops += 1
+        elif item.priority <= PRIORITY_NEXT:
+            self._next.append(item)
+            self._count += 1
+        elif item.priority >= PRIORITY_LAST:
+            self._last.append(item)
+            self._count += 1
+        else:
+            self._serial += 1
+            series = self.series.get(item.series, None)
+            if series is None:
+                series = self.series[item.series] = _Series()
+                self._active.append(item.series)
+            heapq.heappush(series.heap, (item.niceness, self._serial, item))
+            self._count += 1
+        self._fireWaiter()
+
+    def _pop(self):
+        if self._next:
+            self._count -= 1
+            return self._next.popleft()
+        if self._active:
+            self._count -= 1
+            return self._popActive()
+        if self._last:
+            self._count -= 1
+            return self._last.popleft()
+        self._stops -= 1
+        return None
+
+    def _popActive(self):
+        """
+        Pops the next task from the series whose turn it is in the rotation,
+        crediting series with their quanta as their turns come up.
+        """
+        active = self._active
+        while True:
+            ID = active[0]
+            series = self.series[ID]
+            if series.deficit >= 1.0:
+                break
+            # Start of this series' turn
+            series.deficit += self._weights[series.heap[0][0]]
+            if series.deficit >= 1.0:
+                break
+            active.rotate(-1)
+        series.deficit -= 1.0
+        task = heapq.heappop(series.heap)[2]
+        if not series.heap:
+            # An idle series doesn't get to bank credit
+            del self.series[ID]
+            active.popleft()
+        elif series.deficit < 1.0:
+            # End of this series' turn
+            active.rotate(-1)
+        return task
+
+
+class Histogram(object):
+    """
+    I count recorded durations in log-linear buckets, in the manner of an HDR
+    histogram, so that percentiles can be estimated to within a fixed
+    relative precision using a fixed, small amount of memory no matter how
+    many values are recorded.
+
+    Durations are recorded in seconds and bucketed in integer microseconds.
+    Values below C{2**subBits} microseconds get a bucket each, and each
+    power-of-two range above that is divided into C{2**(subBits-1)} buckets,
+    giving a relative precision of C{2**(1-subBits)}, 12.5% by default.
+    Durations of more than C{2**maxBits} microseconds (about 19 hours by
+    default) are counted in the topmost bucket.
+
+    Only buckets with counts in them take up any memory.
+    
+    """
+    def __init__(self, subBits=4, maxBits=36):
+        self.subBits = subBits
+        self.maxValue = 2**maxBits - 1
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _index(self, value):
+        """
+        Returns the index of the bucket for the integer I{value}.
+        """
+        e = value.bit_length() - self.subBits
+        if e <= 0:
+            return value
+        return (e << (self.subBits-1)) + (value >> e)
+
+    def _value(self, index):
+        """
+        Returns the smallest integer value that is counted in the bucket with
+        the specified I{index}.
+        """
+        half = 1 << (self.subBits-1)
+        if index < 2*half:
+            return index
+        e = (index >> (self.subBits-1)) - 1
+        return (half + (index & (half-1))) << e
+
+    def record(self, seconds):
+        """
+        Records a duration of the specified number of I{seconds}.
+        """
+        value = min(int(seconds * 1000000), self.maxValue)
+        index = self._index(max(0, value))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """
+        Returns an estimate of the duration, in seconds, that I{p} percent of
+        the recorded durations are no greater than, or zero if nothing has
+        been recorded.
+        """
+        if not self.count:
+            return 0.0
+        if p >= 100:
+            return self.max
+        threshold = p * self.count / 100.0
+        running = 0
+        for index in sorted(self.counts):
+            running += self.counts[index]
+            if running >= threshold:
+                break
+        return min(1E-6 * self._value(index), self.max)
+
+    def summary(self):
+        """
+        Returns a C{dict} summarizing the recorded durations with their
+        I{count}, I{mean}, I{max}, and the 50th, 90th and 99th percentiles as
+        I{p50}, I{p90} and I{p99}.
+        """
+        if self.count:
+            mean = self.total / self.count
+        else:
+            mean = 0.0
+        result = {'count':self.count, 'mean':mean, 'max':self.max}
+        for p in (50, 90, 99):
+            result['p%d' % p] = self.percentile(p)
+        return result
+
+
+class _Stats(object):
     """
-    B{Not Tested!}
+    I keep the queue depth and histograms of wait and run times for the tasks
+    of one series or niceness band.
+    """
+    __slots__ = ['depth', 'wait', 'run', 'lastActive']
+
+    def __init__(self):
+        self.depth = 0
+        self.wait = Histogram()
+        self.run = Histogram()
+        self.lastActive = time.time()
+
+    def summary(self):
+        return {'depth':self.depth,
+                'wait':self.wait.summary(), 'run':self.run.summary()}
+
+
+class QueueMetrics(object):
+    """
+    I track the current queue depth, and the wait time from enqueueing to
+    being started by a worker and the run time of each task, by task series
+    and by niceness band.
+
+    The niceness bands are -20 (for -20 to -11), -10, 0, +10 (for +10 to +19)
+    and +20.
+
+    To keep my memory fixed, I track at most I{maxSeries} series, not
+    counting those with tasks queued. When a new series would exceed that, I
+    forget the series with no tasks queued that have been idle for more than
+    I{idleTime} seconds, and then if needed the least recently active of the
+    others with no tasks queued.
+
+    A task starts when it is accepted by a worker, unless the worker sets its
+    I{startedTime} attribute when actually starting to run it, as a
+    L{BatchThreadWorker} does. Its wait and run times are recorded when it is
+    finished.
+    """
+    maxSeries = 1000
+    idleTime = 300
+
+    def __init__(self):
+        self.series = {}
+        self.bands = {}
+
+    def _stats(self, task, create=True):
+        band = (task.niceness + 20) // 10 * 10 - 20
+        seriesStats = self.series.get(task.series, None)
+        if seriesStats is None and create:
+            if len(self.series) >= self.maxSeries:
+                self._forget()
+            seriesStats = self.series[task.series] = _Stats()
+        bandStats = self.bands.get(band, None)
+        if bandStats is None:
+            bandStats = self.bands[band] = _Stats()
+        return [x for x in (seriesStats, bandStats) if x is not None]
+
+    def _forget(self):
+        """
+        Forgets the idle series to make room for new ones, down to 3/4 of
+        I{maxSeries} so that this is only done once in a while.
+        """
+        idle = [(x.lastActive, key)
+                for key, x in self.series.iteritems() if not x.depth]
+        idle.sort()
+        cutoff = time.time() - self.idleTime
+        keep = self.maxSeries * 3 // 4
+        for lastActive, key in idle:
+            if lastActive > cutoff and len(self.series) <= keep:
+                break
+            del self.series[key]
 
-    Anyone interested in using this, please feel free and send me your updates
-    to C{test_taskqueue}!
+    def queued(self, task):
+        """
+        Call this when the supplied I{task} has been queued up.
+        """
+        task.queuedTime = time.time()
+        for stats in self._stats(task):
+            stats.depth += 1
+            stats.lastActive = task.queuedTime
+
+    def started(self, task):
+        """
+        Call this when the supplied I{task} has been accepted by a worker.
+        """
+        task.acceptedTime = time.time()
+        for stats in self._stats(task, create=False):
+            stats.depth -= 1
+            stats.lastActive = task.acceptedTime
+
+    def finished(self, result, task):
+        """
+        Add this as a callback and errback to the deferred of the supplied
+        I{task}, before any others.
+        """
+        if hasattr(task, 'acceptedTime'):
+            now = time.time()
+            started = getattr(task, 'startedTime', task.acceptedTime)
+            ended = getattr(task, 'endedTime', now)
+            for stats in self._stats(task, create=False):
+                stats.wait.record(started - task.queuedTime)
+                stats.run.record(ended - started)
+                stats.lastActive = now
+        return result
+
+    def depth(self):
+        """
+        Returns the total number of tasks queued up and not yet started.
+        """
+        return sum([x.depth for x in self.series.itervalues()])
     
+    def summary(self):
+        """
+        Returns a C{dict} with the total queue I{depth} and, keyed by series
+        under I{series} and by niceness band under I{niceness}, the depth and
+        summaries of the I{wait} and I{run} time histograms. See
+        L{Histogram.summary}.
+        """
+        result = {'depth':self.depth()}
+        for name, statsDict in (('series', self.series),
+                                ('niceness', self.bands)):
+            result[name] = dict(
+                [(key, x.summary()) for key, x in statsDict.iteritems()])
+        return result
+
+
+class LoadAverageProducer(object):
+    """
+    I update my consumers periodically with an exponentially smoothed average
+    of the values from a load indicator and, for consumers that want them,
+    summaries of queue metrics.
     """
     implements(interfaces.IPushProducer)
 
     expMinusOne = 0.36787944117144233
 
-    def __init__(self, loadIndicator, updateInterval=5):
+    def __init__(self, loadIndicator, updateInterval=5, metrics=None):
+        """
+        @param loadIndicator: A callable that returns the current load, or a
+            constant load value.
+
+        @param metrics: An object whose C{summary} method returns what to
+            update consumers attached with I{withMetrics} set.
+        """
         self.loadIndicator = loadIndicator
         self.updateInterval = updateInterval
+        self.metrics = metrics
         self.consumers = []
         self.looper = task.LoopingCall(self.update)
 
-    def attachConsumer(self, consumer):
+    def attachConsumer(self, consumer, withMetrics=False):
         """
-        Gives me a new consumer to update.
+        Gives me a new consumer to update, and starts my updates if they
+        aren't running already.
+
+        If I{withMetrics} is set, the consumer will be updated with a tuple
+        containing the load average and the current summary of my metrics
+        instead of just the load average.
         """
-        if interfaces.IFinishableConsumer.providedBy(consumer):
+        if not interfaces.IConsumer.providedBy(consumer):
             msgProto = "'%s' doesn't provide "+\
-                       "twisted.internet.interfaces.IFinishableConsumer"
+                       "twisted.internet.interfaces.IConsumer"
             raise ImplementationError(msgProto % consumer)
-        consumer.registerProducer(self, False)
-        self.consumers.append(consumer)
+        consumer.registerProducer(self, True)
+        self.consumers.append((consumer, withMetrics))
+        self.resumeProducing()
 
     def resumeProducing(self):
-        if not hasattr(self, 'd'):
+        if not self.looper.running:
             self.d = self.looper.start(self.updateInterval)
-            self.d.addCallback(lambda _: delattr(self, 'd'))
 
     def pauseProducing(self):
-        if hasattr(self, 'd'):
+        if self.looper.running:
             self.looper.stop()
             return self.d
+        return defer.succeed(None)
         
     def stopProducing(self):
         dList = [self.pauseProducing()]
-        for consumer in self.consumers:
-            dList.append(defer.maybeDeferred(consumer.finish))
+        for consumer, null in self.consumers:
+            consumer.unregisterProducer()
+            finish = getattr(consumer, 'finish', None)
+            if finish is not None:
+                dList.append(defer.maybeDeferred(finish))
+        self.consumers = []
         return defer.DeferredList(dList)
 
     def update(self):
@@ -327,13 +725,19 @@ class LoadAverageProducer(object):
         if callable(self.loadIndicator):
             indicatorValue = self.loadIndicator()
         else:
-            indicatorValue = loadIndicator
+            indicatorValue = self.loadIndicator
         lastLoad = getattr(self, 'lastLoad', 0)
         thisLoad = lastLoad * self.expMinusOne + \
                    indicatorValue * (1 - self.expMinusOne)
         self.lastLoad = thisLoad
-        for consumer in self.consumers:
-            consumer.write(thisLoad)
+        summary = None
+        for consumer, withMetrics in self.consumers:
+            if withMetrics:
+                if summary is None:
+                    summary = self.metrics.summary()
+                consumer.write((thisLoad, summary))
+            else:
+                consumer.write(thisLoad)
         
 
 class _Assignment(object):
@@ -396,16 +800,36 @@ class _AssignmentFactory(object):
         assignment, and is not just wrapping up its work after having been
         fired, the worker will request another assignment when it finishes the
         task.
+
+        A worker that is ready for another task as soon as it accepts one,
+        e.g., a L{BatchThreadWorker}, will keep getting assignments from a
+        queue with a surplus of them. That's done in a loop here rather than
+        by recursion so the stack doesn't overflow.
         """
+        while self._request(worker, series):
+            pass
+
+    def _request(self, worker, series):
+        """
+        Does the work of L{request}, returning C{True} if the worker accepted
+        an assignment and was ready for another one before this method
+        returned.
+        """
+        readyNow = []
         def accept(assignment, d_get):
             worker.assignments[series].remove(d_get)
             if isinstance(assignment, _Assignment):
                 d = assignment.accept(worker)
                 if worker.hired:
-                    d.addCallback(lambda _: self.request(worker, series))
+                    if inRequest and d.called and \
+                           not isinstance(d.result, failure.Failure):
+                        readyNow.append(None)
+                    else:
+                        d.addCallback(lambda _: self.request(worker, series))
                 return d
 
         queue = self.getQueue(series)
+        inRequest = True
         d = queue.get()
         assignments = getattr(worker, 'assignments', {})
         assignments.setdefault(series, []).append(d)
@@ -415,6 +839,8 @@ class _AssignmentFactory(object):
         # callback will be able to remove the deferred even if the deferred
         # fires immediately due to the queue having a surplus of assignments.
         d.addCallback(accept, d)
+        inRequest = False
+        return bool(readyNow)
 
     def new(self, task):
         """
@@ -541,8 +967,10 @@ class TaskQueue(object):
         self._sessionAttributeNames = []
         self._taskFactory = _TaskFactory()
         self._mgr = WorkerManager()
-        self._heap = Priority()
-        self._loadAverageProducer = LoadAverageProducer(self._heap.heap)
+        self._heap = Scheduler()
+        self._metrics = QueueMetrics()
+        self._loadAverageProducer = LoadAverageProducer(
+            self._heap.__len__, metrics=self._metrics)
         for worker in args:
             self.attachWorker(worker)
         self._startup()
@@ -571,6 +999,7 @@ class TaskQueue(object):
                     return
                 wfd = defer.waitForDeferred(self._mgr.assignment(task))
                 yield wfd
+                self._metrics.started(task)
 
         if hasattr(self, '_alreadyStarted'):
             raise QueueRunError("Startup only occurs upon instantiation")
@@ -589,14 +1018,15 @@ class TaskQueue(object):
     
     def shutdown(self):
         """
-        Initiates a shutdown of the queue by putting a lowest-possible priority
-        C{None} object onto the priority heap instead of a task.
+        Initiates a shutdown of the queue by putting a C{None} object onto the
+        scheduler instead of a task, to be dispatched after all others.
 
         @return: A deferred that fires when the queue has been flushed of all
             pending tasks and all the workers have shut down.
         
         """
         def cleanup(null):
+            self._loadAverageProducer.stopProducing()
             for attrName in self._sessionAttributeNames:
                 if hasattr(self, attrName):
                     object.__delattr__(self, attrName)
@@ -643,8 +1073,8 @@ class TaskQueue(object):
         priority.
 
         Tasks in a series of tasks all having niceness N+10 are dequeued and
-        run at approximately half the rate of tasks in another series with
-        niceness N.
+        run at half the rate of tasks in another series with niceness N. See
+        L{Scheduler}.
         
         @keyword niceness: Scheduling niceness, an integer between -20 and 20,
             with lower numbers having higher scheduling priority as in UNIX
@@ -672,18 +1102,33 @@ class TaskQueue(object):
         series = kw.pop('series', None)
         task = self._taskFactory.new(func, args, kw, niceness, series)
         if kw.pop('doNext', False):
-            task.priority = -1000000
+            task.priority = PRIORITY_NEXT
         elif kw.pop('doLast', False):
-            task.priority = 1000000
+            task.priority = PRIORITY_LAST
+        self._metrics.queued(task)
+        task.d.addBoth(self._metrics.finished, task)
         self._heap.put(task)
         return task.d
 
-    def loadAverage(self, consumer):
+    def loadAverage(self, consumer, withMetrics=False):
         """
         Registers I{consumer} to receive updates on the current queue load
         average.
+
+        @param withMetrics: Set C{True} to have the consumer updated with a
+            tuple containing the load average and the current summary of queue
+            metrics instead. See L{metrics}.
+        """
+        self._loadAverageProducer.attachConsumer(consumer, withMetrics)
+
+    def metrics(self):
+        """
+        Returns a C{dict} with the current depth of the queue and, by task
+        series and by niceness band, the depth and histogram summaries of how
+        long tasks waited in the queue before a worker started them and how
+        long they took to run. See L{QueueMetrics.summary}.
         """
-        self._loadAverageProducer.attachConsumer(consumer)
+        return self._metrics.summary()
 
 
 #--- Implementation of a thread queue follows ---------------------------------
@@ -757,16 +1202,166 @@ class ThreadWorker:
             return d
 
 
+class BatchThreadWorker(ThreadWorker):
+    """
+    I am a L{ThreadWorker} that runs tasks in batches, for when the tasks are
+    so quick that the per-task overhead of cross-thread signaling is larger
+    than the work itself.
+
+    While my thread is idle, I accept tasks without waiting on it, collecting
+    them into a batch that I hand over to the thread once it has
+    I{batchSize} tasks or at the end of the current reactor iteration,
+    whichever comes first. My thread wakes up once per batch, runs its tasks
+    in the order they were assigned, and delivers all of their results with
+    a single C{reactor.callFromThread}.
+
+    While my thread is busy with a batch, I accept no more than one task, so
+    the rest stay in the scheduler and are only pulled, in its order, when
+    the batch is delivered.
+    """
+    def __init__(self, batchSize=100):
+        self.batchSize = batchSize
+        self.cv = threading.Condition()
+        # Tasks accepted for the next batch, only touched in the main thread
+        self.pending = []
+        # The batch handed over to the thread and not yet picked up
+        self.batch = None
+        self.busy = False
+        self.stopping = False
+        self.quitting = False
+        self.d = None
+        self.flushCall = None
+        self.endWaiters = []
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.start()
+
+    def _loop(self):
+        """
+        Runs a loop in a dedicated thread that waits for batches of tasks and
+        runs them. The loop exits when told to by L{_flush} after
+        L{shutdown} has been called and no tasks are left.
+        """
+        while True:
+            self.cv.acquire()
+            while self.batch is None and not self.quitting:
+                self.cv.wait()
+            batch, self.batch = self.batch, None
+            self.cv.release()
+            if batch is None:
+                break
+            results = []
+            for task in batch:
+                f, args, kw = task.callTuple
+                # For the queue metrics, since the task was accepted before
+                # being run
+                task.startedTime = time.time()
+                try:
+                    result = f(*args, **kw)
+                except Exception, e:
+                    results.append((task.d.errback, failure.Failure(e)))
+                else:
+                    results.append((task.d.callback, result))
+                task.endedTime = time.time()
+            reactor.callFromThread(self._deliver, results)
+        # Broken out of loop, ready for the thread to end
+        reactor.callFromThread(self._ended)
+
+    def _flush(self):
+        """
+        Hands my pending tasks over to my thread as a batch, or tells the
+        thread to quit if I'm stopping and have none left.
+        """
+        if self.flushCall is not None:
+            if self.flushCall.active():
+                self.flushCall.cancel()
+            self.flushCall = None
+        if self.busy:
+            return
+        self.cv.acquire()
+        if self.pending:
+            self.batch, self.pending = self.pending, []
+            self.busy = True
+        elif self.stopping:
+            self.quitting = True
+        else:
+            self.cv.release()
+            return
+        self.cv.notify()
+        self.cv.release()
+
+    def _deliver(self, results):
+        """
+        Fires the deferreds of a batch of tasks with their results, then fires
+        the deferred returned by L{run} if I was waiting for the batch to be
+        done, which pulls the tasks for my next batch from the scheduler.
+        """
+        self.busy = False
+        for callback, result in results:
+            callback(result)
+        if self.d is not None:
+            d, self.d = self.d, None
+            d.callback(None)
+        if self.pending or self.stopping:
+            self._flush()
+
+    def _ended(self):
+        self.thread.join()
+        while self.endWaiters:
+            self.endWaiters.pop(0).callback(None)
+
+    def run(self, task):
+        """
+        See L{IWorker.run}. Adds the task to my pending batch.
+
+        @return: A deferred that fires right away if my thread is idle and my
+            batch isn't full yet, or else when my thread has delivered the
+            results of the batch it is running.
+        
+        """
+        if self.d is not None or self.stopping:
+            raise ImplementationError(
+                "Task Loop not ready to deal with a task now")
+        self.pending.append(task)
+        if not self.busy and len(self.pending) >= self.batchSize:
+            self._flush()
+        if self.busy:
+            self.d = defer.Deferred()
+            return self.d
+        if self.flushCall is None:
+            self.flushCall = reactor.callLater(0, self._flush)
+        return defer.succeed(None)
+
+    def shutdown(self):
+        """
+        See L{IWorker.shutdown}. The returned deferred fires when all pending
+        tasks have been run and my thread has terminated.
+        """
+        if not self.thread.isAlive():
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.endWaiters.append(d)
+        if not self.stopping:
+            self.stopping = True
+            self._flush()
+        return d
+
+
 class ThreadQueue(TaskQueue):
     """
     I am a task queue for dispatching arbitrary callables to be run by workers
     from a pool of I{N} worker threads, the number I{N} being specified as the
-    sole argument of my constructor.
+    first argument of my constructor.
+
+    If a I{batchSize} is specified, my workers are L{BatchThreadWorker}
+    instances that run up to that many tasks per cross-thread round trip.
     """
-    def __init__(self, N):
+    def __init__(self, N, batchSize=None):
         TaskQueue.__init__(self)
         for null in xrange(N):
-            worker = ThreadWorker()
+            if batchSize:
+                worker = BatchThreadWorker(batchSize)
+            else:
+                worker = ThreadWorker()
             self.attachWorker(worker)
 
 
@@ -796,6 +1391,314 @@ def deferToOneThread(func, *args, **kw):
     kw['series'] = None
     return _oneThreadQueue.task(func, *args, **kw)
 
+
+#--- Implementation of a process queue follows --------------------------------
+
+class ProcessError(Exception):
+    """
+    A task could not be run by a L{ProcessWorker} or its result could not be
+    obtained from the worker's child process.
+    """
+
+
+def _childLoop():
+    """
+    Runs the task loop of a L{ProcessWorker} child process, reading pickled
+    call tuples from stdin and writing pickled C{(success, result)} tuples to
+    what was stdout. Each pickle is preceded by its length as a 4-byte
+    unsigned integer in network byte order.
+
+    Anything the tasks print to stdout goes to stderr instead, so that it
+    doesn't get mixed up with the results. The loop exits when stdin is
+    closed.
+    """
+    inFile = sys.stdin
+    outFile = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    while True:
+        header = inFile.read(4)
+        if len(header) < 4:
+            break
+        N = struct.unpack('!I', header)[0]
+        data = inFile.read(N)
+        try:
+            f, args, kw = pickle.loads(data)
+        except Exception, e:
+            # The callable may not be importable here, being defined in the
+            # parent's __main__ for instance
+            response = (False, ProcessError("Couldn't unpickle task: %s" % e))
+        else:
+            try:
+                response = (True, f(*args, **kw))
+            except Exception, e:
+                response = (False, e)
+        try:
+            data = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            data = pickle.dumps((False, ProcessError(
+                "Couldn't pickle result %r: %s" % (response[1], e))))
+        outFile.write(struct.pack('!I', len(data)) + data)
+        outFile.flush()
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+    """
+    I talk to the child process of a L{ProcessWorker}, unframing the pickled
+    responses it sends back.
+    """
+    def __init__(self, worker):
+        self.worker = worker
+        self.chunks = []
+        self.bufferSize = 0
+        self.responseSize = None
+
+    def outReceived(self, data):
+        self.chunks.append(data)
+        self.bufferSize += len(data)
+        while True:
+            if self.responseSize is None:
+                if self.bufferSize < 4:
+                    break
+                self._join()
+                self.responseSize = struct.unpack('!I', self.chunks[0][:4])[0]
+                self.chunks[0] = self.chunks[0][4:]
+                self.bufferSize -= 4
+            if self.bufferSize < self.responseSize:
+                break
+            self._join()
+            buffer, N = self.chunks[0], self.responseSize
+            self.chunks = [buffer[N:]]
+            self.bufferSize -= N
+            self.responseSize = None
+            self.worker.gotResponse(pickle.loads(buffer[:N]))
+
+    def _join(self):
+        # Received data is only joined up when a full header or response is
+        # there to be parsed, to avoid copying big results over and over
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+
+    def errReceived(self, data):
+        log.msg("ProcessWorker child %s: %s" % (self.transport.pid, data))
+
+    def processEnded(self, reason):
+        self.worker.ended(reason)
+
+
+class ProcessWorker(object):
+    """
+    I implement an L{IWorker} that runs tasks in a dedicated, long-lived child
+    Python process, so that CPU-bound tasks don't contend for the GIL of the
+    reactor's process.
+
+    Tasks are sent to the child as pickled call tuples over its stdin and the
+    results come back pickled over its stdout, with the reactor doing all the
+    pipe I/O. The callable, arguments, keywords and result of each task must
+    therefore be picklable, and the callable must be importable by the child
+    process, which gets the same C{sys.path} as its parent.
+
+    I run one task at a time, and am not ready for another one until the
+    result of the current task has been obtained.
+
+    If my child process ends other than by my L{shutdown}, a task having
+    crashed it for instance, I spawn a new one. I don't if it ended before
+    running any task, as it would most likely fail the same way again.
+
+    @ivar process: The L{IProcessTransport} for my child process.
+
+    @ivar pid: The process ID of my child process, kept after it has ended.
+    
+    """
+    implements(IWorker)
+
+    def __init__(self, executable=None):
+        """
+        @param executable: The Python interpreter to run the child process
+            with, defaulting to the one running the reactor.
+        """
+        if executable is None:
+            executable = sys.executable
+        self.executable = executable
+        self.task = None
+        self.d = None
+        self.isRunning = True
+        self.stopping = False
+        self.endWaiters = []
+        self._spawn()
+
+    def _spawn(self):
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        args = [self.executable, '-c',
+                'from %s import _childLoop; _childLoop()' % __name__]
+        self.tasksRun = 0
+        self.process = reactor.spawnProcess(
+            _WorkerProtocol(self), self.executable, args, env=env)
+        # The transport forgets the pid once the process has ended
+        self.pid = self.process.pid
+
+    def run(self, task):
+        """
+        See L{IWorker.run}. Writes the task's call tuple to the child process.
+
+        @return: A deferred that fires when the task's result has been
+            obtained and I am ready for another task.
         
-        
-        
+        """
+        if self.task is not None:
+            raise ImplementationError(
+                "Task Loop not ready to deal with a task now")
+        if not self.isRunning:
+            task.d.errback(failure.Failure(
+                ProcessError("Worker process has ended")))
+            return defer.succeed(None)
+        try:
+            data = pickle.dumps(task.callTuple, pickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            task.d.errback(failure.Failure(
+                ProcessError("Couldn't pickle %r: %s" % (task, e))))
+            return defer.succeed(None)
+        self.task = task
+        self.d = defer.Deferred()
+        self.process.write(struct.pack('!I', len(data)) + data)
+        return self.d
+
+    def gotResponse(self, response):
+        """
+        Called by my process protocol with the unpickled C{(success, result)}
+        response to the current task.
+        """
+        task, d = self.task, self.d
+        self.task = self.d = None
+        self.tasksRun += 1
+        success, result = response
+        if success:
+            task.d.callback(result)
+        else:
+            task.d.errback(failure.Failure(result))
+        d.callback(None)
+
+    def ended(self, reason):
+        """
+        Called by my process protocol when the child process has ended,
+        whether expectedly or not.
+        """
+        if self.stopping:
+            self.isRunning = False
+        elif self.task is not None or self.tasksRun:
+            log.msg("ProcessWorker child %s ended unexpectedly (%s), "
+                    "spawning a new one" % (
+                        self.pid, reason.getErrorMessage()))
+            # Spawned before failing the current task, so that the next one
+            # goes to the new child
+            self._spawn()
+        else:
+            log.msg("ProcessWorker child ended before running any task: %s"
+                    % reason.getErrorMessage())
+            self.isRunning = False
+        if self.task is not None:
+            msg = "Worker process ended while running %r" % self.task
+            self.gotResponse((False, ProcessError(msg)))
+        while self.endWaiters:
+            self.endWaiters.pop(0).callback(None)
+    
+    def shutdown(self):
+        """
+        See L{IWorker.shutdown}. Closes the child's stdin after any current
+        task is done, returning a deferred that fires when the child process
+        has ended.
+        """
+        if not self.isRunning:
+            return defer.succeed(None)
+        self.stopping = True
+        d = defer.Deferred()
+        if self.d is not None:
+            self.d.addCallback(lambda _: self.shutdown().chainDeferred(d))
+        else:
+            if not self.endWaiters:
+                self.process.closeStdin()
+            self.endWaiters.append(d)
+        return d
+
+
+class ProcessQueue(TaskQueue):
+    """
+    I am a task queue for dispatching arbitrary picklable callables to be run
+    by workers from a pool of I{N} worker processes, the number I{N} being
+    specified as the sole argument of my constructor.
+    """
+    def __init__(self, N):
+        TaskQueue.__init__(self)
+        for null in xrange(N):
+            worker = ProcessWorker()
+            self.attachWorker(worker)
+
+
+#--- Benchmarks follow --------------------------------------------------------
+
+def benchmarkScheduler(N=1000000, M=10000, QueueClass=Scheduler):
+    """
+    Enqueues I{N} tasks spread over I{M} series with niceness values from -20
+    to +20 in an instance of I{QueueClass}, then gets them all back out.
+
+    @return: A tuple with the rates of enqueueing and dispatching, in tasks
+        per second.
+    
+    """
+    tf = _TaskFactory()
+    f = lambda : None
+    tasks = [tf.new(f, (), {}, (k % 41) - 20, k % M) for k in xrange(N)]
+    queue = QueueClass()
+    t0 = time.time()
+    for task in tasks:
+        queue.put(task)
+    t1 = time.time()
+    results = []
+    for null in xrange(N):
+        queue.get().addCallback(results.append)
+    t2 = time.time()
+    assert len(results) == N
+    return N / (t1 - t0), N / (t2 - t1)
+
+
+def benchmarkThreadQueue(N=100000, batchSize=None):
+    """
+    Runs I{N} trivial tasks through a L{ThreadQueue} with one worker thread,
+    batching them if a I{batchSize} is specified.
+
+    @return: A deferred that fires with the rate of running the tasks, in tasks
+        per second.
+    
+    """
+    def done(null):
+        rate = N / (time.time() - t0)
+        return queue.shutdown().addCallback(lambda _: rate)
+
+    queue = ThreadQueue(1, batchSize)
+    f = lambda x: x
+    t0 = time.time()
+    d = defer.DeferredList([queue.call(f, k) for k in xrange(N)])
+    d.addCallback(done)
+    return d
+
+
+if __name__ == '__main__':
+    N, M = [int(x) for x in (sys.argv[1:] + ['1000000', '10000'])[:2]]
+    print "Queueing %d tasks in %d series..." % (N, M)
+    for QueueClass in (Scheduler, Priority):
+        putRate, getRate = benchmarkScheduler(N, M, QueueClass)
+        print "%-10s put: %10.0f tasks/sec, dispatch: %10.0f tasks/sec" % (
+            QueueClass.__name__, putRate, getRate)
+
+    def threadBenchmarks():
+        print "Running %d tasks in one thread..." % (N/10)
+        for batchSize in (None, 10, 100, 1000):
+            wfd = defer.waitForDeferred(benchmarkThreadQueue(N/10, batchSize))
+            yield wfd
+            print "batchSize %-5s run: %10.0f tasks/sec" % (
+                batchSize, wfd.getResult())
+        reactor.stop()
+
+    reactor.callWhenRunning(defer.deferredGenerator(threadBenchmarks))
+    reactor.run()
@@ -37,6 +37,7 @@ functions of synchronous libraries.
 
 # Imports
 import copy, heapq, threading, sys
+from collections import deque
 from twisted.python.failure import Failure
 from twisted.internet import defer, reactor, task
 
@@ -49,6 +50,9 @@ class InvalidMethodError(Exception):
 
 class ShutdownError(Exception):
     pass
+
+class BacklogFullError(Exception):
+    pass
         
 
 class Task(object):
@@ -329,6 +333,15 @@ class SynchronousQueue(object):
         @param doLast: Set C{True} to assign lower possible priority, even
             lower than with niceness = 20.
         
+        """
+        task = self._task(func, args, kw)
+        self._queue.put(task)
+        return task.d
+
+    def _task(self, func, args, kw):
+        """
+        Checks that a call to L{deferToQueue} can be made now and returns a new
+        L{Task} for it, popping any scheduling keywords from I{kw}.
         """
         # Weed out illegal calls
         if self.whereRunning() != 'outside':
@@ -346,9 +359,7 @@ class SynchronousQueue(object):
             niceness = -21
         elif kw.pop('doLast', False):
             niceness = 21
-        task = Task(func, args, kw, niceness)
-        self._queue.put(task)
-        return task.d
+        return Task(func, args, kw, niceness)
 
     def blockDeferred(self, func, *args, **kw):
         """
@@ -385,3 +396,183 @@ class SynchronousQueue(object):
 
 
         
+
+
+class SynchronousPool(SynchronousQueue):
+    """
+    I am a L{SynchronousQueue} that dispatches tasks to a pool of persistent
+    threads instead of just one. I'm useful for running API functions of a
+    synchronous library that isn't thread-safe for calls involving the same
+    object, e.g., a database connection or other handle, but can work on
+    different objects in parallel.
+
+    Each task is dispatched with a hashable I{key} identifying the object it
+    works on. Tasks with the same key are run one at a time, in order of their
+    scheduling priority, by whichever of my threads is free. Tasks with
+    different keys are run in parallel.
+
+    No more than I{maxBacklog} tasks are admitted to my queue until they are
+    done. Calls to L{deferToQueue} beyond that are held back, in the order
+    they were made, and their deferreds don't fire until capacity frees up
+    for them to be admitted and run. No more than I{maxHeld} calls are held
+    back that way; further calls raise a L{BacklogFullError} right away.
+    """
+    def __init__(self, N=4, maxBacklog=1000, maxHeld=10000):
+        SynchronousQueue.__init__(self)
+        self._N = N
+        self._maxBacklog = maxBacklog
+        self._maxHeld = maxHeld
+        self._cv = threading.Condition()
+        # A heap of (priority, task) tuples for each key with pending tasks
+        self._keys = {}
+        # A heap of (priority, key) tuples for keys with no task running
+        self._ready = []
+        self._held = deque()
+        self._backlog = 0
+        self._stopping = False
+        self._terminator = None
+
+    def startup(self):
+        """
+        Starts a new session of my pool of threads. See
+        L{SynchronousQueue.startup}.
+        """
+        if hasattr(self, '_triggerID'):
+            d = defer.succeed(None)
+        else:
+            self._triggerID = reactor.addSystemEventTrigger(
+                'before', 'shutdown', self.shutdown)
+            self._stopping = False
+            self._threads = []
+            for null in xrange(self._N):
+                thread = EigenThread(group=None, target=self._workOnTasks)
+                self._threads.append(thread)
+                thread.start()
+            d = self.deferToQueue(lambda : None)
+        return d
+
+    def _workOnTasks(self):
+        """
+        The synchronous queue-checker and task-runner loop of each thread in
+        the pool.
+        """
+        self._TLS.where = 'inside'
+        cv = self._cv
+        cv.acquire()
+        while True:
+            while not self._ready and not self._stopping:
+                cv.wait()
+            if not self._ready:
+                break
+            key = heapq.heappop(self._ready)[1]
+            tasks = self._keys[key]
+            task = heapq.heappop(tasks)[1]
+            cv.release()
+            task.run()
+            cv.acquire()
+            if tasks:
+                heapq.heappush(self._ready, (tasks[0][0], key))
+                cv.notify()
+            else:
+                del self._keys[key]
+        cv.release()
+
+    def _admit(self, key, task):
+        """
+        Puts the supplied I{task} into my queue under the supplied I{key}.
+        """
+        self._backlog += 1
+        self._cv.acquire()
+        tasks = self._keys.get(key, None)
+        if tasks is None:
+            # No task for this key is pending or running, so it's ready
+            tasks = self._keys[key] = []
+            heapq.heappush(self._ready, (task.priority, key))
+            self._cv.notify()
+        heapq.heappush(tasks, (task.priority, task))
+        self._cv.release()
+
+    def _taskDone(self, result):
+        """
+        Callback and errback for every admitted task, run in the main thread,
+        that admits the next held task or the terminator if there's room for
+        it now.
+        """
+        self._backlog -= 1
+        if self._held:
+            self._admit(*self._held.popleft())
+        elif self._terminator is not None and self._backlog == 0:
+            task, self._terminator = self._terminator, None
+            self._admit(None, task)
+        return result
+
+    def deferToQueue(self, func, *args, **kw):
+        """
+        Dispatches I{callable(*args, **kw)} as a task to my pool, returning a
+        C{Deferred} to its eventual result. Supports the same scheduling
+        keywords as L{SynchronousQueue.deferToQueue}, plus I{key}.
+
+        @param key: A hashable object identifying the task's series of calls
+            that must not run concurrently with each other. The default is
+            C{None}.
+
+        @raise BacklogFullError: If my backlog is full and I{maxHeld} calls
+            are already being held back.
+        
+        """
+        if hasattr(self, '_shutdownDeferred') and \
+               not self._shutdownDeferred.called:
+            raise InvalidMethodError(
+                "Can't call while the queue is shutting down")
+        if self._backlog >= self._maxBacklog and \
+               len(self._held) >= self._maxHeld:
+            raise BacklogFullError(
+                "Backlog of %d tasks is full and %d more are held back" \
+                % (self._backlog, len(self._held)))
+        key = kw.pop('key', None)
+        task = self._task(func, args, kw)
+        task.d.addBoth(self._taskDone)
+        if self._backlog < self._maxBacklog:
+            self._admit(key, task)
+        else:
+            self._held.append((key, task))
+        return task.d
+
+    def shutdown(self, terminatorFunction=None):
+        """
+        Shuts down the pool, returning a C{Deferred} that fires when all
+        queued and held tasks are done and the shutdown is complete.
+        """
+        def terminate():
+            if callable(terminatorFunction):
+                terminatorFunction()
+            self._sessionAttributes.clear()
+
+        def cleanup(result):
+            self._backlog -= 1
+            self._cv.acquire()
+            self._stopping = True
+            self._cv.notifyAll()
+            self._cv.release()
+            for thread in self._threads:
+                thread.join()
+            if hasattr(self, '_triggerID'):
+                reactor.removeSystemEventTrigger(self._triggerID)
+                del self._triggerID
+            return result
+
+        if not hasattr(self, '_triggerID'):
+            d = defer.succeed(None)
+        elif hasattr(self, '_shutdownDeferred') and \
+                 not self._shutdownDeferred.called:
+            d = defer.Deferred()
+            self._shutdownDeferred.chainDeferred(d)
+        else:
+            terminatorTask = Task(terminate, (), {}, 0, terminator=True)
+            d = self._shutdownDeferred = terminatorTask.d
+            d.addBoth(cleanup)
+            if self._backlog == 0:
+                self._admit(None, terminatorTask)
+            else:
+                self._terminator = terminatorTask
+        return d
@@ -33,9 +33,10 @@
 Unit tests for taskqueue
 """
 
-import copy, time, random, threading
+import os, copy, time, random, threading, operator
 import zope.interface
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, interfaces
+from twisted.python import log
 from twisted.trial.unittest import TestCase
 
 import sasync.taskqueue as taskqueue
@@ -312,6 +313,215 @@ class TestPriorityPipelining(TestCase):
         return d
 
 
+class TestScheduler(TestCase):
+    def setUp(self):
+        self.scheduler = taskqueue.Scheduler()
+        self.tf = taskqueue._TaskFactory()
+
+    def _put(self, name, niceness=0, series=None):
+        task = self.tf.new(name, (), {}, niceness, series)
+        self.scheduler.put(task)
+        return task
+
+    def _getAll(self):
+        names = []
+        def gotTask(task):
+            if task is None:
+                names.append(None)
+            else:
+                names.append(task.callTuple[0])
+        while len(self.scheduler):
+            self.scheduler.get().addCallback(gotTask)
+        return names
+
+    def _counts(self, N, nicenessA, nicenessB):
+        for null in xrange(N):
+            self._put('A', nicenessA, 'A')
+            self._put('B', nicenessB, 'B')
+        names = self._getAll()[:N]
+        return names.count('A'), names.count('B')
+
+    def testOneSeriesFIFO(self):
+        for char in 'abcd':
+            self._put(char)
+        self.failUnlessEqual(self._getAll(), list('abcd'))
+
+    def testOneSeriesNicenessFirst(self):
+        for char in 'abc':
+            self._put(char)
+        self._put('d', -5)
+        self.failUnlessEqual(self._getAll(), list('dabc'))
+
+    def testSeriesInterleaved(self):
+        for char in 'abc':
+            self._put(char, 0, 1)
+        for char in 'xyz':
+            self._put(char, 0, 2)
+        self.failUnlessEqual(self._getAll(), list('abcxyz'))
+        for char in 'abcdef':
+            self._put(char, 0, 1)
+        for char in 'uvwxyz':
+            self._put(char, 0, 2)
+        self.failUnlessEqual(self._getAll(), list('abcduvwxefyz'))
+
+    def testNicenessHalfRate(self):
+        self.failUnlessEqual(self._counts(300, 0, 10), (200, 100))
+
+    def testNicenessQuarterRate(self):
+        self.failUnlessEqual(self._counts(500, 0, 20), (400, 100))
+
+    def testNicenessDoubleRate(self):
+        self.failUnlessEqual(self._counts(300, 0, -10), (100, 200))
+
+    def testNextAndLast(self):
+        self._put('a')
+        task = self.tf.new('b', (), {}, 0)
+        task.priority = taskqueue.PRIORITY_LAST
+        self.scheduler.put(task)
+        self._put('c')
+        self.scheduler.put(None)
+        task = self.tf.new('d', (), {}, 0, 'other')
+        task.priority = taskqueue.PRIORITY_NEXT
+        self.scheduler.put(task)
+        self.failUnlessEqual(self._getAll(), ['d', 'a', 'c', 'b', None])
+
+    def testWaitersFIFO(self):
+        results = []
+        for null in xrange(3):
+            self.scheduler.get().addCallback(results.append)
+        tasks = [self._put(char) for char in 'abc']
+        self.failUnlessEqual(results, tasks)
+
+    def testShutdownWaiters(self):
+        d = self.scheduler.get()
+        self.scheduler.shutdown()
+        return self.failUnlessFailure(d, taskqueue.QueueRunError)
+
+
+class TestHistogram(TestCase):
+    def setUp(self):
+        self.h = taskqueue.Histogram()
+
+    def testEmpty(self):
+        self.failUnlessEqual(self.h.percentile(50), 0.0)
+        self.failUnlessEqual(self.h.summary()['count'], 0)
+
+    def testBucketsRoundTrip(self):
+        previous = -1
+        for value in xrange(100000):
+            index = self.h._index(value)
+            self.failUnless(index >= previous)
+            lower = self.h._value(index)
+            self.failUnless(lower <= value)
+            self.failUnless(value - lower <= value / 8)
+            previous = index
+
+    def testPercentiles(self):
+        for k in xrange(1, 1001):
+            self.h.record(0.001 * k)
+        for p in (50, 90, 99):
+            estimate = self.h.percentile(p)
+            self.failUnless(
+                abs(estimate - p/100.0) <= p/800.0,
+                "p%d estimate %f off" % (p, estimate))
+        self.failUnlessEqual(self.h.percentile(100), 1.0)
+        summary = self.h.summary()
+        self.failUnlessEqual(summary['count'], 1000)
+        self.failUnlessAlmostEqual(summary['mean'], 0.5005)
+
+    def testFixedMemory(self):
+        for k in xrange(100000):
+            self.h.record(random.expovariate(1.0))
+        self.failUnless(len(self.h.counts) < 300)
+
+
+class TestQueueMetrics(TestCase):
+    def setUp(self):
+        self.queue = taskqueue.TaskQueue()
+
+    def tearDown(self):
+        return self.queue.shutdown()
+
+    def testDepthAndTimes(self):
+        def finished(null):
+            metrics = self.queue.metrics()
+            self.failUnlessEqual(metrics['depth'], 0)
+            self.failUnlessEqual(metrics['series']['A']['run']['count'], 2)
+            self.failUnlessEqual(metrics['niceness'][10]['wait']['count'], 2)
+            self.failUnless(metrics['series']['B']['wait']['max'] >= 0.05)
+            self.failUnless(metrics['series']['A']['run']['p50'] >= 0.04)
+
+        dList = []
+        for series, niceness in (('A', 0), ('A', 0), ('B', 10), ('B', 15)):
+            dList.append(self.queue.call(
+                lambda : None, series=series, niceness=niceness))
+        metrics = self.queue.metrics()
+        self.failUnlessEqual(metrics['depth'], 4)
+        self.failUnlessEqual(metrics['series']['A']['depth'], 2)
+        self.failUnlessEqual(metrics['niceness'][0]['depth'], 2)
+        self.failUnlessEqual(metrics['niceness'][10]['depth'], 2)
+        self.failUnlessEqual(metrics['niceness'][10]['run']['count'], 0)
+        worker = MockWorker(0.05)
+        worker.iQualified = ['A', 'B']
+        self.queue.attachWorker(worker)
+        return defer.DeferredList(dList).addCallback(finished)
+
+    def testSeriesForgotten(self):
+        def finished(null):
+            series = self.queue.metrics()['series']
+            self.failUnless(len(series) <= 10)
+            self.failUnlessEqual(series[50]['run']['count'], 1)
+
+        self.queue._metrics.maxSeries = 10
+        dList = []
+        for series in xrange(50):
+            dList.append(self.queue.call(lambda : None, series=series))
+        worker = MockWorker()
+        worker.iQualified = range(51)
+        self.queue.attachWorker(worker)
+        d = defer.DeferredList(dList)
+        d.addCallback(lambda _: self.queue.call(lambda : None, series=50))
+        return d.addCallback(finished)
+
+    def testBatchRunTimes(self):
+        def finished(null):
+            metrics = self.queue.metrics()['series'][None]
+            self.failUnless(metrics['run']['max'] < 0.09)
+            self.failUnless(metrics['wait']['max'] >= 0.15)
+
+        self.queue.attachWorker(taskqueue.BatchThreadWorker(batchSize=5))
+        dList = []
+        for null in xrange(5):
+            dList.append(self.queue.call(time.sleep, 0.05, series=None))
+        return defer.DeferredList(dList).addCallback(finished)
+
+    def testLoadAverageConsumer(self):
+        class Consumer(object):
+            zope.interface.implements(interfaces.IConsumer)
+            def __init__(self):
+                self.written = []
+            def registerProducer(self, producer, streaming):
+                self.producer = producer
+            def unregisterProducer(self):
+                del self.producer
+            def write(self, data):
+                self.written.append(data)
+
+        detailed = Consumer()
+        plain = Consumer()
+        self.queue.loadAverage(detailed, withMetrics=True)
+        self.queue.loadAverage(plain)
+        self.failUnlessEqual(len(detailed.written), 1)
+        load, metrics = detailed.written[0]
+        self.failUnlessEqual(load, 0.0)
+        self.failUnlessEqual(metrics['depth'], 0)
+        detailed.producer.update()
+        self.failUnlessEqual(plain.written, [0.0])
+        d = self.queue.shutdown()
+        d.addCallback(lambda _: self.failIf(hasattr(plain, 'producer')))
+        return d
+
+
 class TestAssignmentFactory(TestCase):
     def setUp(self):
         self.af = taskqueue._AssignmentFactory()
@@ -596,3 +806,216 @@ class TestTaskQueueThreaded(TestCase):
         d = defer.DeferredList(dList)
         d.addCallback(checkResults)
         return d
+
+
+class TestTaskQueueBatchThreaded(TestCase):
+    def setUp(self):
+        self.queue = taskqueue.TaskQueue()
+
+    def tearDown(self):
+        return self.queue.shutdown()
+
+    def testOneTask(self):
+        worker = taskqueue.BatchThreadWorker(10)
+        self.queue.attachWorker(worker)
+        d = self.queue.call(lambda x: 2*x, 15)
+        d.addCallback(self.failUnlessEqual, 30)
+        return d
+
+    def testError(self):
+        worker = taskqueue.BatchThreadWorker(10)
+        self.queue.attachWorker(worker)
+        d = self.queue.call(lambda x: 1/x, 0)
+        return self.failUnlessFailure(d, ZeroDivisionError)
+
+    def testShutdown(self):
+        worker = taskqueue.BatchThreadWorker(10)
+        N = 50
+        mutable = []
+
+        def checkShutdown(null):
+            self.failIf(worker.thread.isAlive())
+            self.failUnlessEqual(mutable, range(N))
+
+        self.queue.attachWorker(worker)
+        for x in xrange(N):
+            self.queue.call(mutable.append, x)
+        d = self.queue.call(time.sleep, 0.1)
+        d.addCallback(lambda _: worker.shutdown())
+        d.addCallback(checkShutdown)
+        return d
+
+    def testBatchSizeLimit(self):
+        N = 100
+        batches = []
+        worker = taskqueue.BatchThreadWorker(7)
+        original = worker._deliver
+
+        def deliver(results):
+            batches.append(len(results))
+            original(results)
+
+        def checkResults(results):
+            self.failUnlessEqual(
+                [x[1] for x in results], [2*x for x in xrange(N)])
+            self.failUnlessEqual(sum(batches), N)
+            self.failUnless(max(batches) <= 7)
+
+        worker._deliver = deliver
+        self.queue.attachWorker(worker)
+        dList = [self.queue.call(lambda y: 2*y, x) for x in xrange(N)]
+        d = defer.DeferredList(dList)
+        d.addCallback(checkResults)
+        return d
+
+    def testBatched(self):
+        N = 50
+        batches = []
+        worker = taskqueue.BatchThreadWorker(10)
+        original = worker._deliver
+
+        def deliver(results):
+            batches.append(len(results))
+            original(results)
+
+        worker._deliver = deliver
+        self.queue.attachWorker(worker)
+        dList = [self.queue.call(lambda y: 2*y, x) for x in xrange(N)]
+        d = defer.DeferredList(dList)
+        d.addCallback(lambda _: self.failUnlessEqual(batches, [10]*5))
+        return d
+
+    def testSchedulingHonored(self):
+        event = threading.Event()
+        order = []
+
+        def task(x):
+            if x == 0:
+                event.wait()
+            order.append(x)
+
+        worker = taskqueue.BatchThreadWorker(5)
+        self.queue.attachWorker(worker)
+        dList = [self.queue.call(task, x) for x in xrange(15)]
+        # Queued while the first batch is running, so it must overtake the
+        # tasks that haven't been pulled from the scheduler yet
+        dList.append(self.queue.call(task, 'urgent', doNext=True))
+        event.set()
+        d = defer.DeferredList(dList)
+        d.addCallback(
+            lambda _: self.failUnlessEqual(
+                order, range(6) + ['urgent'] + range(6, 15)))
+        return d
+
+    def testThreadQueue(self):
+        queue = taskqueue.ThreadQueue(2, 10)
+        N = 100
+        dList = [queue.call(lambda y: 2*y, x) for x in xrange(N)]
+        d = defer.DeferredList(dList)
+        d.addCallback(lambda results: self.failUnlessEqual(
+            [x[1] for x in results], [2*x for x in xrange(N)]))
+        d.addCallback(lambda _: queue.shutdown())
+        return d
+
+
+def _unloadable():
+    raise ImportError("Not importable by the child")
+
+class Unloadable(object):
+    """
+    Pickles fine, but fails to be unpickled, like a callable the child process
+    can't import.
+    """
+    def __reduce__(self):
+        return (_unloadable, ())
+
+
+class TestTaskQueueProcess(TestCase):
+    def setUp(self):
+        self.queue = taskqueue.TaskQueue()
+
+    def tearDown(self):
+        return self.queue.shutdown()
+
+    def testOneTask(self):
+        worker = taskqueue.ProcessWorker()
+        self.queue.attachWorker(worker)
+        d = self.queue.call(operator.mul, 15, 2)
+        d.addCallback(self.failUnlessEqual, 30)
+        return d
+
+    def testError(self):
+        worker = taskqueue.ProcessWorker()
+        self.queue.attachWorker(worker)
+        d = self.queue.call(operator.div, 1, 0)
+        return self.failUnlessFailure(d, ZeroDivisionError)
+
+    def testUnpicklable(self):
+        worker = taskqueue.ProcessWorker()
+        self.queue.attachWorker(worker)
+        d = self.queue.call(lambda x: 2*x, 1)
+        return self.failUnlessFailure(d, taskqueue.ProcessError)
+
+    def testUnloadable(self):
+        worker = taskqueue.ProcessWorker()
+        self.queue.attachWorker(worker)
+        d = self.queue.call(operator.mul, Unloadable(), 2)
+        d = self.failUnlessFailure(d, taskqueue.ProcessError)
+        d.addCallback(lambda _: self.queue.call(operator.mul, 15, 2))
+        d.addCallback(self.failUnlessEqual, 30)
+        return d
+
+    def testChildCrash(self):
+        worker = taskqueue.ProcessWorker()
+        self.queue.attachWorker(worker)
+        pid = worker.process.pid
+        self.failUnlessEqual(worker.pid, pid)
+        messages = []
+        log.addObserver(messages.append)
+        self.addCleanup(log.removeObserver, messages.append)
+
+        def checkLogged(null):
+            self.failUnless(
+                [m for m in messages
+                 if "child %d ended unexpectedly" % pid in "".join(
+                        m['message'])])
+
+        d = self.queue.call(os._exit, 1)
+        d = self.failUnlessFailure(d, taskqueue.ProcessError)
+        d.addCallback(checkLogged)
+        d.addCallback(lambda _: self.queue.call(operator.mul, 15, 2))
+        d.addCallback(self.failUnlessEqual, 30)
+        d.addCallback(lambda _: self.failIfEqual(worker.process.pid, pid))
+        d.addCallback(lambda _: self.failUnlessEqual(
+            worker.pid, worker.process.pid))
+        return d
+
+    def testShutdown(self):
+        worker = taskqueue.ProcessWorker()
+
+        def checkShutdown(null):
+            self.failIf(worker.isRunning)
+            self.failUnlessEqual(worker.process.pid, None)
+
+        self.queue.attachWorker(worker)
+        d = self.queue.call(time.sleep, 0.2)
+        d.addCallback(lambda _: worker.shutdown())
+        d.addCallback(checkShutdown)
+        return d
+
+    def testProcessWorkers(self):
+        N = 20
+
+        def checkResults(results):
+            self.failUnlessEqual(
+                [x[1] for x in results], [2*x for x in xrange(N)])
+
+        for null in xrange(3):
+            worker = taskqueue.ProcessWorker()
+            self.queue.attachWorker(worker)
+        dList = []
+        for x in xrange(N):
+            dList.append(self.queue.call(operator.mul, x, 2))
+        d = defer.DeferredList(dList)
+        d.addCallback(checkResults)
+        return d
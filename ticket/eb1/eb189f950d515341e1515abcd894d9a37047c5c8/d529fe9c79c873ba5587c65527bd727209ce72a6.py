@@ -33,7 +33,7 @@
 Unit tests for syncbridge
 """
 
-import sre, time, copy
+import sre, time, copy, threading
 from twisted.python.failure import Failure
 from twisted.internet import reactor
 from twisted.internet.threads import deferToThread
@@ -300,3 +300,117 @@ class TestSyncQueue(TSQ_Mixin, TestCase):
 
         return self.s.deferToQueue(syncTask).addCallback(gotResult)
 
+
+class TestSyncPool(TestCase):
+    def setUp(self):
+        self.s = syncbridge.SynchronousPool(3, maxBacklog=4)
+        return self.s.startup()
+
+    def tearDown(self):
+        return self.s.shutdown()
+
+    def testRunSeveralTasks(self):
+        def fakeSyncTask(x):
+            time.sleep(DELAY)
+            return 100*x
+
+        def checkResults(results):
+            self.failUnlessEqual(
+                [x[1] for x in results], [100*x for x in xrange(10)])
+
+        dL = [self.s.deferToQueue(fakeSyncTask, x, key=x % 3)
+              for x in xrange(10)]
+        return DeferredList(dL).addCallback(checkResults)
+
+    def testSameKeySerialized(self):
+        lock = threading.Lock()
+        events = []
+
+        def fakeSyncTask(x):
+            if not lock.acquire(False):
+                events.append('overlap')
+                return
+            events.append(x)
+            time.sleep(0.1*DELAY)
+            lock.release()
+
+        dL = [self.s.deferToQueue(fakeSyncTask, x, key='handle')
+              for x in xrange(10)]
+        d = DeferredList(dL)
+        d.addCallback(lambda _: self.failUnlessEqual(events, range(10)))
+        return d
+
+    def testDifferentKeysParallel(self):
+        event = threading.Event()
+
+        def waitForOther():
+            event.wait(10*DELAY)
+            return event.isSet()
+
+        d1 = self.s.deferToQueue(waitForOther, key=1)
+        d2 = self.s.deferToQueue(event.set, key=2)
+        d1.addCallback(self.failUnless)
+        return DeferredList([d1, d2])
+
+    def testBacklogHeld(self):
+        event = threading.Event()
+        results = []
+
+        def fakeSyncTask(x):
+            event.wait()
+            return x
+
+        def checkHeld():
+            self.failUnlessEqual(self.s._backlog, 4)
+            self.failUnlessEqual(len(self.s._held), 6)
+            self.failUnlessEqual(results, [])
+            event.set()
+
+        def checkResults(null):
+            self.failUnlessEqual(sorted(results), range(10))
+            self.failUnlessEqual(self.s._backlog, 0)
+
+        dL = []
+        for x in xrange(10):
+            d = self.s.deferToQueue(fakeSyncTask, x, key=x)
+            d.addCallback(results.append)
+            dL.append(d)
+        checkHeld()
+        return DeferredList(dL).addCallback(checkResults)
+
+    def testHeldBounded(self):
+        event = threading.Event()
+        self.s._maxHeld = 2
+
+        def fakeSyncTask(x):
+            event.wait()
+            return x
+
+        dL = [self.s.deferToQueue(fakeSyncTask, x, key=x) for x in xrange(6)]
+        self.failUnlessRaises(
+            syncbridge.BacklogFullError,
+            self.s.deferToQueue, fakeSyncTask, 6, key=6)
+        self.failUnlessEqual(self.s._backlog, 4)
+        self.failUnlessEqual(len(self.s._held), 2)
+        event.set()
+        d = DeferredList(dL)
+        d.addCallback(
+            lambda results: self.failUnlessEqual(
+                [x[1] for x in results], range(6)))
+        return d
+
+    def testShutdownWithHeld(self):
+        results = []
+
+        def fakeSyncTask(x):
+            time.sleep(0.1*DELAY)
+            results.append(x)
+
+        for x in xrange(10):
+            self.s.deferToQueue(fakeSyncTask, x)
+        d = self.s.shutdown()
+        self.failUnlessRaises(
+            syncbridge.InvalidMethodError,
+            self.s.deferToQueue, fakeSyncTask, 10)
+        d.addCallback(lambda _: self.failUnlessEqual(results, range(10)))
+        return d
@@ -7,12 +7,18 @@ A Twisted wrapper for the asynchronous features of the PostgreSQL psycopg2
 driver.
 """
 
+import csv
+import itertools
+import re
+from collections import deque, OrderedDict
+
 import psycopg2
 from psycopg2 import extensions
 from zope.interface import implements
 
+from twisted.application import service
 from twisted.internet import interfaces, reactor, defer
-from twisted.python import log
+from twisted.python import log, failure
 
 
 class UnexpectedPollResult(Exception):
@@ -176,6 +182,317 @@ class Cursor(_PollingMixin):
         return getattr(self._cursor, name)
 
 
+_streamCounter = itertools.count()
+
+
+class _RowStreamer(object):
+    """
+    A push producer that writes the rows of a query to a consumer, in batches
+    fetched from a server-side cursor.
+
+    psycopg2 does not support named cursors on asynchronous connections, so
+    the cursor is declared and fetched from with plain SQL, which means it has
+    to be used inside a transaction. Only one batch of rows is held in memory
+    at a time and no new batch is fetched while the consumer is paused.
+
+    @type cursor: L{Cursor}
+    @ivar cursor: The cursor used to declare and fetch from the server-side
+        cursor.
+
+    @type consumer: A U{interfaces.IConsumer} provider.
+    @ivar consumer: The consumer that gets written lists of rows.
+
+    @type batchSize: C{int}
+    @ivar batchSize: How many rows to fetch at a time.
+
+    @type rows: C{int}
+    @ivar rows: How many rows have been written to the consumer so far.
+    """
+
+    implements(interfaces.IPushProducer)
+
+    def __init__(self, cursor, consumer, batchSize):
+        self.cursor = cursor
+        self.consumer = consumer
+        self.batchSize = batchSize
+        self.name = "pgadbapi_stream_%d" % _streamCounter.next()
+        self.rows = 0
+
+        self.paused = False
+        self.stopped = False
+        self._done = None
+        self._inFlight = False
+        self._looping = False
+
+    def start(self, query, params=None):
+        """
+        Declare the server-side cursor and start writing rows to the consumer.
+
+        @rtype: C{Deferred}
+        @return: A C{Deferred} that will fire with the number of rows written
+            once all of them have been, or fail with C{defer.CancelledError}
+            if the consumer stops the producer before that.
+        """
+        done = self._done = defer.Deferred()
+        self.consumer.registerProducer(self, True)
+        self._inFlight = True
+        d = self.cursor.execute(
+            "declare %s no scroll cursor for %s" % (self.name, query), params)
+        d.addCallbacks(self._declared, self._finish)
+        return done
+
+    def _declared(self, _):
+        self._inFlight = False
+        self._fetch()
+
+    def _fetch(self):
+        # a loop, so that fetches that complete synchronously do not recurse
+        self._looping = True
+        while self._done and not (self.paused or self._inFlight):
+            if self.stopped:
+                self._finish(failure.Failure(defer.CancelledError()))
+                break
+            self._inFlight = True
+            d = self.cursor.execute(
+                "fetch forward %d from %s" % (self.batchSize, self.name))
+            d.addCallbacks(self._gotRows, self._finish)
+        self._looping = False
+
+    def _gotRows(self, cursor):
+        self._inFlight = False
+        rows = cursor.fetchall()
+        if rows:
+            self.rows += len(rows)
+            self.consumer.write(rows)
+        if not self._done:
+            # the consumer stopped the producer while handling the rows
+            return
+        if len(rows) < self.batchSize:
+            self._inFlight = True
+            d = self.cursor.execute("close %s" % self.name)
+            d.addCallbacks(lambda _: self._finish(self.rows), self._finish)
+        elif not self._looping:
+            self._fetch()
+
+    def _finish(self, result):
+        self._inFlight = False
+        d, self._done = self._done, None
+        self.consumer.unregisterProducer()
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._fetch()
+
+    def stopProducing(self):
+        self.stopped = True
+        self._fetch()
+
+
+# a CSV field, made of quoted parts and unquoted characters, and a quoted part
+_csvField = re.compile(r'(?:"(?:[^"]|"")*"|[^,"]+)*')
+_csvQuoted = re.compile(r'"((?:[^"]|"")*)"')
+
+
+def _parseCSVRecord(record):
+    """
+    Split a CSV record into its fields the way COPY does: an empty field is
+    C{None} unless it was quoted, in which case it is an empty string.
+
+    @param record: The record, with its line ending.
+    @rtype: C{list}
+    """
+    if record.endswith("\r\n"):
+        record = record[:-2]
+    else:
+        record = record[:-1]
+    fields = []
+    pos = 0
+    while True:
+        field = _csvField.match(record, pos).group()
+        pos += len(field)
+        if '"' in field:
+            fields.append(_csvQuoted.sub(
+                    lambda m: m.group(1).replace('""', '"'), field))
+        else:
+            fields.append(field or None)
+        if pos == len(record):
+            return fields
+        if record[pos] != ",":
+            raise csv.Error("unexpected quote in CSV field %r" % (
+                    record[pos - len(field):], ))
+        pos += 1
+
+
+class _CopyConsumer(object):
+    """
+    A consumer that inserts the CSV data written to it into a table.
+
+    psycopg2 does not support COPY on asynchronous connections, so rows are
+    inserted with multi-row INSERT statements of 'batchSize' rows each, one at
+    a time. The producer is paused while more than two batches of rows are
+    waiting to be inserted and resumed when less than one is.
+
+    Fields are parsed like COPY parses CSV: quoted fields can contain commas,
+    doubled quotes and newlines, and empty fields are inserted as NULL unless
+    they are quoted.
+
+    @type cursor: L{Cursor}
+    @ivar cursor: The cursor used to insert rows.
+
+    @type batchSize: C{int}
+    @ivar batchSize: How many rows to insert at a time.
+
+    @type rows: C{int}
+    @ivar rows: How many rows have been inserted so far.
+    """
+
+    implements(interfaces.IConsumer)
+
+    def __init__(self, cursor, table, columns, batchSize):
+        self.cursor = cursor
+        self.batchSize = batchSize
+        if columns:
+            self.insert = "insert into %s (%s) values " % (
+                table, ", ".join(columns))
+        else:
+            self.insert = "insert into %s values " % (table, )
+        self.rows = 0
+        self.producer = None
+        self.paused = False
+
+        # the incomplete last line written and the lines of a record whose
+        # quoted field has not been closed yet
+        self._partial = ""
+        self._record = []
+        self._quotes = 0
+        self._pending = deque()
+        self._inserting = False
+        self._looping = False
+        self._producerDone = False
+        self._failure = None
+        self._done = None
+
+    def start(self, producer):
+        """
+        Start inserting the data that 'producer' produces.
+
+        @param producer: An object with a startProducing(consumer) method
+            returning a Deferred that fires when it is done, and
+            pauseProducing(), resumeProducing() and stopProducing() methods,
+            like C{twisted.web.iweb.IBodyProducer}.
+
+        @rtype: C{Deferred}
+        @return: A C{Deferred} that will fire with the number of rows inserted
+            once the producer is done and all rows have been inserted.
+        """
+        done = self._done = defer.Deferred()
+        self.producer = producer
+        d = defer.maybeDeferred(producer.startProducing, self)
+        d.addCallbacks(self._producerFinished, self._fail)
+        return done
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        if self._failure:
+            return
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        try:
+            for line in lines:
+                self._addLine(line)
+        except csv.Error:
+            self._fail(failure.Failure())
+            return
+        self._flush()
+        if not self.paused and len(self._pending) > 2 * self.batchSize:
+            self.paused = True
+            self.producer.pauseProducing()
+
+    def _addLine(self, line):
+        self._record.append(line + "\n")
+        self._quotes += line.count('"')
+        if self._quotes % 2:
+            # a quoted field goes on in the next line
+            return
+        record, self._record, self._quotes = self._record, [], 0
+        if record == ["\n"] or record == ["\r\n"]:
+            return
+        self._pending.append(_parseCSVRecord("".join(record)))
+
+    def _flush(self):
+        # a loop, so that inserts that complete synchronously do not recurse
+        self._looping = True
+        while not (self._inserting or self._failure) and (
+            len(self._pending) >= self.batchSize or
+            (self._producerDone and self._pending)):
+            batch = [self._pending.popleft() for _ in
+                     range(min(self.batchSize, len(self._pending)))]
+            values = ", ".join([self.cursor.mogrify(
+                        "(%s)" % ", ".join(["%s"] * len(row)), row)
+                                for row in batch])
+            self._inserting = True
+            d = self.cursor.execute(self.insert + values)
+            d.addCallbacks(self._inserted, self._insertFailed,
+                           callbackArgs=(len(batch), ))
+        self._looping = False
+        self._maybeFinish()
+
+    def _inserted(self, _, count):
+        self._inserting = False
+        self.rows += count
+        if self.paused and len(self._pending) < self.batchSize:
+            self.paused = False
+            self.producer.resumeProducing()
+        if not self._looping:
+            self._flush()
+
+    def _insertFailed(self, f):
+        self._inserting = False
+        self._fail(f)
+
+    def _producerFinished(self, _):
+        if self._failure:
+            return
+        if self._partial:
+            self.write("\n")
+        if self._record:
+            self._fail(failure.Failure(
+                    ValueError("Unterminated quoted field in CSV data")))
+            return
+        self._producerDone = True
+        self._flush()
+
+    def _fail(self, f):
+        if self._failure is None:
+            self._failure = f
+            if not self._producerDone:
+                self._producerDone = True
+                self.producer.stopProducing()
+        self._maybeFinish()
+
+    def _maybeFinish(self):
+        if not self._done or self._inserting:
+            return
+        if self._failure:
+            d, self._done = self._done, None
+            d.errback(self._failure)
+        elif self._producerDone and not self._pending:
+            d, self._done = self._done, None
+            d.callback(self.rows)
+
+
 class AlreadyConnected(Exception):
     """
     The database connection is already open.
@@ -203,6 +520,34 @@ class RollbackFailed(Exception):
         return "<RollbackFailed, original error: %s>" % self.originalFailure
 
 
+_statementCounter = itertools.count()
+
+# statements that PostgreSQL can PREPARE
+_preparable = frozenset(['select', 'insert', 'update', 'delete', 'values',
+                         'with'])
+
+_placeholder = re.compile(r"%(?:\((\w+)\))?s|%%")
+
+
+def _numberParameters(query):
+    """
+    Rewrite a query that uses psycopg2 placeholders to use PostgreSQL's
+    numbered parameters instead, as required by PREPARE.
+
+    @rtype: C{tuple}
+    @return: The rewritten query and a list with the name of the parameter
+        that goes in each numbered position, or C{None} for positional
+        parameters.
+    """
+    names = []
+    def number(match):
+        if match.group() == "%%":
+            return "%"
+        names.append(match.group(1))
+        return "$%d" % len(names)
+    return _placeholder.sub(number, query), names
+
+
 class Connection(_PollingMixin):
     """
     A wrapper for a psycopg2 asynchronous connection.
@@ -210,15 +555,39 @@ class Connection(_PollingMixin):
     The wrapper forwards almost everything to the wrapped connection, but
     provides additional methods for compatibility with C{adbapi.Connection}.
 
+    If 'statementCacheSize' is set, runQuery and runOperation PREPARE the
+    statements they run on the server and keep up to that many of them around,
+    keyed by query text, evicting the least recently used one when full. Later
+    calls with the same query text only EXECUTE the prepared statement, which
+    saves PostgreSQL from parsing and planning it again. Note that PostgreSQL
+    has to infer the types of the parameters of a prepared statement from the
+    query, so parameters that appear without context (as in "select %s") are
+    taken to be text and should be cast in the query.
+
     @type connectionFactory: Any callable.
     @ivar connectionFactory: The factory used to produce connections.
 
     @type cursorFactory: Any callable.
     @ivar cursorFactory: The factory used to produce cursors.
+
+    @type statementCacheSize: C{int}
+    @ivar statementCacheSize: How many prepared statements to keep, 0 disables
+        preparing statements.
+
+    @type cacheHits: C{int}
+    @ivar cacheHits: How many statements were run from the cache.
+
+    @type cacheMisses: C{int}
+    @ivar cacheMisses: How many statements had to be prepared.
+
+    @type cacheEvictions: C{int}
+    @ivar cacheEvictions: How many prepared statements were deallocated to
+        make room for others.
     """
 
     connectionFactory = psycopg2.connect
     cursorFactory = Cursor
+    statementCacheSize = 0
 
     def __init__(self, reactor=None):
         if not reactor:
@@ -230,6 +599,13 @@ class Connection(_PollingMixin):
         self.lock = defer.DeferredLock()
         self._connection = None
 
+        # query text -> (statement name, parameter names), least recently
+        # used first
+        self._statements = OrderedDict()
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.cacheEvictions = 0
+
     def pollable(self):
         return self._connection
 
@@ -260,6 +636,8 @@ class Connection(_PollingMixin):
         """
         _connection, self._connection = self._connection, None
         _connection.close()
+        # prepared statements go away with the session
+        self._statements.clear()
 
     def cursor(self):
         """
@@ -283,8 +661,7 @@ class Connection(_PollingMixin):
         @return: A Deferred that will fire with the return value of the
             cursor's fetchall() method.
         """
-        c = self.cursor()
-        d = c.execute(*args, **kwargs)
+        d = self._execute(*args, **kwargs)
         return d.addCallback(lambda c: c.fetchall())
 
     def runOperation(self, *args, **kwargs):
@@ -298,10 +675,130 @@ class Connection(_PollingMixin):
         @rtype: C{Deferred}
         @return: A Deferred that will fire None.
         """
-        c = self.cursor()
-        d = c.execute(*args, **kwargs)
+        d = self._execute(*args, **kwargs)
         return d.addCallback(lambda _: None)
 
+    def _execute(self, query, params=None):
+        """
+        Execute a query on a new cursor, as a prepared statement if possible.
+
+        @rtype: C{Deferred}
+        @return: A Deferred that will fire with the cursor.
+        """
+        c = self.cursor()
+        if not self._isPreparable(query, params):
+            return c.execute(query, params)
+        # hold the lock over deallocating, preparing and executing, so that
+        # the cache always matches what the server has
+        return self.lock.run(self._executePrepared, c, query, params)
+
+    def _isPreparable(self, query, params):
+        if not self.statementCacheSize:
+            return False
+        # without parameters psycopg2 leaves % signs alone, keep it that way
+        if params is None and "%" in query:
+            return False
+        words = query.split(None, 1)
+        return bool(words) and words[0].lower() in _preparable
+
+    def _executePrepared(self, c, query, params):
+        entry = self._statements.pop(query, None)
+        if entry is not None:
+            self.cacheHits += 1
+            self._statements[query] = entry
+            return self._executeStatement(c, entry, params)
+
+        self.cacheMisses += 1
+        d = defer.succeed(None)
+        if len(self._statements) >= self.statementCacheSize:
+            d.addCallback(self._evict, c)
+        name = "pgadbapi_stmt_%d" % _statementCounter.next()
+        if params is None:
+            text, names = query, []
+        else:
+            text, names = _numberParameters(query)
+        d.addCallback(lambda _: c._doit(
+                'execute', "prepare %s as %s" % (name, text)))
+        def prepared(_):
+            entry = self._statements[query] = (name, names)
+            return self._executeStatement(c, entry, params)
+        return d.addCallback(prepared)
+
+    def _executeStatement(self, c, entry, params):
+        name, names = entry
+        if params is None or not names and isinstance(params, dict):
+            # psycopg2 ignores a dict for a query without placeholders
+            args = ()
+        elif names and names[0] is not None:
+            args = tuple([params[n] for n in names])
+        else:
+            args = tuple(params)
+        if not args:
+            return c._doit('execute', "execute %s" % name)
+        return c._doit('execute', "execute %s (%s)" % (
+                name, ", ".join(["%s"] * len(args))), args)
+
+    def _evict(self, _, c):
+        name = self._statements.popitem(last=False)[1][0]
+        self.cacheEvictions += 1
+        return c._doit('execute', "deallocate %s" % name)
+
+    def streamQuery(self, consumer, query, params=None, batchSize=1000):
+        """
+        Execute an SQL query and write its result to a consumer.
+
+        The query is run in a transaction, through a server-side cursor that
+        rows are fetched from 'batchSize' at a time. Each batch is written to
+        'consumer' as a list of rows. The consumer gets registered a streaming
+        producer, so it can pause fetching and stop it, in which case the
+        transaction is rolled back.
+
+        @type consumer: A U{interfaces.IConsumer} provider.
+        @param consumer: The consumer to write lists of rows to.
+
+        @type batchSize: C{int}
+        @param batchSize: How many rows to fetch and write at a time.
+
+        @rtype: C{Deferred}
+        @return: A Deferred that will fire with the number of rows written, or
+            fail with C{defer.CancelledError} if the consumer stopped the
+            producer.
+        """
+        return self.runInteraction(
+            lambda c: _RowStreamer(c, consumer, batchSize).start(
+                query, params))
+
+    def copyFrom(self, table, producer, columns=None, batchSize=1000):
+        """
+        Insert the CSV data from a producer into a table.
+
+        The data is inserted in a transaction, 'batchSize' rows at a time, so
+        either all of it or none ends up in the table. The producer is paused
+        while the database falls behind.
+
+        psycopg2 does not support COPY on asynchronous connections, so this
+        uses multi-row INSERT statements rather than COPY, and the binary COPY
+        format is not supported.
+
+        @type table: C{str}
+        @param table: The name of the table to insert into.
+
+        @param producer: An object with a startProducing(consumer) method
+            returning a Deferred that fires when it is done, and
+            pauseProducing(), resumeProducing() and stopProducing() methods,
+            like C{twisted.web.iweb.IBodyProducer}. It should write CSV data.
+
+        @type columns: C{list} of C{str}
+        @param columns: The columns that the CSV fields go into, or C{None} for
+            all of the table's columns.
+
+        @rtype: C{Deferred}
+        @return: A Deferred that will fire with the number of rows inserted.
+        """
+        return self.runInteraction(
+            lambda c: _CopyConsumer(c, table, columns, batchSize).start(
+                producer))
+
     def runInteraction(self, interaction, *args, **kwargs):
         """
         Run commands in a transaction and return the result.
@@ -358,19 +855,57 @@ class Connection(_PollingMixin):
 
         return d
 
+class PoolSaturated(Exception):
+    """
+    The connection pool's queue of calls waiting for a connection is full.
+    """
+
+
 class ConnectionPool(object):
     """
-    A poor man's pool of L{pgadbapi.Connection} instances.
+    A pool of L{pgadbapi.Connection} instances.
+
+    Each call is run on the least loaded connection that can take it, where
+    the load of a connection is the number of calls that have been dispatched
+    to it and have not finished yet. Up to 'pipeline' queries and operations
+    can be in flight on a connection at once; they are run back to back by the
+    connection. An interaction needs a connection to itself, because it runs
+    in a transaction.
+
+    When no connection can take a call it waits in a FIFO queue. The queue
+    holds at most 'maxWaiting' calls, beyond which calls fail right away with
+    L{PoolSaturated}, and calls that wait longer than 'waitTimeout' seconds
+    fail with C{defer.TimeoutError}.
 
     @type min: C{int}
     @ivar min: The amount of connections that will be open at start. The pool
         never opens or closes connections on its own.
 
+    @type pipeline: C{int}
+    @ivar pipeline: How many queries and operations can be in flight on a
+        connection at once.
+
+    @type maxWaiting: C{int} or C{None}
+    @ivar maxWaiting: How many calls can wait for a connection, or C{None} for
+        no limit.
+
+    @type waitTimeout: C{float} or C{None}
+    @ivar waitTimeout: How many seconds a call can wait for a connection, or
+        C{None} for no limit.
+
+    @type statementCacheSize: C{int} or C{None}
+    @ivar statementCacheSize: If not C{None}, the 'statementCacheSize' of the
+        pooled connections.
+
     @type connectionFactory: Any callable.
     @ivar connectionFactory: The factory used to produce connections.
     """
 
     min = 3
+    pipeline = 1
+    maxWaiting = 1000
+    waitTimeout = None
+    statementCacheSize = None
     connectionFactory = Connection
     reactor = None
 
@@ -378,10 +913,11 @@ class ConnectionPool(object):
         """
         Create a new connection pool.
 
-        Any positional or keyword arguments other than the first one and a
-        'min' keyword argument are passed to the L{Connection} when
-        connecting. Use these arguments to pass database names, usernames,
-        passwords, etc.
+        Any positional or keyword arguments other than the first one and the
+        'min', 'pipeline', 'maxWaiting', 'waitTimeout' and
+        'statementCacheSize' keyword arguments are passed to the
+        L{Connection} when connecting. Use these arguments to
+        pass database names, usernames, passwords, etc.
 
         @type _ignored: Any object.
         @param _ignored: Ignored, for L{adbapi.ConnectionPool} compatibility.
@@ -390,15 +926,24 @@ class ConnectionPool(object):
             from twisted.internet import reactor
             self.reactor = reactor
         # for adbapi compatibility, min can be passed in kwargs
-        if 'min' in connkw:
-            self.min = connkw.pop('min')
+        for name in ('min', 'pipeline', 'maxWaiting', 'waitTimeout',
+                     'statementCacheSize'):
+            if name in connkw:
+                setattr(self, name, connkw.pop(name))
         self.connargs = connargs
         self.connkw = connkw
         self.connections = set(
             [self.connectionFactory(self.reactor) for _ in range(self.min)])
+        if self.statementCacheSize is not None:
+            for c in self.connections:
+                c.statementCacheSize = self.statementCacheSize
 
-        # to avoid checking out more connections than there are pooled in total
-        self._semaphore = defer.DeferredSemaphore(self.min)
+        # the number of calls in flight on each connection
+        self._load = dict([(c, 0) for c in self.connections])
+        # calls waiting for a connection
+        self._waiting = deque()
+        self.timeouts = 0
+        self.rejections = 0
 
     def start(self):
         """
@@ -417,27 +962,31 @@ class ConnectionPool(object):
         """
         Stop the pool.
 
-        Disconnect all connections.
+        Disconnect all connections. Calls still waiting for a connection fail
+        with C{defer.CancelledError}.
         """
         for c in self.connections:
             c.close()
+        waiting, self._waiting = self._waiting, deque()
+        for d, _, _, _, _, timeoutCall in waiting:
+            if timeoutCall:
+                timeoutCall.cancel()
+            d.errback(defer.CancelledError())
 
     def remove(self, connection):
         """
         Remove a connection from the pool.
 
         Provided to be able to remove broken connections from the pool. The
-        caller should make sure the removed connection does not have queries
-        pending.
+        connection must not have any calls in flight.
 
         @type connection: An object produced by the pool's connection factory.
         @param connection: The connection to be removed.
         """
-        if not self.connections:
+        if self._load.get(connection):
             raise ValueError("Connection still in use")
         self.connections.remove(connection)
-        self._semaphore.limit -= 1
-        self._semaphore.acquire()  # bleargh...
+        del self._load[connection]
 
     def add(self, connection):
         """
@@ -450,18 +999,110 @@ class ConnectionPool(object):
         @param connection: The connection to be added.
         """
         self.connections.add(connection)
-        self._semaphore.limit += 1
-        self._semaphore.release() # uuuugh...
+        self._load[connection] = 0
+        self._runWaiting()
 
-    def _putBackAndPassthrough(self, result, connection):
-        self.connections.add(connection)
+    def saturation(self):
+        """
+        Report how busy the pool is.
+
+        @rtype: C{dict}
+        @return: A dictionary with the number of 'connections', how many of
+            them are 'busy', the number of calls 'inFlight' on them and of
+            calls 'waiting' for a connection, the 'capacity' for calls in
+            flight, the 'saturation' (calls in flight or waiting divided by the
+            capacity), and the total number of calls that failed because of
+            'timeouts' or were 'rejections' because the wait queue was full.
+        """
+        inFlight = sum(self._load.itervalues())
+        capacity = len(self.connections) * self.pipeline
+        waiting = len(self._waiting)
+        if capacity:
+            saturation = float(inFlight + waiting) / capacity
+        else:
+            saturation = float(waiting > 0)
+        return {'connections': len(self.connections),
+                'busy': len([l for l in self._load.itervalues() if l]),
+                'inFlight': inFlight,
+                'waiting': waiting,
+                'capacity': capacity,
+                'saturation': saturation,
+                'timeouts': self.timeouts,
+                'rejections': self.rejections}
+
+    def _pick(self, exclusive):
+        """
+        Pick the least loaded connection that can take another call, or one
+        with nothing in flight if the call needs the connection to itself.
+
+        @return: A connection or C{None} if none can take the call.
+        """
+        best, bestLoad = None, None
+        for c, load in self._load.iteritems():
+            if load == 0:
+                return c
+            if not exclusive and load < self.pipeline and \
+                    (best is None or load < bestLoad):
+                best, bestLoad = c, load
+        return best
+
+    def _schedule(self, exclusive, name, args, kwargs):
+        """
+        Run the connection method called 'name' on a connection as soon as one
+        can take the call, queueing the call until then.
+        """
+        if not self._waiting:
+            c = self._pick(exclusive)
+            if c is not None:
+                return self._dispatch(c, exclusive, name, args, kwargs)
+        if self.maxWaiting is not None and \
+                len(self._waiting) >= self.maxWaiting:
+            self.rejections += 1
+            return defer.fail(PoolSaturated(
+                    "%d calls already waiting" % len(self._waiting)))
+        d = defer.Deferred()
+        waiter = [d, exclusive, name, args, kwargs, None]
+        if self.waitTimeout is not None:
+            waiter[-1] = self.reactor.callLater(
+                self.waitTimeout, self._timedOut, waiter)
+        self._waiting.append(waiter)
+        return d
+
+    def _dispatch(self, c, exclusive, name, args, kwargs):
+        # an exclusive call takes up all of the connection's capacity
+        weight = exclusive and self.pipeline or 1
+        self._load[c] += weight
+        d = defer.maybeDeferred(getattr(c, name), *args, **kwargs)
+        return d.addBoth(self._release, c, weight)
+
+    def _release(self, result, c, weight):
+        if c in self._load:
+            self._load[c] -= weight
+        self._runWaiting()
         return result
 
+    def _runWaiting(self):
+        while self._waiting:
+            d, exclusive, name, args, kwargs, timeoutCall = self._waiting[0]
+            c = self._pick(exclusive)
+            if c is None:
+                break
+            self._waiting.popleft()
+            if timeoutCall:
+                timeoutCall.cancel()
+            self._dispatch(c, exclusive, name, args, kwargs).chainDeferred(d)
+
+    def _timedOut(self, waiter):
+        self._waiting.remove(waiter)
+        self.timeouts += 1
+        waiter[0].errback(defer.TimeoutError(
+                "Waited %s seconds for a connection" % self.waitTimeout))
+
     def runQuery(self, *args, **kwargs):
         """
         Execute an SQL query and return the result.
 
-        An asynchronous cursor will be created from a randomly chosen pooled
+        An asynchronous cursor will be created from the least loaded pooled
         connection and its execute() method will be invoked with the provided
         *args and **kwargs. After the query completes the cursor's fetchall()
         method will be called and the returned Deferred will fire with the
@@ -474,12 +1115,7 @@ class ConnectionPool(object):
         @return: A Deferred that will fire with the return value of the
             cursor's fetchall() method.
         """
-        return self._semaphore.run(self._runQuery, *args, **kwargs)
-
-    def _runQuery(self, *args, **kwargs):
-        c = self.connections.pop()
-        d = c.runQuery(*args, **kwargs)
-        return d.addBoth(self._putBackAndPassthrough, c)
+        return self._schedule(False, 'runQuery', args, kwargs)
 
     def runOperation(self, *args, **kwargs):
         """
@@ -492,12 +1128,33 @@ class ConnectionPool(object):
         @rtype: C{Deferred}
         @return: A Deferred that will fire None.
         """
-        return self._semaphore.run(self._runOperation, *args, **kwargs)
+        return self._schedule(False, 'runOperation', args, kwargs)
+
+    def streamQuery(self, consumer, query, params=None, batchSize=1000):
+        """
+        Execute an SQL query and write its result to a consumer.
+
+        The query is run by the L{Connection.streamQuery} method of a pooled
+        connection, which the query has to itself until it finishes.
+
+        @rtype: C{Deferred}
+        @return: A Deferred that will fire with the number of rows written.
+        """
+        return self._schedule(
+            True, 'streamQuery', (consumer, query, params, batchSize), {})
+
+    def copyFrom(self, table, producer, columns=None, batchSize=1000):
+        """
+        Insert the CSV data from a producer into a table.
+
+        The data is inserted by the L{Connection.copyFrom} method of a pooled
+        connection, which the call has to itself until it finishes.
 
-    def _runOperation(self, *args, **kwargs):
-        c = self.connections.pop()
-        d = c.runOperation(*args, **kwargs)
-        return d.addBoth(self._putBackAndPassthrough, c)
+        @rtype: C{Deferred}
+        @return: A Deferred that will fire with the number of rows inserted.
+        """
+        return self._schedule(
+            True, 'copyFrom', (table, producer, columns, batchSize), {})
 
     def runInteraction(self, interaction, *args, **kwargs):
         """
@@ -532,10 +1189,251 @@ class ConnectionPool(object):
         @return: A Deferred that will file with the return value of
             'interaction'.
         """
-        return self._semaphore.run(
-            self._runInteraction, interaction, *args, **kwargs)
+        return self._schedule(
+            True, 'runInteraction', (interaction, ) + args, kwargs)
+
+
+def _quoteIdentifier(name):
+    return '"%s"' % (name.replace('"', '""'), )
+
+
+class Notifier(service.Service):
+    """
+    A service that holds a connection LISTENing on channels and calls the
+    subscribers of a channel when a notification arrives on it.
+
+    The connection's socket is watched by the reactor, so notifications are
+    dispatched as soon as they arrive, without timers or threads. If the
+    connection is lost a new one is made, waiting 'reconnectDelay' seconds
+    and doubling the wait after each failed attempt up to
+    'maxReconnectDelay', and it LISTENs on all subscribed channels again.
+    Notifications sent while there was no connection are lost.
+
+    @type connection: L{Connection} or C{None}
+    @ivar connection: The listening connection, if there is one.
+
+    @type reconnectDelay: C{float}
+    @ivar reconnectDelay: Seconds to wait before the first attempt to
+        reconnect.
+
+    @type maxReconnectDelay: C{float}
+    @ivar maxReconnectDelay: The longest wait between attempts to reconnect.
 
-    def _runInteraction(self, interaction, *args, **kwargs):
-        c = self.connections.pop()
-        d = c.runInteraction(interaction, *args, **kwargs)
-        return d.addBoth(self._putBackAndPassthrough, c)
+    @type connectionFactory: Any callable.
+    @ivar connectionFactory: The factory used to produce the connection.
+    """
+
+    implements(interfaces.IReadDescriptor)
+
+    reconnectDelay = 1.0
+    maxReconnectDelay = 60.0
+    connectionFactory = Connection
+    reactor = None
+
+    def __init__(self, *connargs, **connkw):
+        """
+        Create a new notifier.
+
+        Positional and keyword arguments are passed to the L{Connection} when
+        connecting.
+        """
+        if not self.reactor:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self.connargs = connargs
+        self.connkw = connkw
+        self.connection = None
+
+        # channel -> list of callables
+        self._subscribers = {}
+        # Deferreds waiting for the connection to be listening
+        self._listenWaiters = []
+        self._reading = False
+        self._fd = -1
+        # statements in flight, the connection is not read from meanwhile
+        self._busy = 0
+        self._delay = self.reconnectDelay
+        self._reconnectCall = None
+        self._connecting = None
+
+    def subscribe(self, channel, callback):
+        """
+        Call 'callback' with the channel and the payload of every notification
+        sent on 'channel'.
+
+        @rtype: C{Deferred}
+        @return: A Deferred that will fire when the connection is listening on
+            the channel. If there is no connection yet that is once the
+            service has connected, and the Deferred fails with
+            C{defer.CancelledError} if the service is stopped before.
+        """
+        callbacks = self._subscribers.setdefault(channel, [])
+        callbacks.append(callback)
+        if not self.connection:
+            d = defer.Deferred()
+            self._listenWaiters.append(d)
+            return d
+        if len(callbacks) == 1:
+            d = self._execute("listen %s" % _quoteIdentifier(channel))
+            return d.addCallback(lambda _: None)
+        return defer.succeed(None)
+
+    def unsubscribe(self, channel, callback):
+        """
+        Stop calling 'callback' for notifications sent on 'channel'.
+
+        @rtype: C{Deferred}
+        @return: A Deferred that will fire when the connection has stopped
+            listening on the channel, if this was its last subscriber.
+        """
+        callbacks = self._subscribers[channel]
+        callbacks.remove(callback)
+        if not callbacks:
+            del self._subscribers[channel]
+            if self.connection:
+                d = self._execute("unlisten %s" % _quoteIdentifier(channel))
+                return d.addCallback(lambda _: None)
+        return defer.succeed(None)
+
+    def startService(self):
+        service.Service.startService(self)
+        self._connect()
+
+    def stopService(self):
+        """
+        Close the connection, or wait for the attempt to connect that is
+        under way to end and close the connection then.
+        """
+        service.Service.stopService(self)
+        if self._reconnectCall:
+            self._reconnectCall.cancel()
+            self._reconnectCall = None
+        if self.connection:
+            self._stopReading()
+            c, self.connection = self.connection, None
+            c.close()
+        waiters, self._listenWaiters = self._listenWaiters, []
+        for d in waiters:
+            d.errback(defer.CancelledError())
+        if self._connecting:
+            d = defer.Deferred()
+            self._connecting.addBoth(lambda _: d.callback(None))
+            return d
+
+    def _connect(self):
+        self._reconnectCall = None
+        c = self.connectionFactory(self.reactor)
+        d = c.connect(*self.connargs, **self.connkw)
+        d.addCallbacks(self._connected, self._connectionFailed)
+        if not d.called:
+            self._connecting = d
+            d.addBoth(self._setConnecting, None)
+
+    def _setConnecting(self, result, connecting):
+        self._connecting = connecting
+        return result
+
+    def _connected(self, c):
+        if not self.running:
+            c.close()
+            return
+        self.connection = c
+        self._delay = self.reconnectDelay
+        if not self._subscribers:
+            # everything subscribed to before was unsubscribed from
+            self._startReading()
+            self._listening(None)
+            return
+        d = self._execute("; ".join(["listen %s" % _quoteIdentifier(channel)
+                                     for channel in self._subscribers]))
+        d.addCallbacks(self._listening, self._lost)
+
+    def _listening(self, _):
+        waiters, self._listenWaiters = self._listenWaiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def _connectionFailed(self, f):
+        log.msg("Notifier failed to connect: %s" % (f.getErrorMessage(), ))
+        self._reconnect()
+
+    def _reconnect(self):
+        if self.running:
+            self._reconnectCall = self.reactor.callLater(
+                self._delay, self._connect)
+            self._delay = min(self._delay * 2, self.maxReconnectDelay)
+
+    def _lost(self, f):
+        if not self.connection:
+            return
+        log.msg("Notifier lost its connection: %s" % (f.getErrorMessage(), ))
+        self._stopReading()
+        self._busy = 0
+        c, self.connection = self.connection, None
+        try:
+            c.close()
+        except psycopg2.Error:
+            pass
+        self._reconnect()
+
+    def _execute(self, query):
+        # the cursor polls the connection itself, so stop reading from it
+        # while the statement runs
+        self._stopReading()
+        self._busy += 1
+        d = self.connection.cursor().execute(query)
+        return d.addBoth(self._executed)
+
+    def _executed(self, result):
+        self._busy -= 1
+        if not self._busy and self.connection:
+            self._startReading()
+            # notifications may have arrived along with the results
+            self._dispatch()
+        return result
+
+    def _startReading(self):
+        if not self._reading:
+            # psycopg2 refuses to tell the descriptor once the server has
+            # closed the connection, but the reactor needs it to stop reading
+            self._fd = self.connection.fileno()
+            self._reading = True
+            self.reactor.addReader(self)
+
+    def _stopReading(self):
+        if self._reading:
+            self._reading = False
+            self.reactor.removeReader(self)
+            self._fd = -1
+
+    def _dispatch(self):
+        notifies = self.connection.notifies
+        received = notifies[:]
+        del notifies[:]
+        for notify in received:
+            channel = notify[1]
+            payload = getattr(notify, 'payload', '')
+            for callback in self._subscribers.get(channel, [])[:]:
+                try:
+                    callback(channel, payload)
+                except:
+                    log.err(None, "Notifier subscriber failed")
+
+    def doRead(self):
+        try:
+            self.connection.pollable().poll()
+        except psycopg2.Error:
+            self._lost(failure.Failure())
+            return
+        self._dispatch()
+
+    def connectionLost(self, reason):
+        self._reading = False
+        self._fd = -1
+        self._lost(reason)
+
+    def fileno(self):
+        return self._fd
+
+    def logPrefix(self):
+        return "notifier"
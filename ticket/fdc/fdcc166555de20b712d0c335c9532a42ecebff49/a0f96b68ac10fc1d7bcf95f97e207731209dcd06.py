@@ -15,7 +15,8 @@ except ImportError:
 from twisted.enterprise import pgadbapi
 
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, interfaces, task
+from zope.interface import implements
 
 simple_table_schema = """
 CREATE TABLE simple (
@@ -515,6 +516,520 @@ class PGADBAPIQueryTestCase(_SimpleDBSetupMixin, Psycopg2TestCase):
         return d.addCallback(lambda _: self.conn.runOperation("rollback"))
 
 
+class PGADBAPIStatementCacheTestCase(_SimpleDBSetupMixin, Psycopg2TestCase):
+
+    def setUp(self):
+        d = _SimpleDBSetupMixin.setUp(self)
+        return d.addCallback(
+            lambda _: setattr(self.conn, 'statementCacheSize', 2))
+
+    def countPrepared(self):
+        c = self.conn.cursor()
+        d = c.execute("select count(*) from pg_prepared_statements")
+        return d.addCallback(lambda c: c.fetchone()[0])
+
+    def test_disabledByDefault(self):
+        """
+        Statements are not prepared unless the connection's
+        'statementCacheSize' is set.
+        """
+        conn = pgadbapi.Connection()
+        self.assertEquals(conn.statementCacheSize, 0)
+        self.conn.statementCacheSize = 0
+        d = self.conn.runQuery("select 1")
+        d.addCallback(self.assertEquals, [(1, )])
+        d.addCallback(lambda _: self.assertEquals(
+                (self.conn.cacheHits, self.conn.cacheMisses), (0, 0)))
+        d.addCallback(lambda _: self.countPrepared())
+        return d.addCallback(self.assertEquals, 0)
+
+    def test_hitsAndMisses(self):
+        """
+        The first run of a query prepares it, later runs execute the prepared
+        statement with their own parameters.
+        """
+        insert = "insert into simple values (%s)"
+        d = self.conn.runOperation(insert, (1, ))
+        d.addCallback(lambda _: self.conn.runOperation(insert, (2, )))
+        d.addCallback(lambda _: self.conn.runQuery(
+                "select x from simple order by x"))
+        d.addCallback(self.assertEquals, [(1, ), (2, )])
+        d.addCallback(lambda _: self.assertEquals(
+                (self.conn.cacheHits, self.conn.cacheMisses), (1, 2)))
+        d.addCallback(lambda _: self.countPrepared())
+        return d.addCallback(self.assertEquals, 2)
+
+    def test_eviction(self):
+        """
+        When the cache is full the least recently used statement is
+        deallocated to make room for the new one.
+        """
+        queries = ["select 1", "select 2", "select 3"]
+        d = defer.succeed(None)
+        for i in [0, 1, 0, 2]:
+            d.addCallback(lambda _, q=queries[i]: self.conn.runQuery(q))
+        def check(_):
+            self.assertEquals(sorted(self.conn._statements),
+                              ["select 1", "select 3"])
+            self.assertEquals(self.conn.cacheEvictions, 1)
+            self.assertEquals(self.conn.cacheHits, 1)
+        d.addCallback(check)
+        d.addCallback(lambda _: self.countPrepared())
+        return d.addCallback(self.assertEquals, 2)
+
+    def test_concurrentCalls(self):
+        """
+        Calls for the same query made before it has been prepared share the
+        prepared statement.
+        """
+        query = "select %s::int + 1"
+        d = defer.gatherResults(
+            [self.conn.runQuery(query, (i, )) for i in range(5)])
+        d.addCallback(self.assertEquals, [[(i + 1, )] for i in range(5)])
+        return d.addCallback(lambda _: self.assertEquals(
+                (self.conn.cacheHits, self.conn.cacheMisses), (4, 1)))
+
+    def test_namedParameters(self):
+        """
+        Queries with named parameters and escaped percent signs are prepared
+        correctly.
+        """
+        query = "select %(a)s::int + %(b)s::int, %(a)s::int, '100%%'"
+        d = self.conn.runQuery(query, {'a': 1, 'b': 2})
+        d.addCallback(self.assertEquals, [(3, 1, '100%')])
+        d.addCallback(lambda _: self.conn.runQuery(query, {'a': 5, 'b': 5}))
+        d.addCallback(self.assertEquals, [(10, 5, '100%')])
+        return d.addCallback(lambda _: self.assertEquals(
+                self.conn.cacheHits, 1))
+
+    def test_dictWithoutPlaceholders(self):
+        """
+        A dict of parameters for a query without placeholders is ignored, as
+        psycopg2 does, instead of sending its keys as arguments.
+        """
+        executed = []
+        class RecordingCursor(pgadbapi.Cursor):
+            def _doit(self, name, *args, **kwargs):
+                executed.append(args)
+                return pgadbapi.Cursor._doit(self, name, *args, **kwargs)
+        self.patch(self.conn, 'cursorFactory', RecordingCursor)
+
+        d = self.conn.runQuery("select 1", {'a': 2})
+        d.addCallback(self.assertEquals, [(1, )])
+        d.addCallback(lambda _: self.conn.runQuery("select 1", {'a': 2}))
+        d.addCallback(self.assertEquals, [(1, )])
+        def check(_):
+            self.assertEquals(self.conn.cacheHits, 1)
+            name = self.conn._statements["select 1"][0]
+            self.assertEquals(
+                [args for args in executed if args[0].startswith("execute")],
+                [("execute %s" % (name, ), )] * 2)
+        return d.addCallback(check)
+
+    def test_notPreparable(self):
+        """
+        Statements that cannot be prepared, and queries without parameters
+        that contain percent signs, are run as usual.
+        """
+        d = self.conn.runOperation("create table y (i int)")
+        d.addCallback(lambda _: self.conn.runOperation("drop table y"))
+        d.addCallback(lambda _: self.conn.runQuery("select '%s%%'"))
+        d.addCallback(self.assertEquals, [('%s%%', )])
+        return d.addCallback(lambda _: self.assertEquals(
+                self.conn._statements, {}))
+
+    def test_prepareError(self):
+        """
+        Statements that fail to prepare are not cached.
+        """
+        d = self.conn.runQuery("select * from nonexistent")
+        d = self.assertFailure(d, psycopg2.ProgrammingError)
+        d.addCallback(lambda _: self.assertEquals(self.conn._statements, {}))
+        d.addCallback(lambda _: self.conn.runQuery("select 1"))
+        return d.addCallback(self.assertEquals, [(1, )])
+
+
+class RowConsumer(object):
+    """
+    A consumer that collects the batches of rows written to it.
+
+    @ivar onWrite: A callable that gets called with the consumer after each
+        write, or C{None}.
+    """
+    implements(interfaces.IConsumer)
+
+    producer = None
+    onWrite = None
+
+    def __init__(self):
+        self.batches = []
+        self.registrations = []
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.registrations.append(streaming)
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, rows):
+        self.batches.append(rows)
+        if self.onWrite:
+            self.onWrite(self)
+
+
+class PGADBAPIStreamingTestCase(_SimpleDBSetupMixin, Psycopg2TestCase):
+
+    query = "select i from generate_series(1, %s) as i"
+
+    def test_streamQuery(self):
+        """
+        streamQuery writes the rows to the consumer in batches, fires with the
+        number of rows and unregisters the producer when done.
+        """
+        consumer = RowConsumer()
+        d = self.conn.streamQuery(consumer, self.query, (10, ), batchSize=3)
+        def check(rows):
+            self.assertEquals(rows, 10)
+            self.assertEquals(consumer.registrations, [True])
+            self.assertIdentical(consumer.producer, None)
+            self.assertEquals(consumer.batches,
+                              [[(1, ), (2, ), (3, )], [(4, ), (5, ), (6, )],
+                               [(7, ), (8, ), (9, )], [(10, )]])
+        return d.addCallback(check)
+
+    def test_exactBatches(self):
+        """
+        A result whose size is a multiple of the batch size does not produce
+        an empty write.
+        """
+        consumer = RowConsumer()
+        d = self.conn.streamQuery(consumer, self.query, (4, ), batchSize=2)
+        d.addCallback(self.assertEquals, 4)
+        return d.addCallback(lambda _: self.assertEquals(
+                consumer.batches, [[(1, ), (2, )], [(3, ), (4, )]]))
+
+    def test_pause(self):
+        """
+        No rows are fetched while the consumer has the producer paused.
+        """
+        from twisted.internet import reactor
+        consumer = RowConsumer()
+        def pauseOnce(consumer):
+            consumer.onWrite = None
+            consumer.producer.pauseProducing()
+        consumer.onWrite = pauseOnce
+        d = self.conn.streamQuery(consumer, self.query, (6, ), batchSize=2)
+
+        def checkPaused(_):
+            self.assertEquals(consumer.batches, [[(1, ), (2, )]])
+            consumer.producer.resumeProducing()
+            return d
+        paused = task.deferLater(reactor, 0.1, lambda: None)
+        paused.addCallback(checkPaused)
+        paused.addCallback(self.assertEquals, 6)
+        return paused.addCallback(lambda _: self.assertEquals(
+                len(consumer.batches), 3))
+
+    def test_stop(self):
+        """
+        When the consumer stops the producer no more rows are written, the
+        returned Deferred fails with C{defer.CancelledError} and the
+        connection is usable afterwards.
+        """
+        consumer = RowConsumer()
+        consumer.onWrite = lambda consumer: consumer.producer.stopProducing()
+        d = self.conn.streamQuery(consumer, self.query, (6, ), batchSize=2)
+        d = self.assertFailure(d, defer.CancelledError)
+        d.addCallback(lambda _: self.assertEquals(
+                consumer.batches, [[(1, ), (2, )]]))
+        d.addCallback(lambda _: self.assertIdentical(consumer.producer, None))
+        d.addCallback(lambda _: self.conn.runQuery("select 1"))
+        return d.addCallback(self.assertEquals, [(1, )])
+
+    def test_errors(self):
+        """
+        Errors in the query are passed on and the producer gets unregistered.
+        """
+        consumer = RowConsumer()
+        d = self.conn.streamQuery(consumer, "select * from nonexistent")
+        d = self.assertFailure(d, psycopg2.ProgrammingError)
+        d.addCallback(lambda _: self.assertIdentical(consumer.producer, None))
+        d.addCallback(lambda _: self.conn.runQuery("select 1"))
+        return d.addCallback(self.assertEquals, [(1, )])
+
+
+class ChunkProducer(object):
+    """
+    A producer that writes a list of chunks to a consumer, as fast as the
+    consumer lets it.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.paused = False
+        self.stopped = False
+        self.pauses = 0
+        self._d = None
+
+    def startProducing(self, consumer):
+        self.consumer = consumer
+        self._d = defer.Deferred()
+        d = self._d
+        self._produce()
+        return d
+
+    def _produce(self):
+        while self.chunks and not (self.paused or self.stopped):
+            self.consumer.write(self.chunks.pop(0))
+        if not self.chunks and not self.stopped and self._d:
+            d, self._d = self._d, None
+            d.callback(None)
+
+    def pauseProducing(self):
+        self.paused = True
+        self.pauses += 1
+
+    def resumeProducing(self):
+        self.paused = False
+        self._produce()
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class PGADBAPICopyTestCase(_SimpleDBSetupMixin, Psycopg2TestCase):
+
+    def test_copyFrom(self):
+        """
+        copyFrom inserts the rows of the CSV data, even when lines are split
+        across writes, and fires with the number of rows.
+        """
+        producer = ChunkProducer(["1\n2\n3", "\n4\n\n", "5"])
+        d = self.conn.copyFrom("simple", producer, batchSize=2)
+        d.addCallback(self.assertEquals, 5)
+        d.addCallback(lambda _: self.conn.runQuery(
+                "select x from simple order by x"))
+        return d.addCallback(self.assertEquals, [(i, ) for i in range(1, 6)])
+
+    def test_csvQuoting(self):
+        """
+        Quoted fields can hold commas, quotes and newlines, empty fields are
+        inserted as NULL and the data can go into chosen columns.
+        """
+        producer = ChunkProducer(['1,"x, ""y', '""\r\nz"\r\n', ',\n'])
+        d = self.conn.runOperation("create table y (a text, b int)")
+        d.addCallback(lambda _: self.conn.copyFrom(
+                "y", producer, columns=["b", "a"]))
+        d.addCallback(self.assertEquals, 2)
+        d.addCallback(lambda _: self.conn.runQuery(
+                "select a, b from y order by b"))
+        d.addCallback(self.assertEquals,
+                      [('x, "y"\r\nz', 1), (None, None)])
+        return d.addBoth(lambda res: self.conn.runOperation(
+                "drop table y").addCallback(lambda _: res))
+
+    def test_quotedEmptyField(self):
+        """
+        A quoted empty field is inserted as an empty string, not as NULL.
+        """
+        producer = ChunkProducer(['"",1\n', ',2\n', '"""",3\n'])
+        d = self.conn.runOperation("create table y (a text, b int)")
+        d.addCallback(lambda _: self.conn.copyFrom("y", producer))
+        d.addCallback(self.assertEquals, 3)
+        d.addCallback(lambda _: self.conn.runQuery(
+                "select a, b from y order by b"))
+        d.addCallback(self.assertEquals, [("", 1), (None, 2), ('"', 3)])
+        return d.addBoth(lambda res: self.conn.runOperation(
+                "drop table y").addCallback(lambda _: res))
+
+    def test_backpressure(self):
+        """
+        The producer is paused while rows wait to be inserted, and all rows
+        end up inserted.
+        """
+        producer = ChunkProducer(["%d\n" % i for i in range(50)])
+        d = self.conn.copyFrom("simple", producer, batchSize=2)
+        d.addCallback(self.assertEquals, 50)
+        d.addCallback(lambda _: self.assertNotEquals(producer.pauses, 0))
+        d.addCallback(lambda _: self.conn.runQuery(
+                "select count(*) from simple"))
+        return d.addCallback(self.assertEquals, [(50, )])
+
+    def test_errors(self):
+        """
+        If inserting fails the producer is stopped, nothing is inserted and
+        the failure is passed on.
+        """
+        # more rows than can wait to be inserted, so that the producer is
+        # still producing when the insert fails
+        producer = ChunkProducer(["1\n", "2\n", "boom\n"] +
+                                 ["%d\n" % i for i in range(4, 20)])
+        d = self.conn.copyFrom("simple", producer, batchSize=1)
+        d = self.assertFailure(d, psycopg2.DataError)
+        d.addCallback(lambda _: self.assertTrue(producer.stopped))
+        d.addCallback(lambda _: self.conn.runQuery(
+                "select count(*) from simple"))
+        return d.addCallback(self.assertEquals, [(0, )])
+
+    def test_unterminatedQuote(self):
+        """
+        Data that ends in the middle of a quoted field is rejected.
+        """
+        producer = ChunkProducer(['1\n"2\n'])
+        d = self.conn.copyFrom("simple", producer)
+        d = self.assertFailure(d, ValueError)
+        d.addCallback(lambda _: self.conn.runQuery(
+                "select count(*) from simple"))
+        return d.addCallback(self.assertEquals, [(0, )])
+
+
+class PGADBAPINotifierTestCase(Psycopg2TestCase):
+
+    def setUp(self):
+        self.notifier = pgadbapi.Notifier(
+            user=DB_USER, password=DB_PASS, host=DB_HOST, database=DB_NAME)
+        self.notifier.reconnectDelay = 0.01
+        self.conn = pgadbapi.Connection()
+        return self.conn.connect(user=DB_USER, password=DB_PASS,
+                                 host=DB_HOST, database=DB_NAME)
+
+    def tearDown(self):
+        self.conn.close()
+        return self.notifier.stopService()
+
+    def notify(self, channel, payload):
+        return self.conn.runOperation(
+            "select pg_notify(%s, %s)", (channel, payload))
+
+    def collect(self, channel, until=None):
+        """
+        Subscribe to 'channel', returning a list that the received
+        notifications get appended to and a Deferred that fires when a
+        notification with payload 'until' arrives.
+        """
+        received = []
+        d = defer.Deferred()
+        def callback(channel, payload):
+            received.append((channel, payload))
+            if payload == until and not d.called:
+                d.callback(received)
+        subscribed = self.notifier.subscribe(channel, callback)
+        return subscribed, received, d, callback
+
+    def test_dispatch(self):
+        """
+        Subscribers get called with the channel and the payload of the
+        notifications sent on their channel only.
+        """
+        self.notifier.startService()
+        _, a, aDone, _ = self.collect("a", until="last")
+        _, b, bDone, _ = self.collect("B b", until="last")
+        d = self.notifier.subscribe("a", lambda *args: None)
+        self.assertFalse(d.called)
+        d.addCallback(lambda _: self.notify("a", "1"))
+        d.addCallback(lambda _: self.notify("B b", "2"))
+        d.addCallback(lambda _: self.notify("a", "last"))
+        d.addCallback(lambda _: self.notify("B b", "last"))
+        d.addCallback(lambda _: defer.gatherResults([aDone, bDone]))
+        return d.addCallback(self.assertEquals,
+                             [[("a", "1"), ("a", "last")],
+                              [("B b", "2"), ("B b", "last")]])
+
+    def test_subscribeBeforeStart(self):
+        """
+        Channels subscribed to before the service starts are listened on once
+        it connects, and the subscription fires then.
+        """
+        subscribed, received, done, _ = self.collect("a", until="x")
+        self.assertFalse(subscribed.called)
+        self.notifier.startService()
+        subscribed.addCallback(lambda _: self.notify("a", "x"))
+        subscribed.addCallback(lambda _: done)
+        return subscribed.addCallback(self.assertEquals, [("a", "x")])
+
+    def test_stopBeforeConnected(self):
+        """
+        Subscriptions waiting for the connection fail with
+        C{defer.CancelledError} when the service is stopped.
+        """
+        subscribed, _, _, _ = self.collect("a")
+        self.notifier.startService()
+        stopped = self.notifier.stopService()
+        return defer.gatherResults([
+                stopped, self.assertFailure(subscribed, defer.CancelledError)])
+
+    def test_unsubscribe(self):
+        """
+        Unsubscribed callbacks are not called anymore.
+        """
+        self.notifier.startService()
+        _, a, _, callback = self.collect("a")
+        subscribed, b, bDone, _ = self.collect("b", until="done")
+        d = subscribed.addCallback(
+            lambda _: self.notifier.unsubscribe("a", callback))
+        d.addCallback(lambda _: self.notify("a", "ignored"))
+        d.addCallback(lambda _: self.notify("b", "done"))
+        d.addCallback(lambda _: bDone)
+        d.addCallback(lambda _: self.assertEquals(a, []))
+        return d.addCallback(lambda _: self.assertEquals(
+                self.notifier._subscribers.keys(), ["b"]))
+
+    def test_unsubscribeBeforeConnected(self):
+        """
+        A subscription made before the service connects fires once it has
+        connected, even if it was unsubscribed from meanwhile.
+        """
+        subscribed, _, _, callback = self.collect("a")
+        self.notifier.unsubscribe("a", callback)
+        self.notifier.startService()
+        subscribed.addCallback(lambda _: self.assertNotIdentical(
+                self.notifier.connection, None))
+        return subscribed.addCallback(lambda _: self.assertEquals(
+                self.notifier._listenWaiters, []))
+
+    def test_reconnect(self):
+        """
+        When the listening connection is lost the notifier reconnects and
+        listens on its channels again.
+        """
+        self.notifier.startService()
+        subscribed, received, done, _ = self.collect("a", until="after")
+
+        def kill(_):
+            pid = self.notifier.connection.get_backend_pid()
+            return self.conn.runQuery("select pg_terminate_backend(%s)",
+                                      (pid, ))
+        def sendUntilReceived(_):
+            sender = task.LoopingCall(self.notify, "a", "after")
+            stopped = sender.start(0.05)
+            def stop(result):
+                sender.stop()
+                return stopped.addCallback(lambda _: result)
+            return done.addBoth(stop)
+        def check(received):
+            self.assertEquals(received[-1], ("a", "after"))
+            self.assertNotIdentical(self.notifier.connection, None)
+        subscribed.addCallback(kill)
+        subscribed.addCallback(sendUntilReceived)
+        return subscribed.addCallback(check)
+
+    def test_failingSubscriber(self):
+        """
+        Exceptions raised by subscribers are logged and do not keep other
+        subscribers from being called.
+        """
+        self.notifier.startService()
+        def broken(channel, payload):
+            raise RuntimeError("boom")
+        d = self.notifier.subscribe("a", broken)
+        _, received, done, _ = self.collect("a", until="x")
+        d.addCallback(lambda _: self.notify("a", "x"))
+        d.addCallback(lambda _: done)
+        return d.addCallback(lambda _: self.assertEquals(
+                len(self.flushLoggedErrors(RuntimeError)), 1))
+
+
 class PGADBAPIConnectionPoolTestCase(Psycopg2TestCase):
 
     def setUp(self):
@@ -538,7 +1053,7 @@ class PGADBAPIConnectionPoolTestCase(Psycopg2TestCase):
         wait. The queries return correct values.
         """
         ds = [self.pool.runQuery("select 1") for _ in range(self.pool.min)]
-        self.assertEquals(len(self.pool._semaphore.waiting), 0)
+        self.assertEquals(self.pool.saturation()['waiting'], 0)
 
         d = defer.gatherResults(ds)
         return d.addCallback(self.assertEquals, [[(1, )]] * self.pool.min)
@@ -584,6 +1099,155 @@ class PGADBAPIConnectionPoolTestCase(Psycopg2TestCase):
         return defer.gatherResults([self.pool.runInteraction(interaction)
                                     for _ in range(self.pool.min * 20)])
 
+    def test_statementCacheSize(self):
+        """
+        The pool sets the 'statementCacheSize' of its connections if given.
+        """
+        pool = pgadbapi.ConnectionPool(None, statementCacheSize=5)
+        self.assertEquals([c.statementCacheSize for c in pool.connections],
+                          [5] * pool.min)
+        self.assertNotIn('statementCacheSize', pool.connkw)
+
+    def test_copyFrom(self):
+        """
+        The pool's copyFrom works.
+        """
+        d = self.pool.runOperation("create table y (i int)")
+        d.addCallback(lambda _: self.pool.copyFrom(
+                "y", ChunkProducer(["1\n2\n"])))
+        d.addCallback(self.assertEquals, 2)
+        d.addCallback(lambda _: self.pool.runQuery("select sum(i) from y"))
+        d.addCallback(self.assertEquals, [(3, )])
+        return d.addBoth(lambda res: self.pool.runOperation(
+                "drop table y").addCallback(lambda _: res))
+
+    def test_streamQuery(self):
+        """
+        The pool's streamQuery works.
+        """
+        consumer = RowConsumer()
+        d = self.pool.streamQuery(
+            consumer, "select i from generate_series(1, 5) as i",
+            batchSize=2)
+        d.addCallback(self.assertEquals, 5)
+        return d.addCallback(lambda _: self.assertEquals(
+                [len(b) for b in consumer.batches], [2, 2, 1]))
+
+
+class PGADBAPIConnectionPoolSchedulingTestCase(Psycopg2TestCase):
+
+    # a query that cannot finish before the reactor gets control back
+    slowQuery = "select %s from pg_sleep(0.05)"
+
+    def makePool(self, **kw):
+        pool = pgadbapi.ConnectionPool(
+            None, user=DB_USER, password=DB_PASS,
+            host=DB_HOST, database=DB_NAME, **kw)
+        self.addCleanup(pool.close)
+        return pool.start()
+
+    def test_leastLoaded(self):
+        """
+        Queries are spread over the connections, each going to the one with
+        the fewest calls in flight.
+        """
+        def check(pool):
+            ds = [pool.runQuery(self.slowQuery, (1, ))
+                  for _ in range(pool.min * 2)]
+            self.assertEquals(sorted(pool._load.values()), [2] * pool.min)
+            report = pool.saturation()
+            self.assertEquals(report['busy'], pool.min)
+            self.assertEquals(report['inFlight'], pool.min * 2)
+            self.assertEquals(report['waiting'], 0)
+            self.assertEquals(report['saturation'], 1.0)
+            return defer.gatherResults(ds)
+        d = self.makePool(pipeline=2)
+        d.addCallback(check)
+        return d.addCallback(self.assertEquals, [[(1, )]] * 6)
+
+    def test_pipelineLimit(self):
+        """
+        Calls beyond the pool's pipelining capacity wait for a connection, and
+        are run when one frees up.
+        """
+        def check(pool):
+            ds = [pool.runQuery(self.slowQuery, (i, )) for i in range(5)]
+            report = pool.saturation()
+            self.assertEquals(report['inFlight'], 2)
+            self.assertEquals(report['waiting'], 3)
+            self.assertEquals(report['saturation'], 2.5)
+            d = defer.gatherResults(ds)
+            d.addCallback(lambda res: self.assertEquals(
+                    pool.saturation()['inFlight'], 0) or res)
+            return d
+        d = self.makePool(min=1, pipeline=2)
+        d.addCallback(check)
+        return d.addCallback(self.assertEquals, [[(i, )] for i in range(5)])
+
+    def test_interactionIsExclusive(self):
+        """
+        No other call is put on a connection that is running an interaction,
+        even if the pool pipelines calls.
+        """
+        def check(pool):
+            def interaction(c):
+                d = c.execute(self.slowQuery, (1, ))
+                return d.addCallback(lambda _: self.assertEquals(
+                        pool.saturation()['waiting'], 1))
+            d1 = pool.runInteraction(interaction)
+            d2 = pool.runQuery("select 2")
+            self.assertEquals(pool.saturation()['waiting'], 1)
+            return defer.gatherResults([d1, d2])
+        d = self.makePool(min=1, pipeline=3)
+        d.addCallback(check)
+        return d.addCallback(
+            lambda (c, res): self.assertEquals(res, [(2, )]))
+
+    def test_saturated(self):
+        """
+        When the wait queue is full, calls fail right away with
+        L{pgadbapi.PoolSaturated}.
+        """
+        def check(pool):
+            ok = [pool.runQuery(self.slowQuery, (1, )) for _ in range(2)]
+            d = pool.runQuery(self.slowQuery, (1, ))
+            self.assertEquals(pool.saturation()['rejections'], 1)
+            return defer.gatherResults(
+                ok + [self.assertFailure(d, pgadbapi.PoolSaturated)])
+        d = self.makePool(min=1, maxWaiting=1)
+        return d.addCallback(check)
+
+    def test_waitTimeout(self):
+        """
+        Calls that wait for a connection for longer than the pool's
+        'waitTimeout' fail with C{defer.TimeoutError}, and the pool keeps
+        working afterwards.
+        """
+        def check(pool):
+            slow = pool.runOperation("select pg_sleep(0.5)")
+            d = self.assertFailure(pool.runQuery("select 1"),
+                                   defer.TimeoutError)
+            d.addCallback(lambda _: self.assertEquals(
+                    pool.saturation()['timeouts'], 1))
+            d.addCallback(lambda _: slow)
+            d.addCallback(lambda _: pool.runQuery("select 1"))
+            return d.addCallback(self.assertEquals, [(1, )])
+        d = self.makePool(min=1, waitTimeout=0.05)
+        return d.addCallback(check)
+
+    def test_closeCancelsWaiting(self):
+        """
+        Closing the pool fails the calls that are still waiting for a
+        connection.
+        """
+        def check(pool):
+            d = pool.runQuery("select 1")
+            self.assertEquals(pool.saturation()['waiting'], 1)
+            pool.close()
+            return self.assertFailure(d, defer.CancelledError)
+        d = self.makePool(min=0)
+        return d.addCallback(check)
+
 
 class PGADBAPIConnectionPoolHotswappingTestCase(Psycopg2TestCase):
 